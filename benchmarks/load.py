@@ -0,0 +1,70 @@
+"""Renders a document concurrently against a running splat, reporting throughput and latency.
+
+Works against both the lambda runtime interface emulator and the HTTP server mode, e.g. via docker compose:
+
+    mise run benchmark:server
+    uv run python benchmarks/load.py --url http://localhost:8080/2015-03-31/functions/function/invocations -c 1
+"""
+
+import argparse
+import json
+import statistics
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_URL = "http://localhost:8081/2015-03-31/functions/function/invocations"
+DOCUMENT = "<h1>Invoice {index}</h1>" + "<table>" + "<tr><td>Line item</td><td>$10.00</td></tr>" * 200 + "</table>"
+
+
+def render(url: str, body: dict, index: int) -> tuple[str, float, int]:
+    """Returns the outcome of a render (the render's status code, or the server's when it failed the request), how
+    long it took including retries, and how many times it was turned away with a 503 before being accepted"""
+    body = {**body, "document_content": body["document_content"].format(index=index)}
+    started = time.perf_counter()
+    rejections = 0
+    while True:
+        response = requests.post(url, json={"body": json.dumps(body)}, timeout=15 * 60)
+        if response.status_code != 503 or "Retry-After" not in response.headers:
+            break
+        rejections += 1
+        time.sleep(float(response.headers["Retry-After"]))
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        return f"http {response.status_code}", elapsed, rejections
+    return str(response.json()["statusCode"]), elapsed, rejections
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-r", "--renderer", default="princexml", choices=["princexml", "playwright"])
+    parser.add_argument("-b", "--bucket", help="Deliver to this bucket rather than in the response, e.g. test")
+    args = parser.parse_args()
+
+    # Unique documents, so that every request renders rather than hitting the render cache
+    body = {"document_content": DOCUMENT, "renderer": args.renderer, "cache": False}
+    if args.bucket:
+        body["bucket_name"] = args.bucket
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda index: render(args.url, body, index), range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    outcomes = Counter(outcome for outcome, _, _ in results)
+    latencies = sorted(latency * 1000 for outcome, latency, _ in results if outcome in {"200", "201"})
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {elapsed:.1f}s")
+    print(f"outcomes: {dict(outcomes)}, queue full rejections: {sum(rejections for _, _, rejections in results)}")
+    print(f"throughput: {len(latencies) / elapsed:.2f} pdfs/s")
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"latency ms: p50={percentiles[49]:.0f} p90={percentiles[89]:.0f} p99={percentiles[98]:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Measures what a cold start pays to import the lambda module, and what each deferred dependency costs on first use.
+
+Run it inside the built image, so that it measures the dependencies the lambda actually ships with:
+
+    mise run benchmark:startup
+
+Each sample is a fresh interpreter, as a new lambda container would be.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+SCENARIOS = {
+    "lambda_function": "import lambda_function",
+    "+ requests (document_url, presigned_url)": "import lambda_function, requests",
+    "+ boto3 (bucket_name, render cache)": "import lambda_function, boto3",
+    "+ playwright (browser renders)": "import lambda_function, playwright.sync_api",
+}
+
+
+def sample(statement: str) -> tuple[float, dict[str, int]]:
+    """Returns the wall time of a fresh interpreter running statement, and the cumulative import time (us) of each
+    module imported directly by lambda_function
+    """
+    started = time.perf_counter()
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True
+    )
+    wall = time.perf_counter() - started
+
+    # A module's line follows the lines of everything it imported, which are indented one level further
+    children: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, module = line.removeprefix("import time:").split("|")
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 1:
+            children[module.strip()] = int(cumulative_us)
+        elif depth == 0:
+            if module.strip() == "lambda_function":
+                return wall, children
+            children = {}
+    return wall, {}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--samples", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules to list")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<45} {'median ms':>10} {'p90 ms':>10}")
+    module_times: dict[str, list[int]] = {}
+    for name, statement in SCENARIOS.items():
+        walls = []
+        for _ in range(args.samples):
+            wall, cumulative = sample(statement)
+            walls.append(wall * 1000)
+            if statement == SCENARIOS["lambda_function"]:
+                for module, us in cumulative.items():
+                    module_times.setdefault(module, []).append(us)
+        p90 = statistics.quantiles(walls, n=10)[-1] if len(walls) > 1 else walls[0]
+        print(f"{name:<45} {statistics.median(walls):>10.1f} {p90:>10.1f}")
+
+    print("\nSlowest imports made by lambda_function itself (median cumulative ms)")
+    slowest = sorted(module_times.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for module, times in slowest[: args.top]:
+        print(f"{module:<45} {statistics.median(times) / 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,101 @@
+from __future__ import annotations
+
 import base64
+import binascii
+import collections
+import contextvars
+import datetime
+import email.utils
 import enum
+import functools
+import hashlib
+import io
 import json
 import logging
+import math
+import mimetypes
+import mmap
 import os
+import re
+import resource
+import select
+import shutil
+import socket
 import subprocess
-import sys
 import tempfile
+import threading
+import time
 import uuid
 import xml.etree.ElementTree as ET
-from asyncio import InvalidStateError
-from collections.abc import Iterator, Mapping
-from contextlib import contextmanager
+import zlib
+from collections.abc import Callable, Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, suppress
 from dataclasses import dataclass, field
-from typing import Any
-from urllib.parse import urlparse
+from typing import TYPE_CHECKING, Any, BinaryIO, Literal
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse
 
-import boto3
-import playwright
-import playwright.sync_api
 import pydantic
-import requests
-import sentry_sdk
-from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
-from playwright.sync_api import sync_playwright
-from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+# Renderer and delivery specific dependencies are imported where they're first used, so that a cold start only pays
+# for the ones its request needs. e.g. a princexml document_content render never loads playwright or boto3.
+if TYPE_CHECKING:
+    import playwright.sync_api
+    import requests
 
 logger = logging.getLogger("splat")
 
 S3_RETRY_COUNT = 10
+MAX_WARM_BROWSERS = int(os.environ.get("SPLAT_MAX_WARM_BROWSERS", "2"))
+PRINCE_CONTROL_ENABLED = os.environ.get("SPLAT_PRINCE_CONTROL", "true").lower() in {"1", "true", "yes"}
+PRINCE_WORKER_START_TIMEOUT = 30  # seconds
+PRINCE_JOB_TIMEOUT = 60 * 10  # seconds
+# Lambda exposes its vCPU allocation (which scales with memory) as the cpu count
+CPU_COUNT = os.cpu_count() or 1
+PRINCE_WORKER_COUNT = int(os.environ.get("SPLAT_PRINCE_WORKERS", str(CPU_COUNT)))
+BATCH_MAX_WORKERS = int(os.environ.get("SPLAT_BATCH_MAX_WORKERS", str(CPU_COUNT)))
+S3_MULTIPART_THRESHOLD = int(os.environ.get("SPLAT_S3_MULTIPART_THRESHOLD", str(16 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get("SPLAT_S3_MULTIPART_CHUNKSIZE", str(16 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.environ.get("SPLAT_S3_MAX_CONCURRENCY", "10"))
+S3_MAX_POOL_CONNECTIONS = 50
+DOCUMENT_MAX_BYTES = int(os.environ.get("SPLAT_DOCUMENT_MAX_BYTES", str(512 * 1024 * 1024)))
+DOCUMENT_CHUNK_SIZE = 1024 * 1024
+ASSET_CACHE_DIR = "/tmp/splat-cache/assets"  # noqa
+ASSET_CACHE_MAX_BYTES = int(os.environ.get("SPLAT_ASSET_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+ASSET_CACHE_DEFAULT_TTL = int(os.environ.get("SPLAT_ASSET_CACHE_DEFAULT_TTL", str(60 * 60)))
+ASSET_FETCH_TIMEOUT = 30  # seconds
+# Asset urls whose file name is the sha256 of their content, e.g. .../splat-assets/<sha256>.png
+CONTENT_ADDRESSED_RE = re.compile(r"/[0-9a-f]{64}(\.[A-Za-z0-9]+)?$")
+# Documents up to this size are rendered without touching disk
+IN_MEMORY_RENDER_MAX_BYTES = int(os.environ.get("SPLAT_IN_MEMORY_RENDER_MAX_BYTES", str(32 * 1024 * 1024)))
+# Namespace for the CloudWatch embedded metric format metrics logged after each render. Empty to disable.
+METRICS_NAMESPACE = os.environ.get("SPLAT_METRICS_NAMESPACE", "Splat")
+PDF_PAGE_RE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+FONTCONFIG_FILE = "/var/task/fontconfig/fonts.conf"
+FONTCONFIG_CACHE_DIR = "/var/task/fontconfig/cache"
+FONT_DIRS = ("/var/task/fonts", "/usr/share/fonts", "/usr/local/share/fonts")
+RENDER_CACHE_DIR = "/tmp/splat-cache/renders"  # noqa
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("SPLAT_RENDER_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Lambda caps responses at 6MB, leave room for the rest of the response around the base64 encoded pdf
+STREAMING_MAX_BYTES = int(5.5 * 1024 * 1024)
+# Streamed pdfs too large for a response are uploaded here instead, and a presigned url to them returned
+SPILL_BUCKET = os.environ.get("SPLAT_SPILL_BUCKET") or None
+SPILL_PREFIX = os.environ.get("SPLAT_SPILL_PREFIX", "spill/")
+TMP_DIR = "/tmp"  # noqa
+WORKSPACE_DIR = "/tmp/splat/work"  # noqa
+# Caches are evicted once /tmp holds more than this. Defaults to 80% of the ephemeral storage.
+TMP_MAX_BYTES = int(os.environ.get("SPLAT_TMP_MAX_BYTES", "0")) or None
 
-sentry_sdk.init(
-    dsn=os.environ.get("SENTRY_DSN", ""),
-    integrations=[
-        AwsLambdaIntegration(),
-    ],
-)
+if SENTRY_DSN := os.environ.get("SENTRY_DSN"):
+    import sentry_sdk
+    from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+    sentry_sdk.init(
+        dsn=SENTRY_DSN,
+        integrations=[
+            AwsLambdaIntegration(),
+        ],
+    )
 
 
 class Renderers(str, enum.Enum):
@@ -42,6 +103,50 @@ class Renderers(str, enum.Enum):
     princexml = "princexml"
 
 
+class S3TransferOptions(pydantic.BaseModel):
+    multipart_threshold: int = pydantic.Field(default=S3_MULTIPART_THRESHOLD, ge=5 * 1024 * 1024)
+    multipart_chunksize: int = pydantic.Field(default=S3_MULTIPART_CHUNKSIZE, ge=5 * 1024 * 1024)
+    max_concurrency: int = pydantic.Field(default=S3_MAX_CONCURRENCY, ge=1, le=S3_MAX_POOL_CONNECTIONS)
+
+
+class WaitFor(pydantic.BaseModel):
+    """When a page visited by the browser is ready to render. Phases run in field order; times are in seconds."""
+
+    load_state: Literal["commit", "domcontentloaded", "load"] = "load"
+    load_timeout: float = pydantic.Field(default=60 * 10, gt=0)
+    ## Wait until no requests have been in flight for `networkidle_quiet_ms`
+    networkidle_quiet_ms: int | None = pydantic.Field(default=None, ge=0)
+    networkidle_timeout: float = pydantic.Field(default=30, gt=0)
+    ## Wait for an element matching the css selector to be attached
+    selector: str | None = None
+    selector_timeout: float = pydantic.Field(default=30, gt=0)
+    ## Wait for a javascript expression to be truthy, e.g. `window.__splatReady === true`
+    function: str | None = None
+    function_timeout: float = pydantic.Field(default=30, gt=0)
+    delay: float = pydantic.Field(default=0, ge=0)
+
+
+# Images are downsampled to image_dpi once drawn at more than 1.5x it. None leaves images alone.
+PDF_OPTIMIZE_PRESETS: dict[str, dict[str, Any]] = {
+    "screen": {"image_dpi": 150, "jpeg_quality": 75, "linearize": True},
+    "print": {"image_dpi": 300, "jpeg_quality": 90, "linearize": False},
+    "archive": {"image_dpi": None, "jpeg_quality": None, "linearize": False},
+}
+
+
+class PdfOptimization(pydantic.BaseModel):
+    """Post-processing of the rendered pdf. Fields that aren't set take their value from the preset."""
+
+    preset: Literal["screen", "print", "archive"] = "print"
+    image_dpi: int | None = pydantic.Field(default=None, ge=72)
+    jpeg_quality: int | None = pydantic.Field(default=None, ge=1, le=100)
+    ## Reorder the pdf for fast web view, so viewers can show the first page before the rest has downloaded
+    linearize: bool | None = None
+
+    def setting(self, name: str) -> Any:
+        return getattr(self, name) if name in self.model_fields_set else PDF_OPTIMIZE_PRESETS[self.preset][name]
+
+
 class Payload(pydantic.BaseModel):
     # NOTE: When updating this model, also update the equivalent documentation
     # General Parameters
@@ -51,6 +156,8 @@ class Payload(pydantic.BaseModel):
     # Input parameters
     ## Embed the document content as a string
     document_content: str | None = None
+    ## How document_content is encoded, so large documents fit in lambda's payload limit
+    document_content_encoding: Literal["gzip+base64"] | None = None
     ## Fetch the document from a URL, store it and render it
     document_url: str | None = None
     ## Browse the document in a browser before rendering
@@ -59,11 +166,37 @@ class Payload(pydantic.BaseModel):
     browser_headers: dict = pydantic.Field(default_factory=dict)
     browser_context: dict = pydantic.Field(default_factory=dict)
     browser_pdf_options: Mapping[str, Any] = pydantic.Field(default_factory=dict)
+    ## Restrict what the browser may fetch while rendering
+    browser_allowed_domains: list[str] | None = None
+    browser_blocked_domains: list[str] = pydantic.Field(default_factory=list)
+    browser_blocked_resource_types: list[str] = pydantic.Field(default_factory=list)
+    browser_request_timeout: float | None = pydantic.Field(default=None, gt=0)
+    wait_for: WaitFor = pydantic.Field(default_factory=WaitFor)
     renderer: Renderers = Renderers.princexml
+    ## Serve identical documents rendered with identical options from the render cache. Opt in: the cache is keyed on
+    ## the document alone, so a cached render doesn't change when the assets it references do.
+    cache: bool = False
 
     # Output parameters
     bucket_name: str | None = None
+    ## Tune the multipart upload used to store the pdf in `bucket_name`
+    s3_transfer: S3TransferOptions = pydantic.Field(default_factory=S3TransferOptions)
     presigned_url: dict = pydantic.Field(default_factory=dict)
+    ## Upload the response, less any base64 encoded pdf, to this presigned post once done
+    status_url: dict = pydantic.Field(default_factory=dict)
+    ## Shrink the pdf before delivering it, given as a preset name or as options
+    optimize: PdfOptimization | None = None
+
+    @pydantic.field_validator("optimize", mode="before")
+    @classmethod
+    def optimize_preset(cls, value: Any) -> Any:
+        return {"preset": value} if isinstance(value, str) else value
+
+
+class BatchPayload(pydantic.BaseModel):
+    # NOTE: When updating this model, also update the equivalent documentation
+    items: list[Payload] = pydantic.Field(min_length=1)
+    max_workers: int | None = pydantic.Field(default=None, ge=1)
 
 
 @dataclass
@@ -94,94 +227,433 @@ class SplatPDFGenerationFailure(Exception):
         )
 
 
+@functools.cache
+def font_cache_state() -> str:
+    """Whether the fontconfig cache built with the image covers the fonts on disk: "fresh", "stale" or "missing".
+
+    fontconfig rescans any font directory modified since its cache was built, which for a stale cache costs the first
+    render of every container a scan of those fonts.
+    """
+    try:
+        built = max(entry.stat().st_mtime for entry in os.scandir(FONTCONFIG_CACHE_DIR) if entry.is_file())
+    except (FileNotFoundError, ValueError):
+        return "missing"
+    for font_dir in FONT_DIRS:
+        for dirpath, _, _ in os.walk(font_dir):
+            if os.stat(dirpath).st_mtime > built:
+                return "stale"
+    return "fresh"
+
+
+@functools.cache
 def init() -> None:
+    """Per container setup, run once on the first invocation"""
+    if os.path.exists(FONTCONFIG_FILE):
+        # Point both prince and chromium at the fontconfig cache built with the image
+        os.environ["FONTCONFIG_FILE"] = FONTCONFIG_FILE
+        print(f"splat|font_cache|{font_cache_state()}")
     # If there's any files in the font directory, export FONTCONFIG_PATH
-    if any(f for f in os.listdir("fonts") if f != "fonts.conf"):
+    elif any(f for f in os.listdir("fonts") if f != "fonts.conf"):
         os.environ["FONTCONFIG_PATH"] = "/var/task/fonts"
 
 
+CHROMIUM_ARGS = [
+    "--single-process",
+    "--disable-gpu",
+    "--no-sandbox",
+    "--no-zygote",
+    "--disable-dev-shm-usage",
+    "--autoplay-policy=user-gesture-required",
+    "--disable-background-networking",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-breakpad",
+    "--disable-client-side-phishing-detection",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-domain-reliability",
+    "--disable-extensions",
+    "--disable-features=AudioServiceOutOfProcess",
+    "--disable-hang-monitor",
+    "--disable-ipc-flooding-protection",
+    "--disable-notifications",
+    "--disable-offer-store-unmasked-wallet-cards",
+    "--disable-popup-blocking",
+    "--disable-print-preview",
+    "--disable-prompt-on-repost",
+    "--disable-renderer-backgrounding",
+    "--disable-setuid-sandbox",
+    "--disable-speech-api",
+    "--disable-sync",
+    "--disk-cache-size=33554432",
+    "--hide-scrollbars",
+    "--ignore-gpu-blacklist",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-default-browser-check",
+    "--no-first-run",
+    "--no-pings",
+    "--password-store=basic",
+    "--use-gl=swiftshader",
+    "--use-mock-keychain",
+]
+
+
+class BrowserManager:
+    """Keeps chromium alive between invocations of a warm lambda container.
+
+    Browsers are keyed on their launch kwargs so that a payload with custom `browser_launch_kwargs` gets its own
+    browser without evicting the default one. Each render gets a fresh, isolated browser context. Browsers listen for
+    devtools connections on a loopback port, so that other threads can share them (see `_browser_endpoints`).
+    """
+
+    def __init__(self) -> None:
+        self._playwright: playwright.sync_api.Playwright | None = None
+        self._browsers: dict[str, playwright.sync_api.Browser] = {}
+        self._endpoints: dict[str, str] = {}
+
+    def _get_playwright(self) -> playwright.sync_api.Playwright:
+        if self._playwright is None:
+            from playwright.sync_api import sync_playwright
+
+            self._playwright = sync_playwright().start()
+        return self._playwright
+
+    def _launch(self, browser_launch_kwargs: dict[str, Any]) -> playwright.sync_api.Browser:
+        key = browser_key(browser_launch_kwargs)
+        if endpoint := (_browser_endpoints.get() or {}).get(key):
+            print("splat|browser_connect")
+            return self._get_playwright().chromium.connect_over_cdp(endpoint)
+
+        launch_kwargs = {"headless": True, "args": CHROMIUM_ARGS, **browser_launch_kwargs}
+        port = free_port()
+        launch_kwargs["args"] = [*launch_kwargs["args"], f"--remote-debugging-port={port}"]
+        browser = self._get_playwright().chromium.launch(**launch_kwargs)
+        self._endpoints[key] = f"http://127.0.0.1:{port}"
+        return browser
+
+    def endpoint(self, browser_launch_kwargs: dict[str, Any]) -> str | None:
+        """Returns the devtools endpoint of the warm browser for browser_launch_kwargs, launching it if need be"""
+        self.get_browser(browser_launch_kwargs)
+        return self._endpoints.get(browser_key(browser_launch_kwargs))
+
+    def get_browser(self, browser_launch_kwargs: dict[str, Any]) -> playwright.sync_api.Browser:
+        from playwright.sync_api import Error as PlaywrightError
+
+        key = browser_key(browser_launch_kwargs)
+        browser = self._browsers.pop(key, None)
+        if browser is not None and browser.is_connected():
+            # Re-insert to keep the dict ordered from least to most recently used
+            self._browsers[key] = browser
+            return browser
+        if browser is not None:
+            print("splat|browser_disconnected|relaunching")
+
+        # Each chromium costs hundreds of MB, so only keep a handful of launch configurations warm
+        while len(self._browsers) >= MAX_WARM_BROWSERS:
+            self._close_browser(next(iter(self._browsers.values())))
+
+        print(f"splat|browser_launch|kwargs={key}")
+        with current_report().timed("launch"):
+            try:
+                browser = self._launch(browser_launch_kwargs)
+            except PlaywrightError:
+                # The playwright driver itself may have died along with the browser. Start again from scratch.
+                logger.warning("splat|browser_launch_failed|restarting_playwright", exc_info=True)
+                self.close()
+                browser = self._launch(browser_launch_kwargs)
+        self._browsers[key] = browser
+        return browser
+
+    @contextmanager
+    def new_context(
+        self, context: dict, browser_launch_kwargs: dict[str, Any]
+    ) -> Iterator[playwright.sync_api.BrowserContext]:
+        from playwright.sync_api import Error as PlaywrightError
+
+        browser = self.get_browser(browser_launch_kwargs)
+        try:
+            browser_context = browser.new_context(**context)
+        except PlaywrightError:
+            # The browser may have crashed between the connectivity check and now, retry once on a fresh browser.
+            logger.warning("splat|browser_new_context_failed|relaunching", exc_info=True)
+            self._close_browser(browser)
+            browser_context = self.get_browser(browser_launch_kwargs).new_context(**context)
+        try:
+            yield browser_context
+        finally:
+            try:
+                browser_context.close()
+            except PlaywrightError:
+                logger.warning("splat|browser_context_close_failed", exc_info=True)
+
+    def _close_browser(self, browser: playwright.sync_api.Browser) -> None:
+        from playwright.sync_api import Error as PlaywrightError
+
+        for key, cached in list(self._browsers.items()):
+            if cached is browser:
+                self._browsers.pop(key)
+                self._endpoints.pop(key, None)
+        try:
+            # Only disconnects from a browser shared by another thread
+            browser.close()
+        except PlaywrightError:
+            pass
+
+    def close(self) -> None:
+        for browser in list(self._browsers.values()):
+            self._close_browser(browser)
+        if self._playwright is not None:
+            try:
+                self._playwright.stop()
+            except Exception:  # noqa
+                pass
+            self._playwright = None
+
+
+class _ThreadBrowserManager(threading.local):
+    def __init__(self) -> None:
+        self.manager = BrowserManager()
+
+
+_browser_managers = _ThreadBrowserManager()
+
+
+def browser_manager() -> BrowserManager:
+    """The calling thread's browser manager, as playwright's sync api can only be used from the thread that started it.
+
+    The lambda keeps a single warm browser on its main thread. Batch workers connect to it rather than launching their
+    own, see handle_batch.
+    """
+    return _browser_managers.manager
+
+
+# Devtools endpoints of browsers launched by another thread, by browser_key, that this thread connects to rather than
+# launching browsers of its own
+_browser_endpoints: contextvars.ContextVar[Mapping[str, str] | None] = contextvars.ContextVar(
+    "browser_endpoints", default=None
+)
+
+
+def browser_key(browser_launch_kwargs: dict[str, Any]) -> str:
+    return json.dumps(browser_launch_kwargs, sort_keys=True, default=str)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+# Blocking websockets can't be done with page.route, so stop the page from opening them instead
+BLOCK_WEBSOCKETS_SCRIPT = """
+window.WebSocket = function () { throw new DOMException("WebSockets are blocked while rendering", "SecurityError"); };
+"""
+
+
+@dataclass
+class RequestPolicy:
+    """Which requests the browser may make while rendering"""
+
+    allowed_domains: list[str] | None = None
+    blocked_domains: list[str] = field(default_factory=list)
+    blocked_resource_types: set[str] = field(default_factory=set)
+    request_timeout: float | None = None  # seconds
+
+    @classmethod
+    def from_payload(cls, payload: Payload) -> RequestPolicy:
+        # sendBeacon requests are reported by chromium as pings
+        resource_types = {"ping" if t == "beacon" else t for t in payload.browser_blocked_resource_types}
+        return cls(
+            allowed_domains=payload.browser_allowed_domains,
+            blocked_domains=payload.browser_blocked_domains,
+            blocked_resource_types=resource_types,
+            request_timeout=payload.browser_request_timeout,
+        )
+
+    @property
+    def is_restrictive(self) -> bool:
+        return bool(
+            self.allowed_domains is not None
+            or self.blocked_domains
+            or self.blocked_resource_types
+            or self.request_timeout
+        )
+
+    @staticmethod
+    def _matches(host: str, domains: list[str]) -> bool:
+        return any(host == domain or host.endswith(f".{domain}") for domain in domains)
+
+    def allows(self, request: playwright.sync_api.Request) -> bool:
+        if request.resource_type in self.blocked_resource_types:
+            return False
+        # Domain rules never apply to the page being rendered, nor to file/data urls
+        if request.is_navigation_request() and request.frame.parent_frame is None:
+            return True
+        host = (urlparse(request.url).hostname or "").lower()
+        if not host:
+            return True
+        if self._matches(host, self.blocked_domains):
+            return False
+        return self.allowed_domains is None or self._matches(host, self.allowed_domains)
+
+
+class RequestInterceptor:
+    """Routes every request the page makes through the request policy and the asset cache, counting the outcomes"""
+
+    def __init__(self, policy: RequestPolicy, report: RenderReport) -> None:
+        self.policy = policy
+        # Route handlers run on playwright's dispatcher greenlet, which doesn't share our context variables
+        self.report = report
+
+    def __call__(self, route: playwright.sync_api.Route) -> None:
+        from playwright.sync_api import Error as PlaywrightError
+
+        request = route.request
+        if not self.policy.allows(request):
+            self.report.requests_blocked += 1
+            route.abort("blockedbyclient")
+            return
+        self.report.requests_allowed += 1
+
+        timeout = self.policy.request_timeout * 1000 if self.policy.request_timeout else None
+        try:
+            if asset_cache.handles(request):
+                asset_cache.route(route, timeout=timeout)
+            elif timeout and request.url.startswith(("http://", "https://")):
+                route.fulfill(response=route.fetch(timeout=timeout))
+            else:
+                route.continue_()
+        except PlaywrightError as e:
+            # Raised by route.fetch for timeouts and network errors; fail just this request, not the render
+            logger.warning(f"splat|request_failed|{request.url}|{e.message}")
+            self.report.requests_failed += 1
+            route.abort("timedout" if "Timeout" in e.message else "failed")
+
+
+class NetworkActivity:
+    """Tracks the requests a page has in flight, to wait for the network to go quiet"""
+
+    def __init__(self, page: playwright.sync_api.Page) -> None:
+        self.page = page
+        self.in_flight: set[playwright.sync_api.Request] = set()
+        self.last_activity = time.monotonic()
+        self.log: list[str] = []
+        page.on("request", self._started)
+        page.on("requestfinished", self._finished)
+        page.on("requestfailed", self._finished)
+        page.on("response", lambda response: self.log.append(f"<<< response {response.url} {response.status})"))
+
+    def _started(self, request: playwright.sync_api.Request) -> None:
+        self.log.append(f">>> request {request.url}")
+        self.in_flight.add(request)
+        self.last_activity = time.monotonic()
+
+    def _finished(self, request: playwright.sync_api.Request) -> None:
+        self.in_flight.discard(request)
+        self.last_activity = time.monotonic()
+
+    def wait_for_idle(self, quiet_ms: int, timeout: float) -> None:
+        from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+        deadline = time.monotonic() + timeout
+        while self.in_flight or time.monotonic() - self.last_activity < quiet_ms / 1000:
+            if time.monotonic() >= deadline:
+                raise PlaywrightTimeoutError(f"Network was not idle for {quiet_ms}ms within {timeout}s")
+            # Waiting on the page (rather than sleeping) lets playwright dispatch the request events
+            self.page.wait_for_timeout(min(50, quiet_ms or 50))
+
+
+def _wait_until_ready(page: playwright.sync_api.Page, network: NetworkActivity, wait_for: WaitFor) -> None:
+    """Runs the optional readiness phases. A phase that times out is logged and rendering proceeds anyway."""
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+    report = current_report()
+    phases: list[tuple[str, Callable[[], Any]]] = []
+    if wait_for.networkidle_quiet_ms is not None:
+        phases.append(
+            ("networkidle", lambda: network.wait_for_idle(wait_for.networkidle_quiet_ms, wait_for.networkidle_timeout))
+        )
+    if wait_for.selector:
+        phases.append(
+            (
+                "selector",
+                lambda: page.wait_for_selector(
+                    wait_for.selector, state="attached", timeout=wait_for.selector_timeout * 1000
+                ),
+            )
+        )
+    if wait_for.function:
+        phases.append(
+            ("function", lambda: page.wait_for_function(wait_for.function, timeout=wait_for.function_timeout * 1000))
+        )
+    if wait_for.delay:
+        phases.append(("delay", lambda: page.wait_for_timeout(wait_for.delay * 1000)))
+
+    for name, wait in phases:
+        started = time.monotonic()
+        try:
+            wait()
+        except PlaywrightTimeoutError:
+            logger.warning(f"splat|wait_for|{name}|timed_out, proceeding anyways")
+            name = f"{name}-timeout"
+            for log in network.log:
+                logger.warning(log)
+        report.wait_phases[name] = time.monotonic() - started
+
+
 @contextmanager
 def _playwright_visit_page(
     browser_url: str,
     headers: dict,
     context: dict,
     browser_launch_kwargs: dict[str, Any],
+    request_policy: RequestPolicy | None = None,
+    wait_for: WaitFor | None = None,
 ) -> Iterator[playwright.sync_api.Page]:
     print("splat|playwright_handler|url=", browser_url)
+    request_policy = request_policy or RequestPolicy()
+    wait_for = wait_for or WaitFor()
+
+    with browser_manager().new_context(context, browser_launch_kwargs) as browser_context:
+        browser_context.set_extra_http_headers(headers)
+        page = browser_context.new_page()
+        if "websocket" in request_policy.blocked_resource_types:
+            page.add_init_script(BLOCK_WEBSOCKETS_SCRIPT)
+        # Routing bypasses chromium's own http cache, so only intercept when there's something to gain
+        if asset_cache.enabled or request_policy.is_restrictive:
+            page.route("**/*", RequestInterceptor(request_policy, current_report()))
+        network = NetworkActivity(page)
+
+        with current_report().timed("navigation"):
+            page.goto(browser_url, wait_until=wait_for.load_state, timeout=wait_for.load_timeout * 1000)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
-            headless=True,
-            args=[
-                "--single-process",
-                "--disable-gpu",
-                "--no-sandbox",
-                "--no-zygote",
-                "--disable-dev-shm-usage",
-                "--autoplay-policy=user-gesture-required",
-                "--disable-background-networking",
-                "--disable-background-timer-throttling",
-                "--disable-backgrounding-occluded-windows",
-                "--disable-breakpad",
-                "--disable-client-side-phishing-detection",
-                "--disable-component-update",
-                "--disable-default-apps",
-                "--disable-domain-reliability",
-                "--disable-extensions",
-                "--disable-features=AudioServiceOutOfProcess",
-                "--disable-hang-monitor",
-                "--disable-ipc-flooding-protection",
-                "--disable-notifications",
-                "--disable-offer-store-unmasked-wallet-cards",
-                "--disable-popup-blocking",
-                "--disable-print-preview",
-                "--disable-prompt-on-repost",
-                "--disable-renderer-backgrounding",
-                "--disable-setuid-sandbox",
-                "--disable-speech-api",
-                "--disable-sync",
-                "--disk-cache-size=33554432",
-                "--hide-scrollbars",
-                "--ignore-gpu-blacklist",
-                "--metrics-recording-only",
-                "--mute-audio",
-                "--no-default-browser-check",
-                "--no-first-run",
-                "--no-pings",
-                "--password-store=basic",
-                "--use-gl=swiftshader",
-                "--use-mock-keychain",
-            ],
-            **browser_launch_kwargs,
-        )
-        context = browser.new_context(**context)
-        context.set_extra_http_headers(headers)
-        page = context.new_page()
-        page.goto(browser_url, timeout=1000 * 60 * 10)
-        network_log = []
-        page.on("request", lambda request: network_log.append(f">>> request {request.url}"))
-        page.on("response", lambda response: network_log.append(f"<<< response {response.url} {response.status})"))
         page.emulate_media(media="print")
-        page.wait_for_load_state("domcontentloaded")
-        try:
-            page.wait_for_load_state("load")
-        except (PlaywrightTimeoutError, InvalidStateError):
-            logger.warning("Timed out waiting for load, proceeding anyways")
-            for log in network_log:
-                logger.warning(log)
+        with current_report().timed("wait"):
+            _wait_until_ready(page, network, wait_for)
         yield page
 
 
 def playwright_page_to_pdf(
     browser_url: str,
     headers: dict,
-    output_filepath: str,
     pdf_options: Mapping[str, str],
     context: dict,
     browser_launch_kwargs: dict[str, Any],
-) -> None:
-    with _playwright_visit_page(browser_url, headers, context, browser_launch_kwargs) as page:
-        page.pdf(path=output_filepath, **pdf_options)
+    request_policy: RequestPolicy | None = None,
+    wait_for: WaitFor | None = None,
+    output_filepath: str | None = None,
+) -> bytes | str:
+    """Returns the pdf bytes, or output_filepath once the pdf has been written there when it's too large to keep in
+    memory for the rest of the invocation"""
+    with _playwright_visit_page(browser_url, headers, context, browser_launch_kwargs, request_policy, wait_for) as page:
+        # Playwright sends the whole pdf over its connection, so it's in memory at least until it's written out
+        pdf = page.pdf(**pdf_options)
+    if output_filepath is not None and len(pdf) > IN_MEMORY_RENDER_MAX_BYTES:
+        with open(output_filepath, "wb") as f:
+            f.write(pdf)
+        return output_filepath
+    return pdf
 
 
 def playwright_page_to_html_string(
@@ -189,131 +661,1363 @@ def playwright_page_to_html_string(
     headers: dict,
     context: dict,
     browser_launch_kwargs: dict[str, Any],
+    request_policy: RequestPolicy | None = None,
+    wait_for: WaitFor | None = None,
 ) -> str:
-    with _playwright_visit_page(browser_url, headers, context, browser_launch_kwargs) as page:
+    with _playwright_visit_page(browser_url, headers, context, browser_launch_kwargs, request_policy, wait_for) as page:
         return page.content()
 
 
-def pdf_from_document_content(payload: Payload, output_filepath: str) -> None:
-    """Generates pdf from string content of the document"""
-    print("splat|pdf_from_document_content")
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".html") as temporary_html_file:
-        assert payload.document_content
-        temporary_html_file.write(payload.document_content)
+@dataclass
+class RenderReport:
+    """Facts about the current render that are reported back to the caller in the response headers"""
+
+    cache: str | None = None
+    requests_allowed: int = 0
+    requests_blocked: int = 0
+    requests_failed: int = 0
+    wait_phases: dict[str, float] = field(default_factory=dict)  # seconds
+    pdf_pages: int | None = None
+    optimize_preset: str | None = None
+    optimize_sizes: tuple[int, int] | None = None  # bytes before and after
+    timings: dict[str, float] = field(default_factory=dict)  # seconds spent in each stage, excluding nested stages
+    _open_stages: list[list[float]] = field(default_factory=list, repr=False)
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        """Times a stage of the render. Time spent in stages nested inside it is only counted against those."""
+        started = time.monotonic()
+        nested = [0.0]
+        self._open_stages.append(nested)
+        try:
+            yield
+        finally:
+            self._open_stages.pop()
+            elapsed = time.monotonic() - started
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed - nested[0]
+            if self._open_stages:
+                self._open_stages[-1][0] += elapsed
+
+    def headers(self) -> dict[str, str]:
+        headers = {}
+        if self.timings:
+            headers["Server-Timing"] = ", ".join(
+                f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in [*self.timings.items(), ("total", self.total)]
+            )
+        if self.wait_phases:
+            headers["X-Splat-Wait"] = ", ".join(
+                f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.wait_phases.items()
+            )
+        if self.cache:
+            headers["X-Splat-Cache"] = self.cache
+        if self.optimize_sizes:
+            before, after = self.optimize_sizes
+            headers["X-Splat-Optimize"] = f"preset={self.optimize_preset}, before={before}, after={after}"
+        if self.requests_allowed or self.requests_blocked:
+            headers["X-Splat-Requests"] = (
+                f"allowed={self.requests_allowed}, blocked={self.requests_blocked}, failed={self.requests_failed}"
+            )
+        return headers
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings.values())
+
+
+_render_report: contextvars.ContextVar[RenderReport] = contextvars.ContextVar("render_report")
+
+
+def current_report() -> RenderReport:
+    """The report for the render in progress. Outside of a render, changes to the returned report are discarded."""
+    return _render_report.get(None) or RenderReport()
+
+
+class RenderCache:
+    """Content addressed cache of rendered PDFs.
+
+    The first tier is a size bounded LRU directory in /tmp that lives as long as the warm container. The second,
+    optional, tier is an s3 prefix shared by every container; expiry there is left to a lifecycle rule matching the
+    objects' tags.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        bucket_name: str | None = None,
+        prefix: str = "",
+        tagging: str = "",
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.tagging = tagging
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(payload: Payload, document: bytes | str) -> str:
+        """Hashes everything that influences the rendered output of an html document (bytes or a file path)"""
+        digest = hashlib.sha256()
+        options = {
+            "renderer": payload.renderer.value,
+            "javascript": payload.javascript,
+            "browser_pdf_options": dict(payload.browser_pdf_options),
+            "browser_context": payload.browser_context,
+            "browser_launch_kwargs": payload.browser_launch_kwargs,
+            # What the browser fetches, and when it considers the page ready
+            "browser_headers": payload.browser_headers,
+            "browser_allowed_domains": payload.browser_allowed_domains,
+            "browser_blocked_domains": payload.browser_blocked_domains,
+            "browser_blocked_resource_types": payload.browser_blocked_resource_types,
+            "browser_request_timeout": payload.browser_request_timeout,
+            "wait_for": payload.wait_for.model_dump(),
+        }
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+        with open_binary(document) as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _local_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key: str) -> tuple[str, bytes] | None:
+        """Returns the tier a cached pdf was found in along with its contents"""
+        local_path = self._local_path(key)
+        try:
+            with open(local_path, "rb") as f:
+                pdf = f.read()
+            # Bump the mtime so eviction drops the least recently used entries first
+            os.utime(local_path)
+            return "hit-local", pdf
+        except FileNotFoundError:
+            pass
+
+        if not self.bucket_name:
+            return None
+        from botocore.exceptions import ClientError
+
+        try:
+            obj = s3_client().get_object(Bucket=self.bucket_name, Key=f"{self.prefix}{key}.pdf")
+            pdf = obj["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in {"404", "NoSuchKey"}:
+                logger.warning("splat|render_cache|s3_get_failed", exc_info=True)
+            return None
+        self._store_local(key, pdf)
+        return "hit-s3", pdf
+
+    def put(self, key: str, pdf: bytes | str) -> None:
+        self._store_local(key, pdf)
+        if self.bucket_name:
+            try:
+                with open_binary(pdf) as f:
+                    s3_client().upload_fileobj(
+                        f,
+                        self.bucket_name,
+                        f"{self.prefix}{key}.pdf",
+                        ExtraArgs={"Tagging": self.tagging, "ContentType": "application/pdf"},
+                    )
+            except Exception:  # noqa
+                logger.warning("splat|render_cache|s3_put_failed", exc_info=True)
+
+    def _store_local(self, key: str, pdf: bytes | str) -> None:
+        if binary_size(pdf) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        local_path = self._local_path(key)
+        # Write then rename so a concurrent reader never sees a partially written pdf
+        staging_path = f"{local_path}.{uuid.uuid4()}.tmp"
+        with open_binary(pdf) as src, open(staging_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(staging_path, local_path)
+        with self._lock:
+            evict_least_recently_used(self.directory, self.max_bytes, ".pdf")
+
+
+def evict_least_recently_used(
+    directory: str, max_bytes: int, suffix: str, sidecar_suffixes: tuple[str, ...] = ()
+) -> None:
+    """Removes the least recently used (by mtime) files ending in suffix until the rest fit in max_bytes.
+
+    Files sharing an evicted file's name but ending in one of sidecar_suffixes are removed alongside it.
+    """
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith(suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for evicted in (path, *(path.removesuffix(suffix) + sidecar for sidecar in sidecar_suffixes)):
+            with suppress(FileNotFoundError):
+                os.remove(evicted)
+        total -= size
+
+
+render_cache = RenderCache(
+    directory=RENDER_CACHE_DIR,
+    max_bytes=RENDER_CACHE_MAX_BYTES,
+    bucket_name=os.environ.get("SPLAT_RENDER_CACHE_BUCKET") or None,
+    prefix=os.environ.get("SPLAT_RENDER_CACHE_PREFIX", "render-cache/"),
+    tagging=os.environ.get("SPLAT_RENDER_CACHE_TAGGING", "ExpireAfter=1w"),
+)
+
+
+@dataclass
+class CachedAsset:
+    url: str
+    path: str
+    status: int
+    headers: dict[str, str]
+    expires: float
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def validators(self) -> dict[str, str]:
+        """Headers to revalidate a stale asset with a conditional request"""
+        validators = {}
+        if etag := self.headers.get("etag"):
+            validators["If-None-Match"] = etag
+        if last_modified := self.headers.get("last-modified"):
+            validators["If-Modified-Since"] = last_modified
+        return validators
+
+
+def asset_cache_url(url: str) -> str:
+    """The url an asset is cached under.
+
+    Content addressed assets, named by the sha256 of their content like those the uptick_splat client shares between
+    documents, are cached without their presigning parameters. Each presigned url to one is then served from the same
+    entry, and as its content can't change, there's nothing a fresh signature would fetch that the cache doesn't hold.
+    """
+    parsed = urlparse(url)
+    if not CONTENT_ADDRESSED_RE.search(parsed.path):
+        return url
+    query = [(name, value) for name, value in parse_qsl(parsed.query) if not name.lower().startswith("x-amz-")]
+    return parsed._replace(query=urlencode(query)).geturl()
+
+
+class AssetCache:
+    """Size bounded LRU store of stylesheets, fonts and images fetched while rendering.
+
+    Assets are kept for as long as their http caching headers allow, and are shared by every render on a warm
+    container. Each asset is stored as a `.body` file alongside a `.json` file holding its url, status and headers.
+    """
+
+    # Headers describing the transfer rather than the asset. Stored bodies are already decoded.
+    UNSTORED_HEADERS = {
+        "connection",
+        "content-encoding",
+        "content-length",
+        "keep-alive",
+        "set-cookie",
+        "transfer-encoding",
+    }
+
+    def __init__(self, directory: str, max_bytes: int, default_ttl: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _base_path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(asset_cache_url(url).encode("utf-8")).hexdigest())
+
+    def freshness_lifetime(self, status: int, headers: Mapping[str, str], credentialed: bool = False) -> float | None:
+        """Seconds a response may be reused for, or None if it must not be cached.
+
+        The cache is shared by every render, so like any shared cache (RFC 9111 3.5) it only stores responses to
+        requests carrying credentials when they're explicitly public. Entries are keyed on the url alone, so responses
+        that vary by request headers aren't stored either (bodies are stored decoded, so Accept-Encoding is fine).
+        """
+        headers = {name.lower(): value for name, value in headers.items()}
+        if status != 200 or "set-cookie" in headers:
+            return None
+        vary = {name.strip().lower() for name in headers.get("vary", "").split(",") if name.strip()}
+        if vary - {"accept-encoding"}:
+            return None
+        directives = {}
+        for directive in headers.get("cache-control", "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name] = value.strip('"')
+        if {"no-store", "no-cache", "private"} & directives.keys():
+            return None
+        if credentialed and not {"public", "s-maxage", "must-revalidate"} & directives.keys():
+            return None
+        for name in ("s-maxage", "max-age"):
+            if directives.get(name, "").isdigit():
+                return float(directives[name])
+        with suppress(TypeError, ValueError):
+            date = email.utils.parsedate_to_datetime(headers["date"]) if "date" in headers else None
+            if "expires" in headers:
+                expires = email.utils.parsedate_to_datetime(headers["expires"])
+                # Not datetime.UTC, which the lambda image's python 3.10 doesn't have
+                now = datetime.datetime.now(datetime.timezone.utc)  # noqa: UP017
+                return max((expires - (date or now)).total_seconds(), 0)
+            if "last-modified" in headers and date:
+                # Heuristic freshness, see RFC 9111 4.2.2
+                last_modified = email.utils.parsedate_to_datetime(headers["last-modified"])
+                return min((date - last_modified).total_seconds() / 10, self.default_ttl)
+        return self.default_ttl
+
+    def get(self, url: str) -> CachedAsset | None:
+        """Returns the cached asset for url, fresh or stale"""
+        base_path = self._base_path(url)
+        try:
+            with open(f"{base_path}.json") as f:
+                meta = json.load(f)
+            # Bump the mtime so eviction drops the least recently used entries first
+            os.utime(f"{base_path}.body")
+        except (FileNotFoundError, ValueError):
+            return None
+        return CachedAsset(path=f"{base_path}.body", **meta)
+
+    def put(
+        self, url: str, status: int, headers: Mapping[str, str], body: bytes, credentialed: bool = False
+    ) -> CachedAsset | None:
+        lifetime = self.freshness_lifetime(status, headers, credentialed)
+        if lifetime is None or not lifetime or len(body) > self.max_bytes:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        base_path = self._base_path(url)
+        stored_headers = {
+            name.lower(): value for name, value in headers.items() if name.lower() not in self.UNSTORED_HEADERS
+        }
+        meta = {"url": url, "status": status, "headers": stored_headers, "expires": time.time() + lifetime}
+        # Write then rename so a concurrent reader never sees a partially written asset
+        staging_path = f"{base_path}.{uuid.uuid4()}.tmp"
+        with open(staging_path, "wb") as f:
+            f.write(body)
+        os.replace(staging_path, f"{base_path}.body")
+        with open(staging_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(staging_path, f"{base_path}.json")
+        with self._lock:
+            evict_least_recently_used(self.directory, self.max_bytes, ".body", sidecar_suffixes=(".json",))
+        return CachedAsset(path=f"{base_path}.body", **meta)
+
+    def refresh(self, asset: CachedAsset, headers: Mapping[str, str]) -> CachedAsset:
+        """Extends a stale asset's lifetime after the origin confirmed it is unchanged (304)"""
+        merged = {**asset.headers, **{name.lower(): value for name, value in headers.items()}}
+        lifetime = self.freshness_lifetime(200, merged) or 0
+        asset.expires = time.time() + lifetime
+        with open(f"{self._base_path(asset.url)}.json", "w") as f:
+            json.dump({"url": asset.url, "status": asset.status, "headers": asset.headers, "expires": asset.expires}, f)
+        return asset
+
+    def fetch(self, url: str) -> CachedAsset | None:
+        """Returns a fresh copy of the asset at url, downloading or revalidating it if needed"""
+        asset = self.get(url)
+        if asset and asset.is_fresh():
+            return asset
+        import requests
+
+        headers = asset.validators() if asset else {}
+        try:
+            with http_session().get(url, headers=headers, timeout=ASSET_FETCH_TIMEOUT, stream=True) as response:
+                if response.status_code == 304 and asset:
+                    return self.refresh(asset, response.headers)
+                body = bytearray()
+                for chunk in response.iter_content(DOCUMENT_CHUNK_SIZE):
+                    body += chunk
+                    if len(body) > self.max_bytes:
+                        return None
+                return self.put(url, response.status_code, response.headers, bytes(body))
+        except requests.RequestException:
+            logger.warning(f"splat|asset_cache|fetch_failed|{url}", exc_info=True)
+            return None
+
+    def handles(self, request: playwright.sync_api.Request) -> bool:
+        return (
+            self.enabled
+            and request.method == "GET"
+            and request.resource_type in {"stylesheet", "font", "image"}
+            and request.url.startswith(("http://", "https://"))
+        )
+
+    def route(self, route: playwright.sync_api.Route, timeout: float | None = None) -> None:
+        """Playwright route handler serving stylesheets, fonts and images through the cache"""
+        request = route.request
+        asset = self.get(request.url)
+        if asset and asset.is_fresh():
+            with open(asset.path, "rb") as f:
+                route.fulfill(status=asset.status, headers=asset.headers, body=f.read())
+            return
+
+        response = route.fetch(headers={**request.headers, **(asset.validators() if asset else {})}, timeout=timeout)
+        if response.status == 304 and asset:
+            asset = self.refresh(asset, response.headers)
+            with open(asset.path, "rb") as f:
+                route.fulfill(status=asset.status, headers=asset.headers, body=f.read())
+            return
+        body = response.body()
+        # Cookies are only in all_headers()
+        credentialed = bool({"authorization", "cookie"} & {name.lower() for name in request.all_headers()})
+        self.put(request.url, response.status, response.headers, body, credentialed)
+        route.fulfill(response=response, body=body)
+
+
+asset_cache = AssetCache(
+    directory=ASSET_CACHE_DIR,
+    max_bytes=ASSET_CACHE_MAX_BYTES,
+    default_ttl=ASSET_CACHE_DEFAULT_TTL,
+)
+
+# Absolute asset urls prince would otherwise fetch itself: stylesheet links, images and css url()s
+LINK_TAG_RE = re.compile(rb"<link\b[^>]*>", re.IGNORECASE)
+STYLESHEET_REL_RE = re.compile(rb"""\brel=["']?[^"'>]*\bstylesheet\b""", re.IGNORECASE)
+HREF_RE = re.compile(rb"""(\bhref=)(["'])([^"']+)\2()""", re.IGNORECASE)
+IMAGE_SRC_RE = re.compile(rb"""(<img\b[^>]*?\bsrc=)(["'])(https?://[^"']+)\2()""", re.IGNORECASE)
+CSS_URL_RE = re.compile(rb"""(url\(\s*)(["']?)([^"')]+)\2(\s*\))""", re.IGNORECASE)
+# The string form of @import, without url()
+CSS_IMPORT_RE = re.compile(rb"""(@import\s+)(["'])([^"']+)\2()""", re.IGNORECASE)
+
+
+class AssetLocaliser:
+    """Rewrites the absolute asset urls in an html document to local copies served from the asset cache.
+
+    Assets are hard linked into directory so that eviction during the render can't pull them out from under prince.
+    Assets that can't be cached are left for prince to fetch itself.
+    """
+
+    MAX_STYLESHEET_DEPTH = 2
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.localised: dict[str, str | None] = {}
+
+    def localise_document(self, document: bytes) -> bytes:
+        document = LINK_TAG_RE.sub(self._replace_link, document)
+        document = self.rewrite(IMAGE_SRC_RE, document)
+        document = self.rewrite(CSS_URL_RE, document)
+        document = self.rewrite(CSS_IMPORT_RE, document)
+        print(f"splat|asset_cache|localised={sum(1 for url in self.localised.values() if url)}/{len(self.localised)}")
+        return document
+
+    def _replace_link(self, match: re.Match) -> bytes:
+        tag = match.group(0)
+        if not STYLESHEET_REL_RE.search(tag):
+            return tag
+        return self.rewrite(HREF_RE, tag)
+
+    def rewrite(
+        self,
+        pattern: re.Pattern,
+        content: bytes,
+        base_url: str | None = None,
+        depth: int = 0,
+        localise: bool = True,
+    ) -> bytes:
+        """Replaces the url in group 3 of each match, keeping the quotes in group 2 and the text around it.
+
+        Content with a base_url is served from a local copy, so urls in it that aren't localised are made absolute
+        rather than left to resolve against the copy's path.
+        """
+
+        def replace(match: re.Match) -> bytes:
+            original = match.group(3).decode("utf-8", errors="replace").strip()
+            url = urljoin(base_url, original) if base_url and not original.startswith("#") else original
+            local_url = self.localise(url, depth) if localise and url.startswith(("http://", "https://")) else None
+            if local_url is None and url == original:
+                return match.group(0)
+            replacement = (local_url or url).encode("utf-8")
+            return match.group(1) + match.group(2) + replacement + match.group(2) + match.group(4)
+
+        return pattern.sub(replace, content)
+
+    def rewrite_stylesheet(self, stylesheet: bytes, url: str, depth: int) -> bytes:
+        # Nested stylesheets past MAX_STYLESHEET_DEPTH are left for prince to fetch
+        localise = depth < self.MAX_STYLESHEET_DEPTH
+        stylesheet = self.rewrite(CSS_URL_RE, stylesheet, base_url=url, depth=depth, localise=localise)
+        return self.rewrite(CSS_IMPORT_RE, stylesheet, base_url=url, depth=depth, localise=localise)
+
+    def localise(self, url: str, depth: int) -> str | None:
+        if url in self.localised:
+            return self.localised[url]
+        self.localised[url] = None
+        asset = asset_cache.fetch(url)
+        if asset is None:
+            return None
+
+        suffix = mimetypes.guess_extension(asset.content_type) or ""
+        local_path = os.path.join(self.directory, f"{os.path.basename(asset.path).removesuffix('.body')}{suffix}")
+        try:
+            if asset.content_type == "text/css":
+                # Fonts and images referenced by a stylesheet resolve relative to the stylesheet's own url
+                with open(asset.path, "rb") as f:
+                    stylesheet = self.rewrite_stylesheet(f.read(), url, depth + 1)
+                with open(local_path, "wb") as f:
+                    f.write(stylesheet)
+            elif not os.path.exists(local_path):
+                os.link(asset.path, local_path)
+        except FileNotFoundError:
+            # Evicted between the fetch and now
+            return None
+        self.localised[url] = f"file://{local_path}"
+        return self.localised[url]
+
+
+class Workspace:
+    """Gives each invocation a scratch directory for its temporary files, removed as soon as the invocation ends.
+
+    The caches in /tmp outlive invocations, but are evicted (least recently used first) whenever /tmp grows past
+    max_bytes. Chromium's profile and prince's workers live outside the workspace, as they outlive invocations too.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int | None,
+        caches: tuple[tuple[str, str, tuple[str, ...]], ...],
+    ) -> None:
+        self.directory = directory
+        self._max_bytes = max_bytes
+        # (directory, suffix, sidecar_suffixes) of each cache, in the order they're evicted
+        self.caches = caches
+        self._active: set[str] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self) -> int:
+        if self._max_bytes is None:
+            self._max_bytes = int(shutil.disk_usage(TMP_DIR).total * 0.8)
+        return self._max_bytes
+
+    @contextmanager
+    def invocation(self) -> Iterator[str]:
+        path = os.path.join(self.directory, uuid.uuid4().hex)
+        # Registered before it exists, so a concurrent invocation's clean up never sees it as finished
+        with self._lock:
+            self._active.add(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            with self._lock:
+                self._active.discard(path)
+            raise
+        token = _workspace.set(path)
+        try:
+            yield path
+        finally:
+            _workspace.reset(token)
+            with self._lock:
+                self._active.discard(path)
+            try:
+                self.clean()
+            except Exception as e:
+                logger.error(f"splat|cleanup_error|{str(e)}|stacktrace:", exc_info=True)
+
+    def clean(self) -> None:
+        """Removes the workspaces of finished invocations, including any a timed out invocation left behind, then
+        evicts caches until /tmp fits in max_bytes"""
+        with self._lock:
+            finished = [entry.path for entry in os.scandir(self.directory) if entry.path not in self._active]
+        for path in finished:
+            shutil.rmtree(path, ignore_errors=True)
+
+        excess = shutil.disk_usage(TMP_DIR).used - self.max_bytes
+        for directory, suffix, sidecar_suffixes in self.caches:
+            if excess <= 0:
+                break
+            if not os.path.isdir(directory):
+                continue
+            size = directory_size(directory)
+            print(f"splat|tmp_over_limit|evicting|{directory}|excess={excess}")
+            evict_least_recently_used(directory, max(size - excess, 0), suffix, sidecar_suffixes)
+            excess -= size - directory_size(directory)
+
+
+def directory_size(directory: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+_workspace: contextvars.ContextVar[str] = contextvars.ContextVar("workspace")
+
+
+def scratch_dir() -> str | None:
+    """The current invocation's workspace, to create temporary files in. None (the default tempdir) outside one."""
+    return _workspace.get(None)
+
+
+workspace = Workspace(
+    directory=WORKSPACE_DIR,
+    max_bytes=TMP_MAX_BYTES,
+    caches=(
+        (RENDER_CACHE_DIR, ".pdf", ()),
+        (ASSET_CACHE_DIR, ".body", (".json",)),
+    ),
+)
+
+
+@contextmanager
+def open_binary(data: bytes | str) -> Iterator[BinaryIO]:
+    """Opens in memory bytes or the file at a path as a binary file object"""
+    if isinstance(data, bytes):
+        yield io.BytesIO(data)
+    else:
+        with open(data, "rb") as f:
+            yield f
+
+
+def binary_size(data: bytes | str) -> int:
+    """Size of in memory bytes or of the file at a path"""
+    return len(data) if isinstance(data, bytes) else os.path.getsize(data)
+
+
+@contextmanager
+def html_file(document: bytes | str) -> Iterator[str]:
+    """Yields the path of a file holding the html document, writing it to disk if it is held in memory"""
+    if isinstance(document, str):
+        yield document
+        return
+    with tempfile.NamedTemporaryFile(suffix=".html", dir=scratch_dir()) as temporary_html_file:
+        temporary_html_file.write(document)
         temporary_html_file.flush()
-        if payload.renderer == Renderers.princexml:
-            prince_handler(temporary_html_file.name, output_filepath, payload.javascript)
-        else:
-            playwright_page_to_pdf(
-                f"file://{temporary_html_file.name}",
+        yield temporary_html_file.name
+
+
+def render_html(payload: Payload, document: bytes | str, output_filepath: str) -> bytes | str:
+    """Renders an html document held in memory or at a file path, serving identical renders from the render cache.
+
+    Returns the pdf bytes, or output_filepath if the pdf was too large to render in memory.
+    """
+    cache_key = RenderCache.key(payload, document) if payload.cache else None
+    if cache_key and (cached := render_cache.get(cache_key)):
+        tier, pdf = cached
+        print(f"splat|render_cache|{tier}|{cache_key}")
+        current_report().cache = tier
+        return pdf
+
+    if payload.renderer == Renderers.princexml:
+        with tempfile.TemporaryDirectory(dir=scratch_dir()) as asset_directory:
+            if asset_cache.enabled and isinstance(document, bytes):
+                document = AssetLocaliser(asset_directory).localise_document(document)
+            rendered = prince_handler(document, output_filepath, payload.javascript)
+    else:
+        with html_file(document) as html_filepath:
+            rendered = playwright_page_to_pdf(
+                f"file://{html_filepath}",
                 payload.browser_headers,
-                output_filepath,
                 payload.browser_pdf_options,
                 payload.browser_context,
                 payload.browser_launch_kwargs,
+                RequestPolicy.from_payload(payload),
+                payload.wait_for,
+                output_filepath,
             )
 
+    if cache_key:
+        print(f"splat|render_cache|miss|{cache_key}")
+        current_report().cache = "miss"
+        # A render missing assets the browser failed to fetch would be served until it's evicted
+        if not current_report().requests_failed:
+            render_cache.put(cache_key, rendered)
+    return rendered
 
-def pdf_from_document_url(payload: Payload, output_filepath: str) -> None:
-    """Generates pdf from a remote html document"""
-    print("splat|pdf_from_document_url")
-    response = requests.get(payload.document_url, timeout=120)
-    if response.status_code != 200:
+
+def pdf_from_document_content(payload: Payload, output_filepath: str) -> bytes | str:
+    """Generates pdf from string content of the document"""
+    print("splat|pdf_from_document_content")
+    assert payload.document_content
+    if payload.document_content_encoding == "gzip+base64":
+        return render_html(payload, decompress_document_content(payload.document_content), output_filepath)
+    return render_html(payload, payload.document_content.encode("utf-8"), output_filepath)
+
+
+def decompress_document_content(document_content: str) -> bytes:
+    """Decodes gzip+base64 encoded document content, up to DOCUMENT_MAX_BYTES"""
+    try:
+        compressed = base64.b64decode(document_content, validate=True)
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        document = decompressor.decompress(compressed, DOCUMENT_MAX_BYTES)
+    except (binascii.Error, zlib.error) as e:
+        raise SplatPDFGenerationFailure(f"Invalid gzip+base64 document_content: {e}", status_code=400) from e
+    if decompressor.unconsumed_tail:
         raise SplatPDFGenerationFailure(
-            f"Document was unable to be fetched from document_url provided. Server response: {response.content}",
-            status_code=500,
+            f"Document content is larger than the {DOCUMENT_MAX_BYTES} byte limit.", status_code=400
         )
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".html") as temporary_html_file:
-        temporary_html_file.write(response.content.decode("utf-8"))
-        temporary_html_file.flush()
-        if payload.renderer == Renderers.princexml:
-            prince_handler(temporary_html_file.name, output_filepath, payload.javascript)
-        else:
-            playwright_page_to_pdf(
-                f"file://{temporary_html_file.name}",
-                payload.browser_headers,
-                output_filepath,
-                payload.browser_pdf_options,
-                payload.browser_context,
-                payload.browser_launch_kwargs,
+    if not decompressor.eof:
+        raise SplatPDFGenerationFailure("Invalid gzip+base64 document_content: truncated", status_code=400)
+    return document
+
+
+def _accept_encoding() -> str:
+    # urllib3 only decodes brotli when a brotli package is installed
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return "gzip, deflate"
+    return "gzip, deflate, br"
+
+
+_http_session: requests.Session | None = None
+_http_session_lock = threading.Lock()
+
+
+def http_session() -> requests.Session:
+    """A session kept for the lifetime of the container so warm invocations reuse pooled keep-alive connections"""
+    global _http_session
+    if _http_session is not None:
+        return _http_session
+    import requests
+    import requests.adapters
+
+    # Asset fetches from batch items may race to create the first session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(BATCH_MAX_WORKERS, 10))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = _accept_encoding()
+            _http_session = session
+        return _http_session
+
+
+@contextmanager
+def fetch_document(url: str) -> Iterator[bytes | str]:
+    """Streams a remote document, yielding its bytes or, once it outgrows memory, the path of the file holding it"""
+    print(f"splat|fetch_document|url={urlparse(url).netloc}")
+    with http_session().get(url, timeout=120, stream=True) as response:
+        if response.status_code != 200:
+            snippet = next(response.iter_content(1024), b"")
+            raise SplatPDFGenerationFailure(
+                f"Document was unable to be fetched from document_url provided. Server response: {snippet}",
+                status_code=500,
+            )
+        content_length = int(response.headers.get("Content-Length") or 0)
+        if content_length > DOCUMENT_MAX_BYTES:
+            raise SplatPDFGenerationFailure(
+                f"Document at document_url is larger than the {DOCUMENT_MAX_BYTES} byte limit.", status_code=400
             )
 
+        with tempfile.NamedTemporaryFile(suffix=".html", dir=scratch_dir()) as temporary_html_file:
+            buffer: bytearray | None = bytearray()
+            size = 0
+            # iter_content transparently decodes gzip/deflate/br, so the limit applies to the decoded document
+            for chunk in response.iter_content(DOCUMENT_CHUNK_SIZE):
+                size += len(chunk)
+                if size > DOCUMENT_MAX_BYTES:
+                    raise SplatPDFGenerationFailure(
+                        f"Document at document_url is larger than the {DOCUMENT_MAX_BYTES} byte limit.",
+                        status_code=400,
+                    )
+                if buffer is not None and size <= IN_MEMORY_RENDER_MAX_BYTES:
+                    buffer += chunk
+                    continue
+                if buffer is not None:
+                    # Too big to hold in memory, spill what we have to disk and stream the rest after it
+                    temporary_html_file.write(buffer)
+                    buffer = None
+                temporary_html_file.write(chunk)
+            print(f"splat|fetch_document|bytes={size}|encoding={response.headers.get('Content-Encoding', 'identity')}")
+
+            if buffer is not None:
+                yield bytes(buffer)
+            else:
+                temporary_html_file.flush()
+                yield temporary_html_file.name
+
 
-def pdf_from_browser_url(payload: Payload, output_filepath: str) -> None:
+def pdf_from_document_url(payload: Payload, output_filepath: str) -> bytes | str:
+    """Generates pdf from a remote html document"""
+    print("splat|pdf_from_document_url")
+    assert payload.document_url
+    with ExitStack() as stack:
+        with current_report().timed("fetch"):
+            document = stack.enter_context(fetch_document(payload.document_url))
+        return render_html(payload, document, output_filepath)
+
+
+def pdf_from_browser_url(payload: Payload, output_filepath: str) -> bytes | str:
     """Generates pdf by visiting a browser url"""
     print("splat|pdf_from_browser_url")
     # First we need to visit the browser with playwright and save the html
     assert payload.browser_url
     if payload.renderer == Renderers.princexml:
         html = playwright_page_to_html_string(
-            payload.browser_url, payload.browser_headers, payload.browser_context, payload.browser_launch_kwargs
+            payload.browser_url,
+            payload.browser_headers,
+            payload.browser_context,
+            payload.browser_launch_kwargs,
+            RequestPolicy.from_payload(payload),
+            payload.wait_for,
         )
-        pdf_from_document_content(
+        return pdf_from_document_content(
             Payload(document_content=html, renderer=Renderers.princexml),
             output_filepath,
         )
     else:
-        playwright_page_to_pdf(
+        return playwright_page_to_pdf(
             payload.browser_url,
             payload.browser_headers,
-            output_filepath,
             payload.browser_pdf_options,
             payload.browser_context,
             payload.browser_launch_kwargs,
+            RequestPolicy.from_payload(payload),
+            payload.wait_for,
+            output_filepath,
         )
 
 
+def read_bounded(stream: BinaryIO, output_filepath: str) -> bytes | str:
+    """Reads a stream into memory, or to output_filepath, which is returned instead, once it outgrows
+    IN_MEMORY_RENDER_MAX_BYTES"""
+    buffer = bytearray()
+    while chunk := stream.read(DOCUMENT_CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > IN_MEMORY_RENDER_MAX_BYTES:
+            with open(output_filepath, "wb") as f:
+                f.write(buffer)
+                del buffer
+                shutil.copyfileobj(stream, f)
+            return output_filepath
+    return bytes(buffer)
+
+
 def execute(cmd: list[str]) -> None:
     result = subprocess.run(cmd)  # noqa
     if result.returncode != 0:
         raise subprocess.CalledProcessError(result.returncode, cmd)
 
 
-def prince_handler(input_filepath: str, output_filepath: str, javascript: bool = False) -> None:
+class PrinceWorkerError(Exception):
+    """The prince control process misbehaved; the document may render fine with a one-off prince process"""
+
+
+class PrinceWorker:
+    """A long lived prince process driven over prince's control protocol (`prince --control`).
+
+    Keeping the process alive between documents means the engine, licence and fonts are only loaded once per
+    container rather than once per render. Messages are exchanged as chunks of `<tag> <length>\\n<data>\\n`.
+    """
+
+    def __init__(self, command: list[str] | None = None) -> None:
+        self.command = command or ["./prince", "--control"]
+        self.process: subprocess.Popen | None = None
+        self.version: str | None = None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        print(f"splat|prince_worker_start {' '.join(self.command)}")
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)  # noqa
+        tag, data = self._read_chunk(time.monotonic() + PRINCE_WORKER_START_TIMEOUT)
+        if tag != b"ver":
+            self.stop()
+            raise PrinceWorkerError(f"Unexpected chunk from prince on start up: {tag!r}")
+        self.version = data.decode("utf-8", errors="replace")
+        print(f"splat|prince_worker_ready|version={self.version}")
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self._write_chunk(b"end", b"")
+                self.process.wait(timeout=5)
+        except Exception:  # noqa
+            self.process.kill()
+        self.process = None
+
+    def convert(
+        self, document: bytes | str, javascript: bool = False, output_filepath: str | None = None
+    ) -> bytes | str:
+        """Renders html held in memory or at a file path, returning the pdf bytes, or output_filepath once the pdf
+        has been written there when it's larger than IN_MEMORY_RENDER_MAX_BYTES"""
+        if not self.is_alive():
+            self.start()
+        if isinstance(document, bytes):
+            # In memory documents are sent along with the job as a job resource
+            job = {"input": {"src": "job-resource:0", "javascript": javascript}, "job-resource-count": 1}
+            self._write_chunk(b"job", json.dumps(job).encode("utf-8"))
+            self._write_chunk(b"dat", document)
+        else:
+            job = {"input": {"src": document, "javascript": javascript}, "job-resource-count": 0}
+            self._write_chunk(b"job", json.dumps(job).encode("utf-8"))
+
+        deadline = time.monotonic() + PRINCE_JOB_TIMEOUT
+        tag, size = self._read_header(deadline)
+        pdf: bytes | str | None = None
+        if tag == b"pdf":
+            if output_filepath is not None and size > IN_MEMORY_RENDER_MAX_BYTES:
+                with open(output_filepath, "wb") as f:
+                    self._read_exact(size, deadline, f)
+                pdf = output_filepath
+            else:
+                pdf = self._read_exact(size, deadline)
+            self._read_terminator(deadline)
+            tag, data = self._read_chunk(deadline)
+        else:
+            data = self._read_exact(size, deadline)
+            self._read_terminator(deadline)
+        if tag == b"err":
+            raise PrinceWorkerError(f"Prince control error: {data.decode('utf-8', errors='replace')}")
+        if tag != b"log":
+            raise PrinceWorkerError(f"Unexpected chunk from prince: {tag!r}")
+
+        log = data.decode("utf-8", errors="replace")
+        for line in log.splitlines():
+            print(f"splat|prince|{line}")
+        if pdf is None or "fin|success" not in log:
+            errors = [line for line in log.splitlines() if line.startswith("msg|err|")]
+            raise SplatPDFGenerationFailure(f"Prince failed to render the document: {errors}", status_code=500)
+        return pdf
+
+    def _write_chunk(self, tag: bytes, data: bytes) -> None:
+        assert self.process and self.process.stdin
+        try:
+            self.process.stdin.write(tag + b" " + str(len(data)).encode("ascii") + b"\n" + data + b"\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise PrinceWorkerError("Prince control process is not accepting input") from e
+
+    def _read_exact(self, size: int, deadline: float, sink: BinaryIO | None = None) -> bytes:
+        """Reads size bytes, or writes them to sink, returning nothing, when given one"""
+        assert self.process and self.process.stdout
+        fd = self.process.stdout.fileno()
+        buffer = bytearray()
+        read = 0
+        while read < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PrinceWorkerError("Timed out waiting for prince control process")
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            data = os.read(fd, min(size - read, 1024 * 1024))
+            if not data:
+                raise PrinceWorkerError("Prince control process exited unexpectedly")
+            read += len(data)
+            if sink is not None:
+                sink.write(data)
+            else:
+                buffer += data
+        return bytes(buffer)
+
+    def _read_header(self, deadline: float) -> tuple[bytes, int]:
+        """Reads a chunk's tag and the length of its data"""
+        header = self._read_exact(4, deadline)
+        tag, separator = header[:3], header[3:]
+        if separator != b" ":
+            raise PrinceWorkerError(f"Malformed chunk header from prince: {header!r}")
+        length = b""
+        while (digit := self._read_exact(1, deadline)) != b"\n":
+            length += digit
+            if len(length) > 12:
+                raise PrinceWorkerError("Malformed chunk length from prince")
+        return tag, int(length)
+
+    def _read_terminator(self, deadline: float) -> None:
+        if self._read_exact(1, deadline) != b"\n":
+            raise PrinceWorkerError("Malformed chunk terminator from prince")
+
+    def _read_chunk(self, deadline: float) -> tuple[bytes, bytes]:
+        tag, size = self._read_header(deadline)
+        data = self._read_exact(size, deadline)
+        self._read_terminator(deadline)
+        return tag, data
+
+
+class PrinceWorkerPool:
+    """Hands out idle prince workers, starting new ones on demand up to `size`"""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._idle: list[PrinceWorker] = []
+        self._started = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def worker(self) -> Iterator[PrinceWorker | None]:
+        """Yields an idle worker, or None when every worker is busy"""
+        with self._lock:
+            if self._idle:
+                worker: PrinceWorker | None = self._idle.pop()
+            elif self._started < self.size:
+                worker = PrinceWorker()
+                self._started += 1
+            else:
+                worker = None
+        try:
+            yield worker
+        finally:
+            if worker is not None:
+                with self._lock:
+                    self._idle.append(worker)
+
+    def warm(self, count: int) -> None:
+        """Starts up to count workers ahead of the first render"""
+        for _ in range(count):
+            with self._lock:
+                if self._started >= self.size:
+                    return
+                self._started += 1
+            worker = PrinceWorker()
+            try:
+                worker.start()
+            except (PrinceWorkerError, OSError):
+                logger.warning("splat|prince_worker_warm_failed", exc_info=True)
+                with self._lock:
+                    self._started -= 1
+                return
+            with self._lock:
+                self._idle.append(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            for worker in self._idle:
+                worker.stop()
+
+
+prince_workers = PrinceWorkerPool(size=PRINCE_WORKER_COUNT)
+
+
+def prince_handler(document: bytes | str, output_filepath: str, javascript: bool = False) -> bytes | str:
+    """Renders html held in memory or at a file path with prince.
+
+    Documents small enough to render in memory are piped to prince and the pdf bytes are returned. Larger ones are
+    rendered from disk to output_filepath, which is returned instead, as is a pdf that outgrows memory however its
+    document was sent.
+    """
+    in_memory = binary_size(document) <= IN_MEMORY_RENDER_MAX_BYTES
+    if PRINCE_CONTROL_ENABLED and in_memory:
+        with prince_workers.worker() as worker:
+            if worker is not None:
+                try:
+                    print("splat|prince_worker_run")
+                    return worker.convert(document, javascript, output_filepath)
+                except PrinceWorkerError:
+                    logger.warning("splat|prince_worker_failed|falling_back_to_subprocess", exc_info=True)
+                    worker.stop()
+
     print("splat|prince_command_run")
-    # Prepare command
-    command = [
-        "./prince",
-        input_filepath,
-        "-o",
-        output_filepath,
-        "--structured-log=normal",
-        "--verbose",
-    ]
-    if javascript:
-        command.append("--javascript")
-    # Run command and capture output
-    print(f"splat|invoke_prince {' '.join(command)}")
-    execute(command)
-
-
-def create_pdf(payload: Payload, output_filepath: str) -> str:
-    """Creates the PDF and stores it from the payload"""
+    if in_memory:
+        # Read the document from stdin and write the pdf to stdout
+        command = ["./prince", "-", "-o", "-", "--structured-log=normal", "--verbose"]
+        if javascript:
+            command.append("--javascript")
+        print(f"splat|invoke_prince {' '.join(command)}")
+        with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process:  # noqa
+            assert process.stdin and process.stdout
+
+            # Written from another thread, as prince may start writing the pdf before it has read all of the html
+            def write_document() -> None:
+                assert process.stdin
+                with open_binary(document) as f, process.stdin:
+                    with suppress(BrokenPipeError):
+                        shutil.copyfileobj(f, process.stdin)
+
+            writer = threading.Thread(target=write_document, name="splat-prince-stdin")
+            writer.start()
+            pdf = read_bounded(process.stdout, output_filepath)
+            writer.join()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return pdf
+
+    with html_file(document) as input_filepath:
+        # Prepare command
+        command = [
+            "./prince",
+            input_filepath,
+            "-o",
+            output_filepath,
+            "--structured-log=normal",
+            "--verbose",
+        ]
+        if javascript:
+            command.append("--javascript")
+        # Run command and capture output
+        print(f"splat|invoke_prince {' '.join(command)}")
+        execute(command)
+    return output_filepath
+
+
+def create_pdf(payload: Payload, output_filepath: str) -> bytes | str:
+    """Creates the PDF from the payload.
+
+    Returns the pdf bytes, or output_filepath when the pdf was written to disk instead.
+    """
     if payload.document_content:
-        pdf_from_document_content(payload, output_filepath)
+        return pdf_from_document_content(payload, output_filepath)
     elif payload.document_url:
-        pdf_from_document_url(payload, output_filepath)
+        return pdf_from_document_url(payload, output_filepath)
     elif payload.browser_url:
-        pdf_from_browser_url(payload, output_filepath)
+        return pdf_from_browser_url(payload, output_filepath)
     else:
         raise SplatPDFGenerationFailure(
             "Please specify either document_content or document_url or browser_url in the payload.",
             status_code=400,
         )
-    return output_filepath
 
 
-def deliver_pdf_to_s3_bucket(payload: Payload, output_filepath: str) -> Response:
-    print("splat|bucket_save")
-    key = f"{uuid.uuid4()}.pdf"
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(payload.bucket_name)
-    bucket.upload_file(output_filepath, key)
+def optimize_pdf(pdf: bytes | str, options: PdfOptimization) -> bytes | str:
+    """Shrinks a rendered pdf: deduplicates identical streams (e.g. images and font subsets embedded once per use),
+    downsamples images drawn at far more than the target dpi, recompresses streams and packs objects into object
+    streams. Returns the pdf as bytes, or the path of a file in the workspace for pdfs rendered to disk.
+
+    The original is returned if optimizing failed or didn't make it any smaller.
+    """
+    import pikepdf
+
+    pikepdf.settings.set_flate_compression_level(9)
+    report = current_report()
+    before = binary_size(pdf)
+    try:
+        with pikepdf.open(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf) as document:
+            deduplicated = deduplicate_streams(document)
+            downsampled = 0
+            if image_dpi := options.setting("image_dpi"):
+                downsampled = downsample_images(document, image_dpi, options.setting("jpeg_quality"))
+            report.pdf_pages = len(document.pages)
+
+            save_options = {
+                "compress_streams": True,
+                "recompress_flate": True,
+                "object_stream_mode": pikepdf.ObjectStreamMode.generate,
+                "linearize": options.setting("linearize"),
+            }
+            if isinstance(pdf, bytes):
+                buffer = io.BytesIO()
+                document.save(buffer, **save_options)
+                optimized: bytes | str = buffer.getvalue()
+            else:
+                fd, optimized = tempfile.mkstemp(suffix=".pdf", dir=scratch_dir())
+                os.close(fd)
+                document.save(optimized, **save_options)
+    except pikepdf.PdfError:
+        # The rendered pdf is still perfectly deliverable, just not any smaller
+        logger.warning("splat|optimize_failed", exc_info=True)
+        return pdf
+
+    after = binary_size(optimized)
+    print(
+        f"splat|optimize|preset={options.preset}|before={before}|after={after}"
+        f"|deduplicated={deduplicated}|downsampled={downsampled}"
+    )
+    if after >= before:
+        return pdf
+    report.optimize_preset = options.preset
+    report.optimize_sizes = (before, after)
+    return optimized
+
+
+def deduplicate_streams(document: Any) -> int:
+    """Points every reference to a stream at the first byte identical copy of it, leaving the copies unreferenced so
+    that they're dropped when the pdf is saved. Returns the number of duplicates found."""
+    import pikepdf
+
+    canonical: dict[tuple[bytes, str], Any] = {}
+    duplicates: dict[tuple[int, int], Any] = {}
+    for obj in document.objects:
+        if not isinstance(obj, pikepdf.Stream):
+            continue
+        # Serialised, so that indirect values compare by reference ("12 0 R") rather than by a repr of their content
+        dictionary = sorted(
+            (key, value.unparse() if isinstance(value, pikepdf.Object) else repr(value))
+            for key, value in obj.items()
+            if key != "/Length"
+        )
+        key = (hashlib.sha256(obj.read_raw_bytes()).digest(), repr(dictionary))
+        if key in canonical:
+            duplicates[obj.objgen] = canonical[key]
+        else:
+            canonical[key] = obj
+
+    if duplicates:
+        for obj in document.objects:
+            if isinstance(obj, pikepdf.Dictionary | pikepdf.Stream | pikepdf.Array):
+                _replace_references(obj, duplicates)
+    return len(duplicates)
+
+
+def _replace_references(container: Any, replacements: dict[tuple[int, int], Any]) -> None:
+    """Replaces references to the objects in replacements within a dictionary or array and its direct children"""
+    import pikepdf
+
+    is_dictionary = isinstance(container, pikepdf.Dictionary | pikepdf.Stream)
+    for key, value in list(container.items() if is_dictionary else enumerate(container)):
+        if not isinstance(value, pikepdf.Object):
+            continue  # numbers, booleans and other scalars
+        if value.is_indirect:
+            if value.objgen in replacements:
+                container[key] = replacements[value.objgen]
+        elif isinstance(value, pikepdf.Dictionary | pikepdf.Array):
+            _replace_references(value, replacements)
+
+
+class ImageResolutions:
+    """Finds the lowest effective dpi each image of a pdf is drawn at, i.e. its resolution where it's drawn largest"""
+
+    def __init__(self, document: Any) -> None:
+        import pikepdf
+
+        self.resolutions: dict[tuple[int, int], float] = {}
+        for page in document.pages:
+            self.walk(page, page.get("/Resources"), pikepdf.Matrix())
+
+    def walk(self, content: Any, resources: Any, ctm: Any, depth: int = 0) -> None:
+        import pikepdf
+
+        stack = []
+        for operands, operator in pikepdf.parse_content_stream(content, "q Q cm Do"):
+            if operator == pikepdf.Operator("q"):
+                stack.append(ctm)
+            elif operator == pikepdf.Operator("Q") and stack:
+                ctm = stack.pop()
+            elif operator == pikepdf.Operator("cm"):
+                ctm = pikepdf.Matrix(*(float(operand) for operand in operands)) @ ctm
+            elif operator == pikepdf.Operator("Do") and resources is not None:
+                xobject = resources.get("/XObject", {}).get(operands[0])
+                if xobject is not None:
+                    self.draw(xobject, resources, ctm, depth)
+
+    def draw(self, xobject: Any, resources: Any, ctm: Any, depth: int) -> None:
+        import pikepdf
+
+        if xobject.get("/Subtype") == "/Image" and xobject.is_indirect:
+            # Images are drawn into the unit square, so the lengths of the ctm's axes are their size in points
+            width, height = math.hypot(ctm.a, ctm.b) / 72, math.hypot(ctm.c, ctm.d) / 72
+            if width and height:
+                dpi = min(int(xobject.Width) / width, int(xobject.Height) / height)
+                self.resolutions[xobject.objgen] = min(dpi, self.resolutions.get(xobject.objgen, dpi))
+        elif xobject.get("/Subtype") == "/Form" and depth < 8:
+            matrix = pikepdf.Matrix(*(float(value) for value in xobject.get("/Matrix", [1, 0, 0, 1, 0, 0])))
+            self.walk(xobject, xobject.get("/Resources", resources), matrix @ ctm, depth + 1)
+
+
+def downsample_images(document: Any, image_dpi: int, jpeg_quality: int | None) -> int:
+    """Downsamples opaque 8 bit rgb and grayscale images drawn at more than 1.5x image_dpi, keeping jpegs as jpegs and
+    lossless images lossless. Returns the number of images downsampled."""
+    import pikepdf
+    from PIL import Image
 
-    presigned_url = boto3.client("s3").generate_presigned_url(
+    downsampled = 0
+    for objgen, dpi in ImageResolutions(document).resolutions.items():
+        if dpi <= image_dpi * 1.5:
+            continue
+        image = document.get_object(objgen)
+        if (
+            image.get("/ImageMask")
+            or "/SMask" in image
+            or "/Mask" in image
+            or "/Decode" in image
+            or image.get("/BitsPerComponent") != 8
+            or image.get("/ColorSpace") not in ("/DeviceRGB", "/DeviceGray")
+        ):
+            continue
+        is_jpeg = image.get("/Filter") in ("/DCTDecode", pikepdf.Array([pikepdf.Name.DCTDecode]))
+        try:
+            pil_image = pikepdf.PdfImage(image).as_pil_image()
+        except (pikepdf.PdfError, NotImplementedError, OSError):
+            continue
+        scale = image_dpi / dpi
+        pil_image = pil_image.resize(
+            (max(1, round(pil_image.width * scale)), max(1, round(pil_image.height * scale))), Image.Resampling.LANCZOS
+        )
+        if is_jpeg:
+            buffer = io.BytesIO()
+            pil_image.save(buffer, format="JPEG", quality=jpeg_quality or 90, optimize=True)
+            image.write(buffer.getvalue(), filter=pikepdf.Name.DCTDecode)
+        else:
+            image.write(zlib.compress(pil_image.tobytes(), 9), filter=pikepdf.Name.FlateDecode)
+        image.Width, image.Height = pil_image.width, pil_image.height
+        if "/DecodeParms" in image:
+            del image.DecodeParms
+        downsampled += 1
+    return downsampled
+
+
+_s3_client: Any = None
+_s3_client_lock = threading.Lock()
+
+
+def s3_client() -> Any:
+    """An s3 client kept for the lifetime of the container, shared between threads"""
+    global _s3_client
+    if _s3_client is not None:
+        return _s3_client
+    import boto3
+    import botocore.config
+
+    # Client creation isn't thread safe, and batch items may race to create the first one
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.session.Session().client(
+                "s3", config=botocore.config.Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+            )
+        return _s3_client
+
+
+class UploadProgress:
+    """Logs the progress and throughput of an s3 transfer"""
+
+    def __init__(self, key: str, size: int, log_every: int = 64 * 1024 * 1024) -> None:
+        self.key = key
+        self.size = size
+        self.log_every = log_every
+        self.transferred = 0
+        self.started = time.monotonic()
+        self._next_log = log_every
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount: int) -> None:
+        # Called from the transfer manager's worker threads
+        with self._lock:
+            self.transferred += bytes_amount
+            if self.transferred >= self._next_log:
+                self._next_log += self.log_every
+                print(f"splat|s3_upload_progress|{self.key}|{self.transferred}/{self.size}")
+
+    def log_summary(self) -> None:
+        elapsed = time.monotonic() - self.started
+        throughput = self.transferred / elapsed / 1024 / 1024 if elapsed else 0
+        print(
+            f"splat|s3_upload_complete|{self.key}|bytes={self.transferred}|seconds={elapsed:.3f}|mb_per_second={throughput:.2f}"
+        )
+
+
+def upload_pdf(payload: Payload, pdf: bytes | str, bucket: str, key: str) -> str:
+    """Uploads the pdf to s3, returning a presigned url to download it"""
+    from boto3.s3.transfer import TransferConfig
+
+    transfer_config = TransferConfig(
+        multipart_threshold=payload.s3_transfer.multipart_threshold,
+        multipart_chunksize=payload.s3_transfer.multipart_chunksize,
+        max_concurrency=payload.s3_transfer.max_concurrency,
+    )
+    progress = UploadProgress(key, binary_size(pdf))
+    with open_binary(pdf) as f:
+        s3_client().upload_fileobj(f, bucket, key, Config=transfer_config, Callback=progress)
+    progress.log_summary()
+
+    return s3_client().generate_presigned_url(
         "get_object",
-        Params={"Bucket": payload.bucket_name, "Key": key},
+        Params={"Bucket": bucket, "Key": key},
     )
+
+
+def deliver_pdf_to_s3_bucket(payload: Payload, pdf: bytes | str) -> Response:
+    print("splat|bucket_save")
+    assert payload.bucket_name
+    key = f"{uuid.uuid4()}.pdf"
+    presigned_url = upload_pdf(payload, pdf, payload.bucket_name, key)
     return Response(
         body=json.dumps(
             {
@@ -325,7 +2029,29 @@ def deliver_pdf_to_s3_bucket(payload: Payload, output_filepath: str) -> Response
     )
 
 
-def deliver_pdf_to_presigned_url(payload: Payload, output_filepath: str) -> Response:
+def deliver_pdf_to_spill_bucket(payload: Payload, pdf: bytes | str) -> Response:
+    """Delivers a pdf too large to stream back by uploading it to the spill bucket, redirecting the caller to it.
+
+    The caller is responsible for deleting the object once it has downloaded it.
+    """
+    assert SPILL_BUCKET
+    key = f"{SPILL_PREFIX}{uuid.uuid4()}.pdf"
+    print(f"splat|spill|{binary_size(pdf)}|{key}")
+    presigned_url = upload_pdf(payload, pdf, SPILL_BUCKET, key)
+    return Response(
+        status_code=303,
+        headers={"Content-Type": "application/json", "Location": presigned_url},
+        body=json.dumps(
+            {
+                "bucket": SPILL_BUCKET,
+                "key": key,
+                "presigned_url": presigned_url,
+            }
+        ),
+    )
+
+
+def deliver_pdf_to_presigned_url(payload: Payload, pdf: bytes | str) -> Response:
     print("splat|presigned_url_save")
     presigned_url = payload.presigned_url
     try:
@@ -337,16 +2063,17 @@ def deliver_pdf_to_presigned_url(payload: Payload, output_filepath: str) -> Resp
             status_code=400,
             message="Invalid presigned URL",
         ) from e
-    print("output_filepath=", output_filepath)
+    filename = pdf if isinstance(pdf, str) else "output.pdf"
+    print("output_filepath=", filename)
 
     attempts = 0
     while attempts < S3_RETRY_COUNT:
-        with open(output_filepath, "rb") as f:
+        with open_binary(pdf) as f:
             # 5xx responses are normal for s3, recommendation is to try 10 times
             # https://aws.amazon.com/premiumsupport/knowledge-center/http-5xx-errors-s3/
-            files = {"file": (output_filepath, f)}
+            files = {"file": (filename, f)}
             print(f'splat|posting_to_s3|{presigned_url["url"]}|{presigned_url["fields"].get("key")}')
-            response = requests.post(
+            response = http_session().post(
                 presigned_url["url"],
                 data=presigned_url["fields"],
                 files=files,
@@ -362,15 +2089,15 @@ def deliver_pdf_to_presigned_url(payload: Payload, output_filepath: str) -> Resp
         print("splat|s3_max_retry_reached")
         return Response(
             status_code=response.status_code,
-            headers=response.headers,
-            body=response.content,
+            headers=dict(response.headers),
+            body=response.content.decode("utf-8", errors="replace"),
         )
     if response.status_code != 204:
         print(f"splat|presigned_url_save|unknown_error|{response.status_code}|{response.content}")
         return Response(
             status_code=response.status_code,
-            headers=response.headers,
-            body=response.content,
+            headers=dict(response.headers),
+            body=response.content.decode("utf-8", errors="replace"),
         )
     else:
         return Response(
@@ -378,18 +2105,22 @@ def deliver_pdf_to_presigned_url(payload: Payload, output_filepath: str) -> Resp
         )
 
 
-def deliver_pdf_via_streaming_base64(output_filepath: str) -> Response:
-    print("splat|stream_binary_response")
-    # Otherwise just stream the pdf data back.
-    with open(output_filepath, "rb") as f:
-        binary_data = f.read()
-    b64_encoded_pdf = base64.b64encode(binary_data).decode("utf-8")
-    # Check size. lambda has a 6mb limit. Check if > 5.5mb
-    if sys.getsizeof(b64_encoded_pdf) / 1024 / 1024 > 5.5:
+def deliver_pdf_via_streaming_base64(payload: Payload, pdf: bytes | str) -> Response:
+    # Check size before reading and encoding anything. lambda has a 6mb limit.
+    encoded_size = 4 * math.ceil(binary_size(pdf) / 3)
+    if encoded_size > STREAMING_MAX_BYTES:
+        if SPILL_BUCKET:
+            return deliver_pdf_to_spill_bucket(payload, pdf)
         raise SplatPDFGenerationFailure(
             status_code=500,
             message="The resulting PDF is too large to stream back from lambda. Please use 'presigned_url' to upload it to s3 instead.",
         )
+
+    print("splat|stream_binary_response")
+    # Otherwise just stream the pdf data back.
+    with open_binary(pdf) as f:
+        binary_data = f.read()
+    b64_encoded_pdf = base64.b64encode(binary_data).decode("utf-8")
     return Response(
         headers={
             "Content-Type": "application/pdf",
@@ -399,67 +2130,294 @@ def deliver_pdf_via_streaming_base64(output_filepath: str) -> Response:
     )
 
 
-def deliver_pdf(payload: Payload, output_filepath: str) -> Response:
+def deliver_pdf(payload: Payload, pdf: bytes | str) -> Response:
+    """Delivers the pdf, given as bytes or the path of the file holding it"""
     if payload.bucket_name:
-        return deliver_pdf_to_s3_bucket(payload, output_filepath)
+        return deliver_pdf_to_s3_bucket(payload, pdf)
     elif payload.presigned_url:
-        return deliver_pdf_to_presigned_url(payload, output_filepath)
+        return deliver_pdf_to_presigned_url(payload, pdf)
+    else:
+        return deliver_pdf_via_streaming_base64(payload, pdf)
+
+
+def pdf_page_count(pdf: bytes | str) -> int | None:
+    """Counts the page objects of a pdf, without parsing it. Pages hidden inside compressed object streams are missed."""
+    if isinstance(pdf, bytes):
+        pages = len(PDF_PAGE_RE.findall(pdf))
+    else:
+        with open(pdf, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pages = len(PDF_PAGE_RE.findall(mapped))
+    return pages or None
+
+
+def emit_render_metrics(payload: Payload, report: RenderReport, pdf: bytes | str) -> None:
+    """Logs the render's stage timings in CloudWatch's embedded metric format, which lambda turns into metrics"""
+    if not METRICS_NAMESPACE:
+        return
+    # ru_maxrss is in kilobytes on linux, and is the peak over the lifetime of the container rather than this render
+    metrics: dict[str, tuple[float, str]] = {
+        **{f"{stage}_ms": (seconds * 1000, "Milliseconds") for stage, seconds in report.timings.items()},
+        "total_ms": (report.total * 1000, "Milliseconds"),
+        "pdf_bytes": (binary_size(pdf), "Bytes"),
+        "peak_rss_bytes": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, "Bytes"),
+        "peak_child_rss_bytes": (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024, "Bytes"),
+    }
+    if pages := report.pdf_pages or pdf_page_count(pdf):
+        metrics["pdf_pages"] = (pages, "Count")
+    if report.optimize_sizes:
+        metrics["pdf_bytes_unoptimized"] = (report.optimize_sizes[0], "Bytes")
+    metrics["tmp_used_bytes"] = (shutil.disk_usage(TMP_DIR).used, "Bytes")
+    if os.path.exists(FONTCONFIG_FILE):
+        metrics["font_cache_stale"] = (int(font_cache_state() != "fresh"), "Count")
+
+    if payload.document_content:
+        input_mode = "document_content"
+    elif payload.document_url:
+        input_mode = "document_url"
     else:
-        return deliver_pdf_via_streaming_base64(output_filepath)
+        input_mode = "browser_url"
+    dimensions = {"renderer": payload.renderer.value, "input_mode": input_mode}
+
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [list(dimensions)],
+                            "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()],
+                        }
+                    ],
+                },
+                **dimensions,
+                **{name: round(value, 3) for name, (value, _) in metrics.items()},
+                "cache": report.cache,
+            }
+        )
+    )
 
 
 # Entrypoint for AWS
 def lambda_handler(event: dict, context: dict) -> dict:  # noqa
+    token = _status_url.set(None)
     try:
-        resp = handle_event(event).as_dict()
+        # Everything the invocation writes to its workspace is removed on the way out
+        with workspace.invocation():
+            resp = handle_event(event).as_dict()
     except SplatPDFGenerationFailure as e:
         resp = e.as_response().as_dict()
     except Exception as e:
         logger.error(f"splat|unknown_error|{str(e)}|stacktrace:", exc_info=True)
         resp = SplatPDFGenerationFailure(status_code=500, message=str(e)).as_response().as_dict()
-    finally:
-        try:
-            execute(["rm", "-rf", "/tmp/*"])  # noqa
-        except Exception as e:
-            logger.error(f"splat|cleanup_error|{str(e)}|stacktrace:", exc_info=True)
 
+    if status_url := _status_url.get():
+        post_status(status_url, resp)
+    _status_url.reset(token)
     return resp
 
 
+# Where to upload the outcome of the current invocation, given as `status_url` in its body
+_status_url: contextvars.ContextVar[dict | None] = contextvars.ContextVar("status_url", default=None)
+
+
+def post_status(status_url: dict, resp: dict) -> None:
+    """Uploads the response as a json status object to a presigned post, for callers that invoked splat asynchronously
+    and so never receive the response itself. A base64 encoded pdf is left out of it."""
+    status = {key: value for key, value in resp.items() if key != "body" or not resp.get("isBase64Encoded")}
+    if isinstance(status.get("body"), bytes):
+        status["body"] = status["body"].decode("utf-8", errors="replace")
+    try:
+        status_json = json.dumps(status, default=str)
+    except Exception as e:  # noqa
+        # The caller only learns the outcome from the status object, so it must always be written
+        logger.warning(f"splat|status_save|invalid_status|{str(e)}", exc_info=True)
+        failure = SplatPDFGenerationFailure(f"Unable to serialise splat's response: {e}")
+        status_json = json.dumps(failure.as_response().as_dict())
+    try:
+        for _ in range(S3_RETRY_COUNT):
+            response = http_session().post(
+                status_url["url"],
+                data=status_url["fields"],
+                files={"file": ("status.json", status_json, "application/json")},
+                timeout=30,
+            )
+            if response.status_code not in [500, 503]:
+                break
+        print(f"splat|status_save|{response.status_code}")
+    except Exception as e:  # noqa
+        logger.warning(f"splat|status_save|error|{str(e)}", exc_info=True)
+
+
 def handle_event(event: dict) -> Response:  # noqa
     """The main body of the lambda sans error handling"""
     print("splat|begin")
 
+    report = RenderReport()
+
     # 1) Initialize
-    init()
+    with report.timed("init"):
+        init()
 
     # 2) Parse payload
-    body = json.loads(event.get("body", "{}"))
-    try:
-        payload = Payload(**body)
-    except pydantic.ValidationError as e:
-        raise SplatPDFGenerationFailure(
-            status_code=400,
-            message=f"Invalid payload: {e}",
-        ) from e
+    with report.timed("parse"):
+        body = json.loads(event.get("body", "{}"))
+        if isinstance(body, dict) and isinstance(body.get("status_url"), dict):
+            _status_url.set(body["status_url"])
+        if "items" in body:
+            payload = None
+        else:
+            try:
+                payload = Payload(**body)
+            except pydantic.ValidationError as e:
+                raise SplatPDFGenerationFailure(
+                    status_code=400,
+                    message=f"Invalid payload: {e}",
+                ) from e
+    if payload is None:
+        return handle_batch(body)
 
     # 3) Check licence if user is requesting that
     if payload.check_license:
         return check_license()
 
+    # 4) Generate and deliver the PDF
+    return render_and_deliver(payload, report)
+
+
+def render_and_deliver(payload: Payload, report: RenderReport | None = None) -> Response:
     print(f"splat|javascript={payload.javascript}")
     print(f"splat|renderer={payload.renderer}")
 
-    # 4) Generate PDF
-    with tempfile.NamedTemporaryFile(suffix=".pdf") as output_pdf:
-        output_filepath = output_pdf.name
-        create_pdf(payload, output_filepath)
+    report = report or RenderReport()
+    token = _render_report.set(report)
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".pdf", dir=scratch_dir()) as output_pdf:
+            # Generate PDF
+            with report.timed("render"):
+                pdf = create_pdf(payload, output_pdf.name)
+
+            if payload.optimize:
+                with report.timed("optimize"):
+                    pdf = optimize_pdf(pdf, payload.optimize)
+
+            # Deliver  the PDF
+            with report.timed("delivery"):
+                resp = deliver_pdf(payload, pdf)
 
-        # 5) Deliver  the PDF
-        resp = deliver_pdf(payload, output_filepath)
+            try:
+                emit_render_metrics(payload, report, pdf)
+            except Exception as e:
+                logger.warning(f"splat|metrics_error|{str(e)}", exc_info=True)
+    finally:
+        _render_report.reset(token)
+    resp.headers = {**resp.headers, **report.headers()}
     return resp
 
 
+def _render_batch_item(index: int, payload: Payload) -> dict:
+    print(f"splat|batch_item|index={index}")
+    try:
+        if not (payload.bucket_name or payload.presigned_url):
+            raise SplatPDFGenerationFailure(
+                "Batch items must specify either bucket_name or presigned_url.",
+                status_code=400,
+            )
+        resp = render_and_deliver(payload)
+    except SplatPDFGenerationFailure as e:
+        resp = e.as_response()
+    except Exception as e:
+        logger.error(f"splat|batch_item_error|{index}|{str(e)}|stacktrace:", exc_info=True)
+        resp = SplatPDFGenerationFailure(status_code=500, message=str(e)).as_response()
+
+    body = resp.body.decode("utf-8", errors="replace") if isinstance(resp.body, bytes) else resp.body
+    return {"index": index, "statusCode": resp.status_code, "body": body, "headers": dict(resp.headers)}
+
+
+def _uses_playwright(payload: Payload) -> bool:
+    return payload.renderer == Renderers.playwright or bool(payload.browser_url)
+
+
+def handle_batch(body: dict) -> Response:
+    """Renders every item of a batch payload and reports on each one individually.
+
+    Items render concurrently, on as many threads as the lambda has vCPUs. Playwright's sync api is bound to the
+    thread that started it, so items needing chromium render on worker threads of their own, each with its own
+    playwright connected to the warm browser over devtools. Their pages render in parallel, in one chromium.
+    """
+    try:
+        batch = BatchPayload(**body)
+    except pydantic.ValidationError as e:
+        raise SplatPDFGenerationFailure(
+            status_code=400,
+            message=f"Invalid payload: {e}",
+        ) from e
+
+    max_workers = min(batch.max_workers or BATCH_MAX_WORKERS, BATCH_MAX_WORKERS)
+    print(f"splat|batch|items={len(batch.items)}|max_workers={max_workers}")
+
+    results: list[dict] = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="splat-batch") as executor:
+        futures = [
+            # Run in a copy of the current context so that items write to the invocation's workspace
+            executor.submit(contextvars.copy_context().run, _render_batch_item, index, item)
+            for index, item in enumerate(batch.items)
+            if not _uses_playwright(item)
+        ]
+        playwright_items = [(index, item) for index, item in enumerate(batch.items) if _uses_playwright(item)]
+        if playwright_items:
+            results.extend(_render_playwright_batch_items(playwright_items, max_workers))
+        results.extend(future.result() for future in futures)
+
+    results.sort(key=lambda result: result["index"])
+    return Response(body=json.dumps({"items": results}))
+
+
+def _render_playwright_batch_items(items: list[tuple[int, Payload]], max_workers: int) -> list[dict]:
+    """Renders batch items needing chromium on worker threads sharing this thread's warm browsers"""
+    configurations = {browser_key(item.browser_launch_kwargs): item.browser_launch_kwargs for _, item in items}
+    endpoints = {}
+    # Only as many launch configurations as are kept warm, or sharing one would close another
+    for key, browser_launch_kwargs in list(configurations.items())[:MAX_WARM_BROWSERS]:
+        try:
+            if endpoint := browser_manager().endpoint(browser_launch_kwargs):
+                endpoints[key] = endpoint
+        except Exception as e:  # noqa
+            # Workers launch browsers of their own instead
+            logger.warning(f"splat|batch_browser_failed|{str(e)}", exc_info=True)
+
+    pending = collections.deque(items)
+    results: list[dict] = []
+
+    def work() -> None:
+        try:
+            while True:
+                try:
+                    index, item = pending.popleft()
+                except IndexError:
+                    return
+                results.append(_render_batch_item(index, item))
+        finally:
+            # Disconnects from the shared browsers and stops this thread's playwright
+            browser_manager().close()
+
+    token = _browser_endpoints.set(endpoints)
+    try:
+        threads = [
+            # Run in a copy of the current context so that items write to the invocation's workspace
+            threading.Thread(target=contextvars.copy_context().run, args=(work,), name=f"splat-batch-browser-{n}")
+            for n in range(min(max_workers, len(items)))
+        ]
+    finally:
+        _browser_endpoints.reset(token)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 def check_license() -> Response:
     """Checks the license file and returns the parsed license data."""
     tree = ET.parse("./prince-engine/license/license.dat")  # noqa
@@ -0,0 +1,212 @@
+"""HTTP server entry point for running splat as a long lived container, e.g. on ECS, rather than on lambda.
+
+Accepts the same events and returns the same responses as the lambda, at the path the lambda runtime interface
+emulator uses, so clients and tests work against either:
+
+    curl localhost:8080/2015-03-31/functions/function/invocations -d '{"body": "{\\"document_content\\": \\"<h1>hi</h1>\\"}"}'
+
+Renders run on a fixed pool of worker threads. Each has its own warm chromium, as playwright's sync api is bound to the
+thread that started it, and they share the prince workers. Requests wait in a bounded queue, beyond which they're
+turned away with a 503 so the load balancer can send them elsewhere.
+"""
+
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import lambda_function
+
+logger = logging.getLogger("splat")
+
+INVOCATIONS_PATH = "/2015-03-31/functions/function/invocations"
+PORT = int(os.environ.get("SPLAT_SERVER_PORT", "8080"))
+WORKERS = int(os.environ.get("SPLAT_SERVER_WORKERS", str(lambda_function.CPU_COUNT)))
+QUEUE_SIZE = int(os.environ.get("SPLAT_SERVER_QUEUE_SIZE", str(WORKERS * 2)))
+# Launch chromium and prince on every worker before reporting ready
+WARM = os.environ.get("SPLAT_SERVER_WARM", "true").lower() in {"1", "true", "yes"}
+DRAIN_TIMEOUT = int(os.environ.get("SPLAT_SERVER_DRAIN_TIMEOUT", "120"))  # seconds
+MAX_BODY_BYTES = int(os.environ.get("SPLAT_SERVER_MAX_BODY_BYTES", str(64 * 1024 * 1024)))
+
+
+class RenderPool:
+    """Worker threads rendering events from a bounded queue"""
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self.jobs: queue.Queue[tuple[dict, Future] | None] = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._run, name=f"splat-render-{index}", daemon=True) for index in range(workers)
+        ]
+        self.draining = threading.Event()
+        self._warm = False
+        self._warmed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._warmed == len(self.threads) and not self.draining.is_set()
+
+    @property
+    def alive(self) -> bool:
+        return all(thread.is_alive() for thread in self.threads)
+
+    def start(self, warm: bool) -> None:
+        self._warm = warm
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, event: dict) -> Future:
+        """Queues an event for rendering. Raises queue.Full when the queue is full."""
+        future: Future = Future()
+        self.jobs.put_nowait((event, future))
+        return future
+
+    def _run(self) -> None:
+        # A worker that failed to warm up still takes renders, but the server isn't reported ready
+        if not self._warm or self._warm_up():
+            with self._lock:
+                self._warmed += 1
+
+        while (job := self.jobs.get()) is not None:
+            event, future = job
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(lambda_function.lambda_handler(event, None))
+            except Exception as e:  # noqa
+                future.set_exception(e)
+            finally:
+                self.jobs.task_done()
+        self.jobs.task_done()
+        lambda_function.browser_manager().close()
+
+    def _warm_up(self) -> bool:
+        try:
+            lambda_function.init()
+            lambda_function.browser_manager().get_browser({})
+            if lambda_function.PRINCE_CONTROL_ENABLED:
+                lambda_function.prince_workers.warm(1)
+        except Exception:  # noqa
+            logger.warning("splat|server|warm_up_failed", exc_info=True)
+            return False
+        return True
+
+    def drain(self, timeout: float) -> None:
+        """Finishes the queued renders, then stops the workers"""
+        self.draining.set()
+        deadline = time.monotonic() + timeout
+        for _ in self.threads:
+            # Queued after every pending job, so those are rendered first
+            try:
+                self.jobs.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                logger.warning("splat|server|drain_timed_out")
+                break
+        for thread in self.threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        # Anything still queued missed the deadline, fail it rather than leave its request hanging
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job[1].cancel()
+        lambda_function.prince_workers.close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: "SplatServer"
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path == "/healthz":
+            self._send(200 if self.server.pool.alive else 503, {"alive": self.server.pool.alive})
+        elif self.path == "/readyz":
+            self._send(200 if self.server.pool.ready else 503, {"ready": self.server.pool.ready})
+        else:
+            self._send(404, {"errors": ["Not found"]})
+
+    def do_POST(self) -> None:  # noqa: N802
+        if self.path != INVOCATIONS_PATH:
+            self._send(404, {"errors": ["Not found"]})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self._send(413, {"errors": [f"Request body is larger than the {MAX_BODY_BYTES} byte limit."]})
+            return
+        body = self.rfile.read(length)
+        if self.server.pool.draining.is_set():
+            self._send(503, {"errors": ["Shutting down"]})
+            return
+        try:
+            event = json.loads(body or b"{}")
+        except json.JSONDecodeError as e:
+            self._send(400, {"errors": [f"Invalid event: {e}"]})
+            return
+
+        try:
+            future = self.server.pool.submit(event)
+        except queue.Full:
+            self._send(503, {"errors": ["Too many renders queued, try again later"]}, {"Retry-After": "1"})
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"splat|server|render_error|{str(e)}", exc_info=True)
+            self._send(500, {"errors": [str(e)]})
+            return
+        # Like the lambda runtime, the render's own status code is in the response body
+        self._send(200, result)
+
+    def _send(self, status: int, body: Any, headers: dict[str, str] | None = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        print(f"splat|server|{self.address_string()}|{format % args}")
+
+
+class SplatServer(ThreadingHTTPServer):
+    # Let handlers waiting on a render write their response before the process exits
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, address: tuple[str, int], pool: RenderPool) -> None:
+        super().__init__(address, Handler)
+        self.pool = pool
+
+
+def main() -> None:
+    pool = RenderPool(WORKERS, QUEUE_SIZE)
+    pool.start(warm=WARM)
+    server = SplatServer(("0.0.0.0", PORT), pool)  # noqa: S104
+
+    def shut_down(signum: int, frame: Any) -> None:
+        print(f"splat|server|shutting_down|signal={signum}")
+        pool.draining.set()
+        # shutdown() waits for serve_forever() to return, so it can't be called from the thread running it
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+
+    print(f"splat|server|listening|port={PORT}|workers={WORKERS}|queue_size={QUEUE_SIZE}")
+    server.serve_forever()
+    pool.drain(DRAIN_TIMEOUT)
+    server.server_close()
+    print("splat|server|stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+import asyncio
+import base64
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+from collections.abc import Iterator
+
+import boto3
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+from uptick_splat import aio, assets, jobs, utils
+from uptick_splat.config import ClientCache, config
+from uptick_splat.deleter import BackgroundDeleter
+
+
+def wait_until(condition, timeout: float = 2) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestBackgroundDeleter:
+    @pytest.fixture
+    def deleted(self, monkeypatch) -> list[tuple[str, str]]:
+        deleted: list[tuple[str, str]] = []
+        monkeypatch.setattr(config, "delete_key_fn", lambda bucket_name, key: deleted.append((bucket_name, key)))
+        return deleted
+
+    def test_keys_are_deleted_after_the_flush_interval_every_time(self, deleted):
+        deleter = BackgroundDeleter(flush_interval=0.1)
+        deleter("bucket", "k1")
+        assert wait_until(lambda: ("bucket", "k1") in deleted)
+
+        # The queue emptied, the next key must still be flushed on time rather than waiting for a full batch
+        deleter("bucket", "k2")
+        assert wait_until(lambda: ("bucket", "k2") in deleted)
+        deleter("bucket", "k3")
+        assert wait_until(lambda: ("bucket", "k3") in deleted)
+
+    def test_failed_deletes_are_retried(self, monkeypatch):
+        attempts: list[str] = []
+
+        def flaky_delete(bucket_name: str, key: str) -> None:
+            attempts.append(key)
+            if len(attempts) == 1:
+                raise Exception("Slow down")
+
+        monkeypatch.setattr(config, "delete_key_fn", flaky_delete)
+        deleter = BackgroundDeleter(flush_interval=0.1)
+        deleter("bucket", "k1")
+        assert wait_until(lambda: len(attempts) == 2)
+
+    def test_flush_deletes_everything_queued(self, deleted):
+        deleter = BackgroundDeleter(flush_interval=60)
+        deleter("bucket", "k1")
+        deleter("other", "k2")
+        deleter.flush()
+        assert sorted(deleted) == [("bucket", "k1"), ("other", "k2")]
+
+
+class TestClientCache:
+    class FakeSession:
+        def client(self, service_name: str, region_name: str | None = None, config=None) -> object:
+            return object()
+
+    @pytest.fixture(autouse=True)
+    def session(self, monkeypatch) -> None:
+        session = self.FakeSession()
+        monkeypatch.setattr(config, "get_session_fn", lambda: session)
+
+    def test_clients_are_reused(self):
+        cache = ClientCache()
+        assert cache.get("s3") is cache.get("s3")
+        assert cache.get("lambda", read_timeout=1) is not cache.get("lambda", read_timeout=2)
+        assert cache.stats() == {"clients": 3, "hits": 1, "misses": 3}
+
+    def test_clients_are_not_reused_across_sessions(self, monkeypatch):
+        # e.g. sessions with temporary credentials, which mustn't outlive them
+        monkeypatch.setattr(config, "get_session_fn", self.FakeSession)
+        cache = ClientCache()
+        assert cache.get("s3") is not cache.get("s3")
+        assert cache.stats()["hits"] == 0
+
+    def test_least_recently_used_clients_are_evicted(self):
+        cache = ClientCache(max_clients=2)
+        s3_client = cache.get("s3")
+        cache.get("lambda", read_timeout=1)
+        cache.get("s3")
+        cache.get("lambda", read_timeout=2)
+        assert cache.stats()["clients"] == 2
+        assert cache.get("s3") is s3_client
+
+
+def test_aio_read_timeouts_share_a_few_clients():
+    assert {aio._read_timeout(timeout) for timeout in range(1, 60 * 20)} == {2**n for n in range(10)} | {60 * 15}
+    assert aio._read_timeout(0.1) == 1
+    assert aio._read_timeout(2.5) == 4
+    assert aio._read_timeout(None) == 60 * 15
+
+
+def presigning_s3_client():
+    """A real client, for presigning locally, that can't reach s3"""
+    return boto3.client("s3", region_name="us-east-1", aws_access_key_id="id", aws_secret_access_key="key")
+
+
+class FakeLambdaClient:
+    def __init__(self, *splat_responses: dict) -> None:
+        self.splat_responses = list(splat_responses)
+        self.bodies: list[dict] = []
+
+    def invoke(self, FunctionName: str, Payload: str) -> dict:
+        self.bodies.append(json.loads(json.loads(Payload)["body"]))
+        return {"StatusCode": 200, "Payload": io.BytesIO(json.dumps(self.splat_responses.pop(0)).encode("utf-8"))}
+
+
+class TestPdfWithSplat:
+    too_large = {
+        "statusCode": 500,
+        "body": json.dumps({"errors": ["The resulting PDF is too large to stream back from lambda. Please use ..."]}),
+    }
+
+    @pytest.fixture
+    def via_s3(self, monkeypatch) -> list[dict]:
+        calls: list[dict] = []
+
+        def pdf_from_html(body_html: str, **kwargs) -> bytes:
+            calls.append(kwargs)
+            return b"%PDF via s3"
+
+        monkeypatch.setattr(utils, "pdf_from_html", pdf_from_html)
+        return calls
+
+    def test_small_pdfs_are_returned_inline(self, monkeypatch, via_s3):
+        lambda_client = FakeLambdaClient({"statusCode": 200, "body": base64.b64encode(b"%PDF inline").decode()})
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: lambda_client)
+        assert utils.pdf_with_splat("<p>hi</p>", bucket_name="bucket") == b"%PDF inline"
+        assert lambda_client.bodies[0]["document_content"] == "<p>hi</p>"
+        assert not via_s3
+
+    def test_small_documents_saved_to_s3_are_sent_inline(self, monkeypatch, via_s3):
+        lambda_client = FakeLambdaClient({"statusCode": 201})
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: lambda_client)
+        monkeypatch.setattr(utils, "get_s3_client", lambda: presigning_s3_client())
+        assert utils.pdf_with_splat("<p>hi</p>", bucket_name="bucket", s3_filepath="out.pdf") is None
+        assert lambda_client.bodies[0]["document_content"] == "<p>hi</p>"
+        assert lambda_client.bodies[0]["presigned_url"]["fields"]["key"] == "out.pdf"
+        assert not via_s3
+
+    def test_large_documents_are_sent_via_s3(self, monkeypatch, via_s3):
+        lambda_client = FakeLambdaClient()
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: lambda_client)
+        monkeypatch.setattr(utils, "get_s3_client", lambda: presigning_s3_client())
+        body_html = os.urandom(5 * 1024 * 1024).hex()
+        assert utils.pdf_with_splat(body_html, bucket_name="bucket", s3_filepath="out.pdf") == b"%PDF via s3"
+        assert via_s3[0]["s3_filepath"] == "out.pdf"
+        assert not lambda_client.bodies
+
+    def test_pdfs_too_large_to_return_inline_are_rendered_via_s3(self, monkeypatch, via_s3):
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: FakeLambdaClient(self.too_large))
+        assert utils.pdf_with_splat("<p>hi</p>", bucket_name="bucket") == b"%PDF via s3"
+        assert via_s3[0]["bucket_name"] == "bucket"
+
+    def test_pdfs_too_large_to_return_inline_fail_without_a_bucket(self, monkeypatch, via_s3):
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: FakeLambdaClient(self.too_large))
+        monkeypatch.setattr(config, "default_bucket_name", None)
+        with pytest.raises(utils.SplatPDFGenerationFailure, match="too large"):
+            utils.pdf_with_splat("<p>hi</p>")
+        assert not via_s3
+
+
+class TestSpilledPdfs:
+    def test_spilled_pdfs_are_downloaded_then_deleted(self, monkeypatch):
+        deleted: list[tuple[str, str]] = []
+        s3_client = FakeS3Client()
+        s3_client.objects[("spill-bucket", "spill/a.pdf")] = {"Body": io.BytesIO(b"%PDF spilled")}
+        spilled = {
+            "statusCode": 303,
+            "headers": {"Location": "https://s3/spill-bucket/spill/a.pdf"},
+            "body": json.dumps({"bucket": "spill-bucket", "key": "spill/a.pdf", "presigned_url": "https://s3/..."}),
+        }
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: FakeLambdaClient(spilled))
+        monkeypatch.setattr(utils, "get_s3_client", lambda: s3_client)
+        monkeypatch.setattr(utils, "deleter", lambda bucket_name, key: deleted.append((bucket_name, key)))
+
+        assert utils.pdf_from_html_without_s3("<p>hi</p>") == b"%PDF spilled"
+        assert deleted == [("spill-bucket", "spill/a.pdf")]
+
+    def test_an_invalid_spilled_response_is_reported(self, monkeypatch):
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: FakeLambdaClient({"statusCode": 303}))
+        with pytest.raises(utils.SplatPDFGenerationFailure, match="Invalid spilled pdf response"):
+            utils.pdf_from_html_without_s3("<p>hi</p>")
+
+
+class RawBody(io.BytesIO):
+    def stream(self, **kwargs) -> Iterator[bytes]:
+        yield self.read()
+
+
+class RangedS3:
+    """Serves one object's ranged GETs to a real s3 client, answering later parts sooner so they complete out of order"""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.completed: list[int] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.client = presigning_s3_client()
+        self.client.meta.events.register("before-send.s3", self.send)
+
+    def send(self, request, **kwargs) -> AWSResponse:
+        headers = {"ETag": '"etag"', "Content-Type": "application/pdf"}
+        if request.method == "HEAD":
+            return AWSResponse(request.url, 200, {**headers, "Content-Length": str(len(self.data))}, RawBody())
+        range_header = request.headers["Range"]
+        range_header = range_header.decode() if isinstance(range_header, bytes) else range_header
+        start, end = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header).groups()
+        start, end = int(start), min(int(end or len(self.data)), len(self.data) - 1)
+
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05 * (1 - start / len(self.data)))
+        with self.lock:
+            self.in_flight -= 1
+            self.completed.append(start)
+
+        part = self.data[start : end + 1]
+        headers |= {"Content-Length": str(len(part)), "Content-Range": f"bytes {start}-{end}/{len(self.data)}"}
+        return AWSResponse(request.url, 206, headers, RawBody(part))
+
+
+class TestDownloadInParts:
+    part_size = 10_000
+    data = os.urandom(part_size * 9 + 1234)
+
+    def test_parts_are_yielded_in_order(self):
+        s3 = RangedS3(self.data)
+
+        parts = list(utils.iter_parts(s3.client, "bucket", "x.pdf", part_size=self.part_size, max_concurrency=4))
+
+        assert b"".join(parts) == self.data
+        assert [len(part) for part in parts] == [self.part_size] * 9 + [1234]
+        assert s3.completed != sorted(s3.completed)
+        assert 1 < s3.max_in_flight <= 4
+
+    @pytest.mark.parametrize("to_path", [True, False])
+    def test_pdf_from_html_to_file_reassembles_the_parts(self, monkeypatch, tmp_path, to_path):
+        s3 = RangedS3(self.data)
+        deleted: list[tuple[str, str]] = []
+        monkeypatch.setattr(utils, "render_to_s3", lambda *args: s3.client)
+        monkeypatch.setattr(utils, "deleter", lambda bucket_name, key: deleted.append((bucket_name, key)))
+        destination = tmp_path / "out.pdf"
+
+        if to_path:
+            utils.pdf_from_html_to_file("<p>hi</p>", destination, bucket_name="bucket", part_size=self.part_size)
+        else:
+            with open(destination, "wb") as f:
+                utils.pdf_from_html_to_file("<p>hi</p>", f, bucket_name="bucket", part_size=self.part_size)
+
+        assert destination.read_bytes() == self.data
+        assert s3.completed != sorted(s3.completed)
+        assert s3.max_in_flight > 1
+        [(bucket_name, key)] = deleted
+        assert bucket_name == "bucket" and key.startswith("tmp/")
+
+
+class TestAioPdfFromHtml:
+    def test_the_pdf_of_a_render_that_timed_out_is_deleted_once_splat_returns(self, monkeypatch):
+        deleted: list[tuple[str, str]] = []
+        uploaded: list[str] = []
+
+        class SlowLambdaClient:
+            def invoke(self, FunctionName: str, Payload: str) -> dict:
+                time.sleep(0.2)
+                uploaded.append(json.loads(json.loads(Payload)["body"])["presigned_url"]["key"])
+                return {"StatusCode": 200, "Payload": io.BytesIO(json.dumps({"statusCode": 201}).encode("utf-8"))}
+
+        monkeypatch.setattr(aio, "deleter", lambda bucket_name, key: deleted.append((bucket_name, key)))
+        monkeypatch.setattr(utils, "get_s3_client", lambda: None)
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args: SlowLambdaClient())
+        monkeypatch.setattr(utils, "presign_destination", lambda s3_client, bucket_name, key, *args: {"key": key})
+        monkeypatch.setattr(utils, "upload_html", lambda *args: ("tmp/document.html", "https://document"))
+
+        with pytest.raises(TimeoutError):
+            asyncio.run(aio.pdf_from_html("<p>hi</p>", bucket_name="bucket", timeout=0.1))
+        assert wait_until(lambda: len(uploaded) == 1 and ("bucket", uploaded[0]) in deleted)
+        assert ("bucket", "tmp/document.html") in deleted
+
+
+class TestJobs:
+    @pytest.fixture
+    def s3_client(self, monkeypatch):
+        s3_client = presigning_s3_client()
+        monkeypatch.setattr(utils, "get_s3_client", lambda: s3_client)
+        monkeypatch.setattr(utils, "upload_html", lambda *args: ("tmp/document.html", "https://document"))
+        return s3_client
+
+    def test_status_objects_are_tagged_and_kept_under_the_process_prefix(self, monkeypatch, s3_client):
+        invoked: list[dict] = []
+        monkeypatch.setattr(utils, "invoke_event", lambda lambda_client, splat_body: invoked.append(splat_body))
+        monkeypatch.setattr(utils, "get_lambda_client", lambda *args, **kwargs: None)
+        monkeypatch.setattr(config, "default_tagging", "ExpireAfter=1w&Owner=a%26b")
+
+        job = jobs.submit("<p>hi</p>", bucket_name="bucket")
+        status_url = invoked[0]["status_url"]
+        assert status_url["fields"]["key"] == job.status_key
+        assert job.status_key.startswith(jobs._process_status_prefix())
+        assert jobs._process_status_prefix() != jobs.JOB_STATUS_PREFIX
+        assert status_url["fields"]["tagging"] == (
+            "<Tagging><TagSet><Tag><Key>ExpireAfter</Key><Value>1w</Value></Tag>"
+            "<Tag><Key>Owner</Key><Value>a&amp;b</Value></Tag></TagSet></Tagging>"
+        )
+
+    def test_waiting_lists_only_the_status_prefix_of_the_jobs(self, monkeypatch):
+        listed: list[str] = []
+
+        class FakeS3Client:
+            def get_paginator(self, operation_name: str):
+                return self
+
+            def paginate(self, Bucket: str, Prefix: str):
+                listed.append(Prefix)
+                return [{"Contents": [{"Key": f"{Prefix}done.json"}]}]
+
+        monkeypatch.setattr(utils, "get_s3_client", FakeS3Client)
+        done, pending = jobs.wait(
+            [
+                jobs.RenderJob("done", "bucket", "a.pdf", "a.html", True, status_prefix="tmp/splat-jobs/p/"),
+                jobs.RenderJob("pending", "bucket", "b.pdf", "b.html", True, status_prefix="tmp/splat-jobs/p/"),
+            ],
+            timeout=0,
+        )
+        assert [job.id for job in done] == ["done"]
+        assert [job.id for job in pending] == ["pending"]
+        assert listed == ["tmp/splat-jobs/p/"]
+
+
+class TestPdfFromHtmlMany:
+    @pytest.fixture
+    def rendering(self, monkeypatch) -> dict:
+        state = {"in_flight": 0, "most_in_flight": 0, "calls": []}
+        lock = threading.Lock()
+
+        def pdf_from_html(body_html: str, **kwargs) -> bytes:
+            with lock:
+                state["calls"].append((body_html, kwargs))
+                state["in_flight"] += 1
+                state["most_in_flight"] = max(state["most_in_flight"], state["in_flight"])
+            try:
+                # Later documents finish first, so results complete out of order
+                time.sleep(0.05 if body_html.endswith("0") else 0.01)
+                if body_html == "fail":
+                    raise utils.SplatPDFGenerationFailure("Error returned from splat")
+                return f"%PDF {body_html}".encode()
+            finally:
+                with lock:
+                    state["in_flight"] -= 1
+
+        monkeypatch.setattr(utils, "pdf_from_html", pdf_from_html)
+        return state
+
+    def test_results_match_documents_by_index(self, rendering):
+        documents = [f"doc {n}" for n in range(10)]
+        results = list(utils.pdf_from_html_many(documents, max_concurrency=4))
+        assert sorted(result.index for result in results) == list(range(10))
+        assert all(result.pdf == f"%PDF {documents[result.index]}".encode() for result in results)
+
+    def test_a_failing_document_is_reported_without_cancelling_the_others(self, rendering):
+        results = {result.index: result for result in utils.pdf_from_html_many(["doc 0", "fail", "doc 2"])}
+        assert isinstance(results[1].error, utils.SplatPDFGenerationFailure) and results[1].pdf is None
+        assert results[0].pdf == b"%PDF doc 0" and results[2].pdf == b"%PDF doc 2"
+
+    def test_no_more_than_max_concurrency_documents_render_at_once(self, rendering):
+        list(utils.pdf_from_html_many((f"doc {n}" for n in range(20)), max_concurrency=3))
+        assert rendering["most_in_flight"] == 3
+        assert len(rendering["calls"]) == 20
+
+    def test_document_options_override_the_defaults(self, rendering):
+        documents = ["doc 0", {"body_html": "doc 1", "s3_filepath": "1.pdf", "bucket_name": "other"}]
+        list(utils.pdf_from_html_many(documents, bucket_name="bucket", javascript=True))
+        calls = dict(rendering["calls"])
+        assert calls["doc 0"]["bucket_name"] == "bucket" and calls["doc 0"]["javascript"] is True
+        assert calls["doc 1"]["bucket_name"] == "other" and calls["doc 1"]["s3_filepath"] == "1.pdf"
+
+    def test_unknown_document_options_are_reported(self, rendering):
+        [result] = utils.pdf_from_html_many([{"body_html": "doc 0", "colour": "red"}])
+        assert "colour" in str(result.error)
+
+
+class FakeS3Client:
+    """Keeps objects in memory, and presigns urls naming the key"""
+
+    def __init__(self) -> None:
+        self.objects: dict[tuple[str, str], dict] = {}
+        self.calls: list[tuple[str, str]] = []
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        self.calls.append(("head_object", Key))
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return self.objects[(Bucket, Key)]
+
+    def put_object(self, Bucket: str, Key: str, **kwargs) -> None:
+        self.calls.append(("put_object", Key))
+        self.objects[(Bucket, Key)] = {**kwargs, "LastModified": datetime.datetime.now(datetime.UTC)}
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        self.calls.append(("get_object", Key))
+        return self.objects[(Bucket, Key)]
+
+    def generate_presigned_url(self, operation_name: str, Params: dict, ExpiresIn: int) -> str:
+        return f"https://s3/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+
+class TestShareAssets:
+    logo = os.urandom(16 * 1024)
+    data_uri = f"data:image/png;base64,{base64.b64encode(logo).decode()}"
+
+    @pytest.fixture(autouse=True)
+    def asset_index(self) -> Iterator[None]:
+        assets.asset_index.clear()
+        yield
+        assets.asset_index.clear()
+
+    def test_large_data_uris_are_replaced_by_presigned_urls(self):
+        s3_client = FakeS3Client()
+        body_html = f'<img src="{self.data_uri}"><img src="data:image/png;base64,AAAA">'
+        shared = assets.share_assets(s3_client, "bucket", body_html, expires_in=60)
+        key = f"splat-assets/{hashlib.sha256(self.logo).hexdigest()}.png"
+        assert shared == f'<img src="https://s3/bucket/{key}?expires={assets.ASSET_URL_EXPIRY}">' + (
+            '<img src="data:image/png;base64,AAAA">'
+        )
+        assert s3_client.objects[("bucket", key)]["Body"] == self.logo
+        assert s3_client.objects[("bucket", key)]["Tagging"] == config.default_tagging
+
+    def test_an_asset_is_uploaded_once(self):
+        s3_client = FakeS3Client()
+        assets.share_assets(s3_client, "bucket", f'<img src="{self.data_uri}"><img src="{self.data_uri}">', 60)
+        assets.share_assets(s3_client, "bucket", f'<img src="{self.data_uri}">', 60)
+        assert [call for call, _ in s3_client.calls] == ["head_object", "put_object"]
+
+    def test_an_asset_already_in_the_bucket_is_not_uploaded_again(self):
+        s3_client = FakeS3Client()
+        assets.share_assets(s3_client, "bucket", self.data_uri, 60)
+        assets.asset_index.clear()  # e.g. another process
+        assets.share_assets(s3_client, "bucket", self.data_uri, 60)
+        assert [call for call, _ in s3_client.calls] == ["head_object", "put_object", "head_object"]
+
+    def test_an_asset_in_use_is_uploaded_again_once_old_so_it_doesnt_expire(self):
+        s3_client = FakeS3Client()
+        assets.share_assets(s3_client, "bucket", self.data_uri, 60)
+        [uploaded] = s3_client.objects.values()
+        uploaded["LastModified"] -= datetime.timedelta(seconds=assets.ASSET_REFRESH_AGE + 1)
+        assets.asset_index.clear()
+        assets.share_assets(s3_client, "bucket", self.data_uri, 60)
+        assert [call for call, _ in s3_client.calls].count("put_object") == 2
+
+    def test_invalid_base64_is_left_alone(self):
+        body_html = f'<img src="{self.data_uri[:-5]}!!!!!">'
+        s3_client = FakeS3Client()
+        assert assets.share_assets(s3_client, "bucket", body_html, 60) == body_html
+        assert not s3_client.calls
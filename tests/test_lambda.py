@@ -0,0 +1,241 @@
+import email.utils
+import json
+import os
+import sys
+import threading
+import time
+from collections.abc import Iterator
+
+import pytest
+import requests
+
+# The lambda's own dependencies (lambda_requirements.txt) aren't those of the client
+pytest.importorskip("pydantic")
+
+import lambda_function  # noqa: E402
+
+
+class TestWorkspace:
+    def test_clean_up_removes_orphaned_workspaces_but_not_active_ones(self, tmp_path):
+        workspace = lambda_function.Workspace(str(tmp_path / "workspaces"), max_bytes=2**62, caches=())
+        orphan = tmp_path / "workspaces" / "orphan"
+        orphan.mkdir(parents=True)
+
+        with workspace.invocation() as path:
+            # Another invocation finishing while this one renders
+            workspace.clean()
+            assert os.path.isdir(path)
+            assert not orphan.exists()
+        assert not os.path.exists(path)
+
+    def test_a_workspace_is_active_as_soon_as_it_exists(self, tmp_path, monkeypatch):
+        workspace = lambda_function.Workspace(str(tmp_path / "workspaces"), max_bytes=2**62, caches=())
+        makedirs = os.makedirs
+
+        def makedirs_then_clean(path: str, **kwargs) -> None:
+            makedirs(path, **kwargs)
+            # Another invocation finishing between this one creating its workspace and using it
+            workspace.clean()
+
+        monkeypatch.setattr(lambda_function.os, "makedirs", makedirs_then_clean)
+        with workspace.invocation() as path:
+            assert os.path.isdir(path)
+
+
+class TestAssetCache:
+    def test_expires_without_a_date_is_measured_from_now(self, tmp_path):
+        asset_cache = lambda_function.AssetCache(str(tmp_path), max_bytes=2**20, default_ttl=60)
+        expires = email.utils.formatdate(time.time() + 60 * 60, usegmt=True)
+        lifetime = asset_cache.freshness_lifetime(200, {"expires": expires})
+        assert lifetime is not None and 3500 < lifetime <= 3600
+
+    def test_responses_to_credentialed_requests_are_only_stored_when_shareable(self, tmp_path):
+        asset_cache = lambda_function.AssetCache(str(tmp_path), max_bytes=2**20, default_ttl=60)
+        assert asset_cache.freshness_lifetime(200, {"cache-control": "max-age=60"}, credentialed=True) is None
+        assert asset_cache.freshness_lifetime(200, {"cache-control": "public, max-age=60"}, credentialed=True) == 60
+
+
+class TestRenderCache:
+    @pytest.fixture
+    def renders(self) -> list[bytes]:
+        return []
+
+    @pytest.fixture
+    def render(self, tmp_path, monkeypatch, renders):
+        """Renders with a fake playwright, which fails a request whenever the document asks it to"""
+        render_cache = lambda_function.RenderCache(str(tmp_path / "renders"), max_bytes=2**20)
+        monkeypatch.setattr(lambda_function, "render_cache", render_cache)
+
+        def playwright_page_to_pdf(browser_url: str, *args) -> bytes:
+            with open(browser_url.removeprefix("file://"), "rb") as f:
+                document = f.read()
+            if b"missing" in document:
+                lambda_function.current_report().requests_failed += 1
+            renders.append(document)
+            return b"%PDF-" + document
+
+        def render(**payload) -> bytes | str:
+            token = lambda_function._render_report.set(lambda_function.RenderReport())
+            try:
+                payload = lambda_function.Payload(renderer="playwright", **payload)
+                return lambda_function.render_html(payload, payload.document_content.encode(), str(tmp_path / "out"))
+            finally:
+                lambda_function._render_report.reset(token)
+
+        monkeypatch.setattr(lambda_function, "playwright_page_to_pdf", playwright_page_to_pdf)
+        monkeypatch.setattr(lambda_function, "scratch_dir", lambda: str(tmp_path))
+        return render
+
+    def test_renders_are_only_cached_when_asked(self, render, renders):
+        render(document_content="<h1>Z</h1>")
+        render(document_content="<h1>Z</h1>")
+        assert len(renders) == 2
+
+        render(document_content="<h1>Z</h1>", cache=True)
+        assert render(document_content="<h1>Z</h1>", cache=True) == b"%PDF-<h1>Z</h1>"
+        assert len(renders) == 3
+
+    def test_renders_missing_assets_are_not_cached(self, render, renders):
+        render(document_content='<img src="missing.png">', cache=True)
+        render(document_content='<img src="missing.png">', cache=True)
+        assert len(renders) == 2
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, content: bytes = b"") -> None:
+        self.status_code = status_code
+        self.content = content
+        self.headers = requests.structures.CaseInsensitiveDict({"Content-Type": "application/xml"})
+
+
+class FakeSession:
+    def __init__(self, responses: dict[str, FakeResponse]) -> None:
+        self.responses = responses
+        self.posted: dict[str, list] = {}
+
+    def post(self, url: str, data: dict, files: dict, timeout: float) -> FakeResponse:
+        _, content, *_ = files["file"]
+        self.posted.setdefault(url, []).append(content if isinstance(content, str) else content.read())
+        return self.responses[url]
+
+
+class TestStatus:
+    def test_failing_to_deliver_to_a_presigned_url_leaves_a_failure_status(self, monkeypatch):
+        session = FakeSession(
+            {
+                "https://s3/pdf": FakeResponse(403, b"<Error><Code>AccessDenied</Code></Error>"),
+                "https://s3/status": FakeResponse(204),
+            }
+        )
+        monkeypatch.setattr(lambda_function, "http_session", lambda: session)
+        monkeypatch.setattr(lambda_function, "init", lambda: None)
+        monkeypatch.setattr(lambda_function, "create_pdf", lambda payload, output_filepath: b"%PDF-1.4")
+
+        body = {
+            "document_content": "<p>hi</p>",
+            "presigned_url": {"url": "https://s3/pdf", "fields": {"key": "tmp/a.pdf"}},
+            "status_url": {"url": "https://s3/status", "fields": {"key": "tmp/splat-jobs/a.json"}},
+        }
+        resp = lambda_function.lambda_handler({"body": json.dumps(body)}, None)
+
+        assert resp["statusCode"] == 403
+        [status] = session.posted["https://s3/status"]
+        assert json.loads(status)["statusCode"] == 403
+        assert "AccessDenied" in json.loads(status)["body"]
+
+    def test_a_response_that_cant_be_serialised_leaves_a_failure_status(self, monkeypatch):
+        session = FakeSession({"https://s3/status": FakeResponse(204)})
+        monkeypatch.setattr(lambda_function, "http_session", lambda: session)
+
+        circular: list = []
+        circular.append(circular)
+        lambda_function.post_status({"url": "https://s3/status", "fields": {}}, {"statusCode": 201, "body": circular})
+        [status] = session.posted["https://s3/status"]
+        assert json.loads(status)["statusCode"] == 500
+
+
+class TestBatches:
+    def test_playwright_items_render_concurrently_on_the_warm_browser(self, monkeypatch):
+        rendered: list[tuple[int, str | None]] = []
+        closed: list[str] = []
+
+        class FakeBrowserManager:
+            def endpoint(self, browser_launch_kwargs: dict) -> str:
+                return "http://127.0.0.1:9222"
+
+            def close(self) -> None:
+                closed.append(threading.current_thread().name)
+
+        def render_batch_item(index: int, payload) -> dict:
+            time.sleep(0.2)
+            endpoints = lambda_function._browser_endpoints.get() or {}
+            rendered.append((index, endpoints.get(lambda_function.browser_key(payload.browser_launch_kwargs))))
+            return {"index": index, "statusCode": 201}
+
+        monkeypatch.setattr(lambda_function, "browser_manager", FakeBrowserManager)
+        monkeypatch.setattr(lambda_function, "_render_batch_item", render_batch_item)
+        monkeypatch.setattr(lambda_function, "BATCH_MAX_WORKERS", 4)
+
+        started = time.monotonic()
+        body = {"items": [{"renderer": "playwright", "document_content": "<p>hi</p>"} for _ in range(4)]}
+        response = lambda_function.handle_batch(body)
+
+        assert time.monotonic() - started < 0.6
+        assert [item["index"] for item in json.loads(response.body)["items"]] == [0, 1, 2, 3]
+        assert sorted(rendered) == [(index, "http://127.0.0.1:9222") for index in range(4)]
+        # Each worker disconnects from the shared browser once the batch is done
+        assert len(closed) == 4 and threading.current_thread().name not in closed
+
+
+# Echoes the html back as the "pdf", from the command line or over prince's control protocol
+FAKE_PRINCE = """\
+import sys
+
+if "--control" in sys.argv:
+    def write(tag, data):
+        sys.stdout.buffer.write(tag + b" " + str(len(data)).encode() + b"\\n" + data + b"\\n")
+        sys.stdout.buffer.flush()
+
+    def read():
+        tag, length = sys.stdin.buffer.readline().split()
+        data = sys.stdin.buffer.read(int(length))
+        sys.stdin.buffer.read(1)
+        return tag, data
+
+    write(b"ver", b"fake")
+    while (chunk := read())[0] != b"end":
+        write(b"pdf", b"%PDF-" + read()[1])
+        write(b"log", b"fin|success\\n")
+else:
+    sys.stdout.buffer.write(b"%PDF-" + sys.stdin.buffer.read())
+"""
+
+
+class TestPrince:
+    @pytest.fixture(autouse=True)
+    def prince(self, tmp_path, monkeypatch) -> Iterator[None]:
+        prince = tmp_path / "prince"
+        prince.write_text(f"#!{sys.executable}\n{FAKE_PRINCE}")
+        prince.chmod(0o755)
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(lambda_function, "IN_MEMORY_RENDER_MAX_BYTES", 1024)
+        prince_workers = lambda_function.PrinceWorkerPool(1)
+        monkeypatch.setattr(lambda_function, "prince_workers", prince_workers)
+        yield
+        prince_workers.close()
+
+    @pytest.mark.parametrize("control", [False, True])
+    def test_small_pdfs_are_kept_in_memory(self, monkeypatch, tmp_path, control):
+        monkeypatch.setattr(lambda_function, "PRINCE_CONTROL_ENABLED", control)
+        pdf = lambda_function.prince_handler(b"<p>hi</p>", str(tmp_path / "out.pdf"))
+        assert pdf == b"%PDF-<p>hi</p>"
+
+    @pytest.mark.parametrize("control", [False, True])
+    def test_pdfs_that_outgrow_memory_are_written_to_the_output_file(self, monkeypatch, tmp_path, control):
+        monkeypatch.setattr(lambda_function, "PRINCE_CONTROL_ENABLED", control)
+        monkeypatch.setattr(lambda_function, "prince_workers", lambda_function.PrinceWorkerPool(1))
+        # Small enough to send in memory, but the "pdf" is a little larger
+        document = b"x" * 1020
+        pdf = lambda_function.prince_handler(document, str(tmp_path / "out.pdf"))
+        assert pdf == str(tmp_path / "out.pdf")
+        assert (tmp_path / "out.pdf").read_bytes() == b"%PDF-" + document
@@ -1,5 +1,9 @@
 import base64
+import gzip
 import json
+import os
+import struct
+import zlib
 from typing import Any
 from uuid import uuid4
 
@@ -29,6 +33,17 @@ def get_s3_client() -> Any:
     )
 
 
+def random_png(width: int, height: int) -> bytes:
+    """Returns an rgb png of random pixels, stored uncompressed"""
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    rows = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 0)) + chunk(b"IEND", b"")
+
+
 def call_lamdba(body: dict, raise_exception=True) -> tuple[int, dict, bytes]:
     response = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60)
     if raise_exception:
@@ -131,6 +146,35 @@ class TestDeliveryMechanisms:
         assert status_code == 200
         assert b"Z" in pdf_bytes
 
+    def test_generating_pdf_from_gzipped_document_content(self):
+        document_content = base64.b64encode(gzip.compress(b"<h1>Z</h1>")).decode("ascii")
+        status_code, _, pdf_bytes = call_lamdba(
+            {"document_content": document_content, "document_content_encoding": "gzip+base64"},
+        )
+        assert status_code == 200
+        assert b"Z" in pdf_bytes
+
+    def test_pdfs_too_large_to_return_are_spilled_to_s3(self):
+        s3_client = get_s3_client()
+        # Random pixels don't compress, so the pdf is as large as the image
+        image = base64.b64encode(random_png(1600, 1600)).decode("ascii")
+        key = gen_temp_key()
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=f'<img src="data:image/png;base64,{image}">')
+        document_url = s3_client.generate_presigned_url("get_object", Params={"Bucket": BUCKET_NAME, "Key": key})
+
+        response = requests.post(LAMBDA_URL, json={"body": json.dumps({"document_url": document_url})}, timeout=120)
+        data = response.json()
+        body = json.loads(data["body"])
+
+        assert data["statusCode"] == 303
+        assert data["headers"]["Location"] == body["presigned_url"]
+        assert body["bucket"] == BUCKET_NAME
+        assert body["key"].startswith("spill/")
+        pdf_bytes = requests.get(data["headers"]["Location"], timeout=60).content
+        assert pdf_bytes.startswith(b"%PDF")
+        assert len(pdf_bytes) > 5.5 * 1024 * 1024
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=body["key"])
+
     def test_storing_pdf_via_bucket_name(self):
         status_code, body, _ = call_lamdba(
             {"document_content": "<h1>Z</h1>", "bucket_name": BUCKET_NAME},
@@ -141,6 +185,102 @@ class TestDeliveryMechanisms:
         assert body["key"].endswith(".pdf")
 
 
+class TestBatches:
+    def test_rendering_a_batch_delivers_every_item(self):
+        s3_client = get_s3_client()
+
+        keys = [gen_temp_key(format="pdf") for _ in range(3)]
+        items = [
+            {
+                "document_content": f"<h1>Z{index}</h1>",
+                "presigned_url": s3_client.generate_presigned_post(BUCKET_NAME, key),
+            }
+            for index, key in enumerate(keys)
+        ]
+
+        status_code, body, _ = call_lamdba({"items": items})
+
+        assert status_code == 200
+        assert [item["statusCode"] for item in body["items"]] == [201, 201, 201]
+        for index, key in enumerate(keys):
+            pdf_bytes = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read()
+            assert f"Z{index}".encode() in pdf_bytes
+
+    def test_batch_item_failures_are_reported_per_item(self):
+        status_code, body, _ = call_lamdba(
+            {
+                "items": [
+                    {"document_content": "<h1>Z</h1>", "bucket_name": BUCKET_NAME},
+                    {"document_content": "<h1>Z</h1>"},
+                ]
+            },
+        )
+
+        assert status_code == 200
+        assert body["items"][0]["statusCode"] == 200
+        assert body["items"][1]["statusCode"] == 400
+
+
+class TestRenderCache:
+    def test_rendering_the_same_document_twice_is_served_from_the_cache(self):
+        body = {"document_content": f"<h1>Z {uuid4()}</h1>", "bucket_name": BUCKET_NAME, "cache": True}
+
+        first = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60).json()
+        second = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60).json()
+
+        assert first["headers"]["X-Splat-Cache"] == "miss"
+        assert second["headers"]["X-Splat-Cache"] == "hit-local"
+
+
+class TestRequestPolicies:
+    def test_blocked_domains_are_not_fetched_by_the_browser(self):
+        body = {
+            "document_content": '<h1>Z</h1><img src="https://tracker.example.com/pixel.gif">',
+            "renderer": "playwright",
+            "browser_blocked_domains": ["example.com"],
+        }
+
+        response = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60).json()
+
+        assert response["statusCode"] == 200
+        assert "blocked=1" in response["headers"]["X-Splat-Requests"]
+
+
+class TestWaitFor:
+    def test_rendering_waits_for_the_page_to_signal_it_is_ready(self):
+        body = {
+            "document_content": "<h1>Z</h1><script>setTimeout(() => { window.__splatReady = true }, 500)</script>",
+            "renderer": "playwright",
+            "wait_for": {"function": "window.__splatReady === true", "function_timeout": 10},
+        }
+
+        response = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60).json()
+
+        assert response["statusCode"] == 200
+        assert "function=" in response["headers"]["X-Splat-Wait"]
+
+
+class TestMetrics:
+    def test_response_breaks_the_render_down_by_stage(self):
+        body = {"document_content": "<h1>Z</h1>"}
+
+        response = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60).json()
+
+        assert response["statusCode"] == 200
+        stages = [metric.split(";")[0] for metric in response["headers"]["Server-Timing"].split(", ")]
+        assert stages == ["init", "parse", "render", "delivery", "total"]
+
+
+class TestOptimize:
+    def test_optimizing_is_timed(self):
+        body = {"document_content": "<h1>Z</h1>", "optimize": "screen"}
+
+        response = requests.post(LAMBDA_URL, json={"body": json.dumps(body)}, timeout=60).json()
+
+        assert response["statusCode"] == 200
+        assert "optimize;dur=" in response["headers"]["Server-Timing"]
+
+
 class TestInputValidation:
     def test_sending_invalid_presigned_url_an_error_is_returned(self):
         status_code, _, _ = call_lamdba(
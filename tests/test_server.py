@@ -0,0 +1,171 @@
+import json
+import queue
+import threading
+import time
+from collections.abc import Iterator
+
+import pytest
+import requests
+
+# The lambda's own dependencies (lambda_requirements.txt) aren't those of the client
+pytest.importorskip("pydantic")
+
+import lambda_function  # noqa: E402
+import server  # noqa: E402
+
+
+class FakeRenders:
+    """Stands in for lambda_handler, holding each render until it's released"""
+
+    def __init__(self) -> None:
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.rendered: list[dict] = []
+
+    def __call__(self, event: dict, context: None) -> dict:
+        self.started.release()
+        assert self.release.wait(5)
+        self.rendered.append(event)
+        return {"statusCode": 200, "body": json.dumps({"name": event["name"]})}
+
+
+@pytest.fixture
+def renders(monkeypatch) -> FakeRenders:
+    fake = FakeRenders()
+    monkeypatch.setattr(lambda_function, "lambda_handler", fake)
+    monkeypatch.setattr(server.RenderPool, "_warm_up", lambda self: True)
+    monkeypatch.setattr(lambda_function.prince_workers, "close", lambda: None)
+    return fake
+
+
+@pytest.fixture
+def pool(renders) -> Iterator[server.RenderPool]:
+    pool = server.RenderPool(workers=1, queue_size=1)
+    yield pool
+    renders.release.set()
+    if any(thread.is_alive() for thread in pool.threads):
+        pool.drain(5)
+
+
+@pytest.fixture
+def url(pool) -> Iterator[str]:
+    httpd = server.SplatServer(("127.0.0.1", 0), pool)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def invoke(url: str, name: str) -> requests.Response:
+    return requests.post(url + server.INVOCATIONS_PATH, json={"name": name}, timeout=5)
+
+
+class TestRenderPool:
+    def test_renders_beyond_the_queue_are_turned_away(self, pool, renders):
+        pool.start(warm=False)
+        rendering = pool.submit({"name": "rendering"})
+        assert renders.started.acquire(timeout=5)
+        queued = pool.submit({"name": "queued"})
+
+        with pytest.raises(queue.Full):
+            pool.submit({"name": "turned away"})
+
+        renders.release.set()
+        assert rendering.result(5)["statusCode"] == 200
+        assert queued.result(5)["statusCode"] == 200
+        assert [event["name"] for event in renders.rendered] == ["rendering", "queued"]
+
+    @pytest.mark.parametrize("warmed_up", [True, False])
+    def test_is_only_ready_once_every_worker_has_warmed_up(self, renders, monkeypatch, warmed_up):
+        monkeypatch.setattr(server.RenderPool, "_warm_up", lambda self: warmed_up)
+        pool = server.RenderPool(workers=2, queue_size=2)
+        assert not pool.ready
+
+        pool.start(warm=True)
+        # Renders still run on workers that failed to warm up, so both are past it once both are rendering
+        futures = [pool.submit({"name": name}) for name in ("first", "second")]
+        assert renders.started.acquire(timeout=5)
+        assert renders.started.acquire(timeout=5)
+        assert pool.ready is warmed_up
+
+        renders.release.set()
+        assert all(future.result(5)["statusCode"] == 200 for future in futures)
+
+        pool.drain(5)
+        assert not pool.ready
+
+    def test_drain_finishes_queued_renders_then_stops_the_workers(self, pool, renders):
+        pool.start(warm=False)
+        rendering = pool.submit({"name": "rendering"})
+        assert renders.started.acquire(timeout=5)
+        queued = pool.submit({"name": "queued"})
+
+        threading.Timer(0.2, renders.release.set).start()
+        pool.drain(5)
+
+        assert rendering.result(0)["statusCode"] == 200
+        assert queued.result(0)["statusCode"] == 200
+        assert not pool.alive
+
+    def test_drain_cancels_renders_still_queued_at_its_deadline(self, pool, renders):
+        pool.start(warm=False)
+        pool.submit({"name": "rendering"})
+        assert renders.started.acquire(timeout=5)
+        queued = pool.submit({"name": "queued"})
+
+        pool.drain(0.1)
+
+        assert queued.cancelled()
+
+
+class TestHandler:
+    def test_renders_are_returned_in_the_response_body(self, pool, renders, url):
+        pool.start(warm=False)
+        renders.release.set()
+
+        response = invoke(url, "doc")
+
+        assert response.status_code == 200
+        assert response.json() == {"statusCode": 200, "body": json.dumps({"name": "doc"})}
+
+    def test_a_full_queue_is_a_503_with_retry_after(self, pool, renders, url):
+        pool.start(warm=False)
+        pending = [threading.Thread(target=invoke, args=(url, name)) for name in ("rendering", "queued")]
+        pending[0].start()
+        assert renders.started.acquire(timeout=5)
+        pending[1].start()
+        while pool.jobs.qsize() < 1:
+            time.sleep(0.01)
+
+        response = invoke(url, "turned away")
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        renders.release.set()
+        for thread in pending:
+            thread.join(5)
+        assert [event["name"] for event in renders.rendered] == ["rendering", "queued"]
+
+    @pytest.mark.parametrize("warmed_up", [True, False])
+    def test_readyz_waits_for_a_successful_warm_up(self, pool, monkeypatch, url, warmed_up):
+        warming = threading.Event()
+        monkeypatch.setattr(server.RenderPool, "_warm_up", lambda self: warming.wait(5) and warmed_up)
+        pool.start(warm=True)
+
+        assert requests.get(url + "/readyz", timeout=5).status_code == 503
+        assert requests.get(url + "/healthz", timeout=5).status_code == 200
+
+        warming.set()
+        pool.submit({"name": "doc"}).cancel()  # Wait for the worker to pass warm up
+        pool.jobs.join()
+        response = requests.get(url + "/readyz", timeout=5)
+        assert response.status_code == (200 if warmed_up else 503)
+        assert response.json() == {"ready": warmed_up}
+
+    def test_draining_turns_away_renders_and_reports_not_ready(self, pool, url):
+        pool.start(warm=False)
+        pool.draining.set()
+
+        assert invoke(url, "doc").status_code == 503
+        assert requests.get(url + "/readyz", timeout=5).status_code == 503
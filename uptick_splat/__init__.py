@@ -1,11 +1,29 @@
-from .config import config, configure_splat
-from .utils import SplatPDFGenerationFailure, pdf_from_html, pdf_from_html_without_s3
+from . import aio, jobs
+from .config import clients, config, configure_splat
+from .utils import (
+    PdfResult,
+    SplatPDFGenerationFailure,
+    pdf_from_html,
+    pdf_from_html_chunks,
+    pdf_from_html_many,
+    pdf_from_html_to_file,
+    pdf_from_html_without_s3,
+    pdf_with_splat,
+)
 
 __all__ = [
+    "aio",
+    "clients",
+    "jobs",
     "config",
     "configure_splat",
     "SplatPDFGenerationFailure",
+    "PdfResult",
     "pdf_from_html",
+    "pdf_from_html_chunks",
+    "pdf_from_html_many",
+    "pdf_from_html_to_file",
     "pdf_from_html_without_s3",
+    "pdf_with_splat",
     "__version__",
 ]
@@ -0,0 +1,182 @@
+"""asyncio counterparts of pdf_from_html, pdf_from_html_without_s3 and pdf_with_splat.
+
+boto3 only has a blocking api, so each step of a render (presign, upload, invoke, download) runs on a shared, bounded
+thread pool (see `configure_splat(max_concurrency=...)`). Renders beyond that limit wait in the pool's queue without a
+thread of their own, so an event loop can have thousands in flight. Cancelling a render, or it timing out, stops it
+at the next step and removes any temporary files it uploaded. A render that has already been handed to splat keeps
+its thread until the invocation returns or its read timeout, the call's timeout rounded up to a power of two, passes.
+The pdf splat uploads for a cancelled render is removed then too, unless splat is still rendering it once the read
+timeout passes; a lifecycle rule on the tmp/ prefix catches those.
+"""
+
+import asyncio
+import base64
+import functools
+import math
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, TypeVar
+from uuid import uuid4
+
+from . import utils
+from .config import config
+from .deleter import deleter
+from .utils import SplatPDFGenerationFailure
+
+T = TypeVar("T")
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool renders run on, recreating it if max_concurrency has been reconfigured"""
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != config.max_concurrency:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=config.max_concurrency, thread_name_prefix="splat")
+        return _executor
+
+
+async def _run(fn: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(fn, *args))
+
+
+def _read_timeout(timeout: float | None) -> float:
+    # Stop waiting on the lambda soon after the caller has given up on it, so the thread is freed for other renders.
+    # Rounded up to a power of two, as each read timeout needs a lambda client of its own
+    if timeout is None:
+        return 60 * 15
+    return min(2 ** math.ceil(math.log2(max(timeout, 1))), 60 * 15)
+
+
+async def pdf_from_html(
+    body_html: str,
+    *,
+    bucket_name: str | None = None,
+    s3_filepath: str | None = None,
+    javascript: bool = False,
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+    timeout: float | None = None,
+) -> bytes | None:
+    """Generates a pdf from html using the splat lambda function. See utils.pdf_from_html.
+
+    :param timeout: seconds to wait for the pdf before raising TimeoutError. defaults to no limit
+    """
+    bucket_name = bucket_name or config.default_bucket_name
+    if not bucket_name:
+        raise SplatPDFGenerationFailure("Invalid configuration: no bucket name provided")
+
+    is_streaming = not bool(s3_filepath)
+    destination_path = s3_filepath or f"tmp/{uuid4()}.pdf"
+
+    async with asyncio.timeout(timeout):
+        s3_client = await _run(utils.get_s3_client)
+        presigned_url = await _run(
+            utils.presign_destination, s3_client, bucket_name, destination_path, fields, conditions
+        )
+        tmp_html_key, document_url = await _run(utils.upload_html, s3_client, bucket_name, body_html)
+        step: Future | None = None
+        try:
+            try:
+                lambda_client = await _run(utils.get_lambda_client, _read_timeout(timeout))
+                step = get_executor().submit(
+                    utils.invoke,
+                    lambda_client,
+                    {"document_url": document_url, "presigned_url": presigned_url, "javascript": javascript},
+                )
+                splat_response = await asyncio.wrap_future(step)
+            finally:
+                # Remove the temporary html file from s3, even when cancelled
+                deleter(bucket_name, tmp_html_key)
+
+            # ==== Success ====
+            if splat_response.get("statusCode") == 201:
+                if is_streaming:
+                    step = get_executor().submit(utils.download, s3_client, bucket_name, destination_path)
+                    return await asyncio.wrap_future(step)
+                return None
+        except asyncio.CancelledError:
+            # Splat uploads the pdf once it's rendered, whether or not anyone is still waiting for it. The step in
+            # flight carries on in its thread, so the temporary pdf is removed once that's done
+            if is_streaming and step is not None:
+                step.add_done_callback(lambda _: deleter(bucket_name, destination_path))
+            raise
+        # ==== Failure ====
+        utils.raise_for_error(splat_response)
+
+
+async def pdf_from_html_without_s3(
+    body_html: str,
+    javascript: bool = False,
+    compress: bool = False,
+    *,
+    timeout: float | None = None,
+) -> bytes:
+    """Generates a pdf from html without using s3. See utils.pdf_from_html_without_s3.
+
+    :param timeout: seconds to wait for the pdf before raising TimeoutError. defaults to no limit
+    """
+    async with asyncio.timeout(timeout):
+        splat_body = await _run(utils.document_content_body, body_html, javascript, compress)
+        return await _pdf_from_splat_body(splat_body, timeout)
+
+
+async def _pdf_from_splat_body(splat_body: dict, timeout: float | None) -> bytes:
+    lambda_client = await _run(utils.get_lambda_client, _read_timeout(timeout))
+    return await _pdf_from_splat_response(await _run(utils.invoke, lambda_client, splat_body))
+
+
+async def _pdf_from_splat_response(splat_response: dict) -> bytes:
+    # ==== Success ====
+    if splat_response.get("statusCode") == 200:
+        return base64.b64decode(splat_response.get("body"))
+    # Too large to return, splat uploaded it to its spill bucket instead
+    elif splat_response.get("statusCode") == 303:
+        s3_client = await _run(utils.get_s3_client)
+        return await _run(utils.download, s3_client, *utils.spilled_location(splat_response))
+    # ==== Failure ====
+    utils.raise_for_error(splat_response)
+
+
+async def pdf_with_splat(
+    body_html: str,
+    *,
+    bucket_name: str | None = None,
+    s3_filepath: str | None = None,
+    javascript: bool = False,
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+    compress: bool = True,
+    timeout: float | None = None,
+) -> bytes | None:
+    """Generates a pdf from html, sending it inline or via s3. See utils.pdf_with_splat.
+
+    :param timeout: seconds to wait for the pdf before raising TimeoutError. defaults to no limit
+    """
+    bucket_name = bucket_name or config.default_bucket_name
+    async with asyncio.timeout(timeout):
+        splat_body = await _run(
+            utils.inline_splat_body, body_html, bucket_name, s3_filepath, javascript, fields, conditions, compress
+        )
+        if splat_body is not None:
+            lambda_client = await _run(utils.get_lambda_client, _read_timeout(timeout))
+            splat_response = await _run(utils.invoke, lambda_client, splat_body)
+            # ==== Saved to s3_filepath ====
+            if s3_filepath and splat_response.get("statusCode") == 201:
+                return None
+            if not (utils.pdf_too_large(splat_response) and bucket_name):
+                return await _pdf_from_splat_response(splat_response)
+        return await pdf_from_html(
+            body_html,
+            bucket_name=bucket_name,
+            s3_filepath=s3_filepath,
+            javascript=javascript,
+            fields=fields,
+            conditions=conditions,
+            timeout=timeout,
+        )
@@ -0,0 +1,110 @@
+"""Sharing of heavy assets between documents.
+
+Logos, fonts and stylesheets inlined into html as base64 `data:` uris are usually identical across a run of documents.
+With `configure_splat(share_assets=True)`, the large ones are uploaded once under a key named by the sha256 of their
+content, and each document refers to them by a presigned url instead. Only the variable content of each document is
+then uploaded, and splat's asset cache serves the shared assets without fetching them again. Assets are tagged with
+config.default_tagging like the html, and uploaded again daily while in use, so a lifecycle rule expiring that tag
+removes only the assets no longer used.
+"""
+
+import base64
+import binascii
+import hashlib
+import mimetypes
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from botocore.exceptions import ClientError
+
+from .config import config
+
+ASSET_PREFIX = "splat-assets/"
+# Smaller data: uris cost less inline than as a request of their own
+ASSET_MIN_BYTES = 8 * 1024
+ASSET_URL_EXPIRY = 6 * 60 * 60  # seconds
+# How long an asset is assumed to still exist after checking, e.g. in case a lifecycle rule has since removed it
+ASSET_INDEX_TTL = 60 * 60  # seconds
+# Assets still in use are uploaded again once they're this old, so the lifecycle rule expiring config.default_tagging
+# only removes those no longer used
+ASSET_REFRESH_AGE = 24 * 60 * 60  # seconds
+CACHE_CONTROL = "max-age=31536000, immutable"
+DATA_URI_RE = re.compile(r"data:([\w.+-]+/[\w.+-]+)(?:;[\w.+-]+=[\w.+-]+)*;base64,([A-Za-z0-9+/]+={0,2})")
+
+
+@dataclass
+class SharedAsset:
+    checked_at: float
+    url: str | None = None
+    url_expires_at: float = 0
+
+
+class AssetIndex:
+    """The assets this process has uploaded or found already uploaded, and presigned urls to them"""
+
+    def __init__(self) -> None:
+        self._assets: dict[tuple[str, str], SharedAsset] = {}
+        self._lock = threading.Lock()
+
+    def url(self, s3_client: Any, bucket_name: str, content_type: str, content: bytes, expires_in: int) -> str:
+        """Returns a presigned url valid for at least expires_in seconds to the shared copy of content"""
+        key = f"{ASSET_PREFIX}{hashlib.sha256(content).hexdigest()}{mimetypes.guess_extension(content_type) or ''}"
+        now = time.time()
+        with self._lock:
+            asset = self._assets.get((bucket_name, key))
+        if asset is None or now - asset.checked_at > ASSET_INDEX_TTL:
+            upload_asset(s3_client, bucket_name, key, content_type, content)
+            asset = SharedAsset(checked_at=now)
+        # Urls are reused until they'd expire before the document's own
+        if asset.url is None or asset.url_expires_at - now < expires_in:
+            asset.url = s3_client.generate_presigned_url(
+                "get_object", Params={"Bucket": bucket_name, "Key": key}, ExpiresIn=max(ASSET_URL_EXPIRY, expires_in)
+            )
+            asset.url_expires_at = now + max(ASSET_URL_EXPIRY, expires_in)
+        with self._lock:
+            self._assets[(bucket_name, key)] = asset
+        return asset.url
+
+    def clear(self) -> None:
+        with self._lock:
+            self._assets.clear()
+
+
+asset_index = AssetIndex()
+
+
+def upload_asset(s3_client: Any, bucket_name: str, key: str, content_type: str, content: bytes) -> None:
+    """Uploads an asset unless it's already in the bucket, and was uploaded within ASSET_REFRESH_AGE"""
+    try:
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        if time.time() - head["LastModified"].timestamp() < ASSET_REFRESH_AGE:
+            return
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in {"404", "NoSuchKey"}:
+            raise
+    s3_client.put_object(
+        Body=content,
+        Bucket=bucket_name,
+        Key=key,
+        ContentType=content_type,
+        CacheControl=CACHE_CONTROL,
+        Tagging=config.default_tagging,
+    )
+
+
+def share_assets(s3_client: Any, bucket_name: str, body_html: str, expires_in: int) -> str:
+    """Replaces the large base64 data: uris in body_html with presigned urls to shared copies of them"""
+
+    def replace(match: re.Match) -> str:
+        if len(match.group(0)) < ASSET_MIN_BYTES:
+            return match.group(0)
+        try:
+            content = base64.b64decode(match.group(2), validate=True)
+        except binascii.Error:
+            return match.group(0)
+        return asset_index.url(s3_client, bucket_name, match.group(1).lower(), content, expires_in)
+
+    return DATA_URI_RE.sub(replace, body_html)
@@ -1,17 +1,27 @@
+import threading
+from collections import OrderedDict
 from collections.abc import Callable
 from dataclasses import dataclass
 from typing import Any
 from uuid import uuid4
 
 import boto3
+from botocore.config import Config as BotocoreConfig
 
 from .logging import logger
 
+_session: Any = None
+_session_lock = threading.Lock()
+
 
 def get_session() -> Any:
-    """This function can be overridden to provide a custom session"""
-    session = boto3.session.Session()
-    return session
+    """This function can be overridden to provide a custom session. The default session is shared, so that the
+    clients created from it are reused (see ClientCache)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
 
 
 def get_tmp_html_key() -> str:
@@ -21,16 +31,69 @@ def get_tmp_html_key() -> str:
 
 def delete_key(bucket_name: str, path: str) -> None:
     """This function can be overriden to provide a custom delete key function"""
-    global config
-    session = config.get_session_fn()
-    s3_client = session.client("s3")
+    s3_client = clients.get("s3")
     try:
         s3_client.delete_object(Bucket=bucket_name, Key=path)
     except Exception as e:  # noqa
         logger.warning(f"Failed to delete {path} from s3: {e}")
 
 
-def configure_splat(
+class ClientCache:
+    """boto3 clients shared between renders, keyed on the session, service, region and client config.
+
+    Clients are thread safe, and reusing one reuses its endpoint resolution and pooled connections rather than paying
+    for them on every pdf. The session function is still called for every client, and a client is only reused while
+    it returns the same session, so a session function that returns a new session (e.g. with fresh credentials) each
+    call gets a new client each call. The max_clients least recently used are kept.
+    """
+
+    def __init__(self, max_clients: int = 32) -> None:
+        self.max_clients = max_clients
+        self._clients: OrderedDict[tuple, tuple[Any, Any]] = OrderedDict()  # key -> (session, client)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, service_name: str, region_name: str | None = None, **client_config: Any) -> Any:
+        session = config.get_session_fn()
+        key = (
+            id(session),
+            service_name,
+            region_name,
+            config.max_pool_connections,
+            repr(sorted(client_config.items())),
+        )
+        with self._lock:
+            # The session is kept alongside its client, so its id can't be reused by another session meanwhile
+            if (cached := self._clients.get(key)) is not None and cached[0] is session:
+                self._clients.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            # Sessions aren't thread safe, so clients are created under the lock
+            client = session.client(
+                service_name,
+                region_name=region_name,
+                config=BotocoreConfig(max_pool_connections=config.max_pool_connections, **client_config),
+            )
+            self._clients[key] = (session, client)
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return client
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"clients": len(self._clients), "hits": self.hits, "misses": self.misses}
+
+
+clients = ClientCache()
+
+
+def configure_splat(  # noqa: C901
     function_region: str | None = None,
     function_name: str | None = None,
     default_bucket_name: str | None = None,
@@ -38,6 +101,9 @@ def configure_splat(
     get_session_fn: Callable[[], Any] | None = None,
     get_tmp_html_key_fn: Callable[[str], str] | None = None,
     delete_key_fn: Callable[[str, str], None] | None = None,
+    max_concurrency: int | None = None,
+    max_pool_connections: int | None = None,
+    share_assets: bool | None = None,
 ):
     """Configure the splat function.
 
@@ -45,8 +111,12 @@ def configure_splat(
     :param function_name: the name of the splat function
     :param default_bucket_name: the default bucket name to store html uploaded to s3
     :param default_tagging: the default tag to apply to html uploaded to s3
-    :param get_session_fn: a function that returns a boto3 session
+    :param get_session_fn: a function that returns a boto3 session, called for every client. clients are only reused
+        while it returns the same session
     :param default_key_delete_fn: a function that deletes a key from s3
+    :param max_concurrency: the number of threads the asyncio api (uptick_splat.aio) runs renders on
+    :param max_pool_connections: the number of connections each cached boto3 client keeps open
+    :param share_assets: upload large base64 data: uris once and refer to them by url, see uptick_splat.assets
     """
     global config
     if function_region is not None:
@@ -59,10 +129,18 @@ def configure_splat(
         config.default_tagging = default_tagging
     if get_session_fn is not None:
         config.get_session_fn = get_session_fn
+        clients.clear()
     if get_tmp_html_key_fn is not None:
         config.get_tmp_html_key_fn = get_tmp_html_key_fn
     if delete_key_fn is not None:
         config.delete_key_fn = delete_key_fn
+    if max_concurrency is not None:
+        config.max_concurrency = max_concurrency
+    if max_pool_connections is not None:
+        config.max_pool_connections = max_pool_connections
+        clients.clear()
+    if share_assets is not None:
+        config.share_assets = share_assets
 
 
 @dataclass
@@ -76,6 +154,10 @@ class Config:
     get_tmp_html_key_fn: Callable[[str], str]
     delete_key_fn: Callable[[str, str], None]
 
+    max_concurrency: int
+    max_pool_connections: int
+    share_assets: bool
+
 
 configure_splat()
 
@@ -87,4 +169,8 @@ config = Config(
     get_session_fn=get_session,
     get_tmp_html_key_fn=get_tmp_html_key,
     delete_key_fn=delete_key,
+    max_concurrency=64,
+    # Enough for every thread of the asyncio api to hold a connection at once
+    max_pool_connections=64,
+    share_assets=False,
 )
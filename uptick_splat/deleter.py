@@ -0,0 +1,108 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+
+from .config import clients, config, delete_key
+from .logging import logger
+
+
+class BackgroundDeleter:
+    """Deletes temporary files off the caller's thread.
+
+    Keys are queued, then deleted with delete_objects up to 1000 (its limit) at a time, once that many are queued or
+    the oldest has waited flush_interval seconds. Keys that fail are retried with the next batch, up to max_attempts
+    times. Anything still queued is deleted when the interpreter exits. A custom config.delete_key_fn is called for
+    each key instead, on the same thread.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, flush_interval: float = 1, max_attempts: int = 3) -> None:
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._keys: dict[str, list[tuple[str, int]]] = defaultdict(list)  # bucket -> [(key, attempts)]
+        self._queued = 0
+        self._oldest: float | None = None
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def __call__(self, bucket_name: str, key: str) -> None:
+        self._add(bucket_name, key, 0)
+
+    def _add(self, bucket_name: str, key: str, attempts: int) -> None:
+        with self._condition:
+            self._keys[bucket_name].append((key, attempts))
+            self._queued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="splat-deleter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            # Wake the thread to time the flush of a queue that was empty, or to flush a full batch now
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._condition.notify()
+            elif self._queued >= self.BATCH_SIZE:
+                self._condition.notify()
+
+    def flush(self) -> None:
+        """Deletes everything queued now, retrying failures until they succeed or run out of attempts"""
+        while batches := self._take():
+            self._delete_batches(batches)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._due():
+                    timeout = None if self._oldest is None else self._oldest + self.flush_interval - time.monotonic()
+                    self._condition.wait(timeout)
+            if batches := self._take():
+                self._delete_batches(batches)
+
+    def _due(self) -> bool:
+        if self._oldest is None:
+            return False
+        return self._queued >= self.BATCH_SIZE or time.monotonic() >= self._oldest + self.flush_interval
+
+    def _take(self) -> dict[str, list[tuple[str, int]]]:
+        with self._condition:
+            batches, self._keys = self._keys, defaultdict(list)
+            self._queued = 0
+            self._oldest = None
+        return batches
+
+    def _delete_batches(self, batches: dict[str, list[tuple[str, int]]]) -> None:
+        for bucket_name, keys in batches.items():
+            for start in range(0, len(keys), self.BATCH_SIZE):
+                self._delete(bucket_name, keys[start : start + self.BATCH_SIZE])
+
+    def _delete(self, bucket_name: str, keys: list[tuple[str, int]]) -> None:
+        if config.delete_key_fn is not delete_key:
+            for key, attempts in keys:
+                try:
+                    config.delete_key_fn(bucket_name, key)
+                except Exception as e:  # noqa
+                    self._retry(bucket_name, key, attempts, e)
+            return
+
+        try:
+            response = clients.get("s3").delete_objects(
+                Bucket=bucket_name, Delete={"Objects": [{"Key": key} for key, _ in keys], "Quiet": True}
+            )
+        except Exception as e:  # noqa
+            for key, attempts in keys:
+                self._retry(bucket_name, key, attempts, e)
+            return
+        errors = {error.get("Key"): error.get("Message") for error in response.get("Errors", [])}
+        for key, attempts in keys:
+            if key in errors:
+                self._retry(bucket_name, key, attempts, errors[key])
+
+    def _retry(self, bucket_name: str, key: str, attempts: int, error: object) -> None:
+        if attempts + 1 >= self.max_attempts:
+            logger.warning(f"Failed to delete {key} from s3: {error}")
+        else:
+            self._add(bucket_name, key, attempts + 1)
+
+
+deleter = BackgroundDeleter()
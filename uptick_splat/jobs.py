@@ -0,0 +1,209 @@
+"""Render jobs: pdfs rendered by asynchronous invocations of splat, which callers check on rather than wait for.
+
+`submit` uploads the html, queues the invocation and returns a `RenderJob` straight away. splat uploads the response
+it would have returned to a status object alongside the pdf once it's done, and a job is done once its status object
+exists. Waiting on many jobs lists the status prefix of the process that submitted them, rather than checking each
+job in turn.
+"""
+
+import json
+import os
+import time
+from collections.abc import Iterable
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from urllib.parse import parse_qsl
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+from botocore.exceptions import ClientError
+
+from . import utils
+from .config import config
+from .deleter import deleter
+from .utils import SplatPDFGenerationFailure
+
+JOB_STATUS_PREFIX = "tmp/splat-jobs/"
+# Asynchronous invocations can sit in lambda's queue before running, so their urls outlive those of a direct render
+JOB_URL_EXPIRY = 60 * 60  # seconds
+POLL_INTERVAL = 1  # seconds
+MAX_POLL_INTERVAL = 10  # seconds
+
+
+@dataclass(eq=False)
+class RenderJob:
+    """A pdf being rendered by splat. Only `result` removes the job's temporary files."""
+
+    id: str
+    bucket_name: str
+    key: str  # of the pdf
+    html_key: str
+    is_streaming: bool  # the pdf is returned by result rather than left at key
+    status_prefix: str = JOB_STATUS_PREFIX
+    _done: bool = field(default=False, repr=False)
+
+    @property
+    def status_key(self) -> str:
+        return f"{self.status_prefix}{self.id}.json"
+
+    def done(self) -> bool:
+        """Whether splat has finished the job, successfully or not"""
+        if not self._done:
+            try:
+                utils.get_s3_client().head_object(Bucket=self.bucket_name, Key=self.status_key)
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in {"404", "NoSuchKey"}:
+                    raise
+            else:
+                self._done = True
+        return self._done
+
+    def result(self, timeout: float | None = None) -> bytes | None:
+        """Waits for the job, then returns the pdf, or None when it was saved to its s3_filepath.
+
+        Raises TimeoutError if it isn't done within timeout seconds, and SplatPDFGenerationFailure if it failed.
+        """
+        done, _ = wait([self], timeout=timeout)
+        if not done:
+            raise TimeoutError(f"Render job {self.id} did not finish within {timeout} seconds")
+
+        s3_client = utils.get_s3_client()
+        status = json.loads(utils.download(s3_client, self.bucket_name, self.status_key))
+        deleter(self.bucket_name, self.html_key)
+        # ==== Success ====
+        if status.get("statusCode") == 201:
+            if self.is_streaming:
+                return utils.download(s3_client, self.bucket_name, self.key)
+            return None
+        # ==== Failure ====
+        utils.raise_for_error(status)
+
+
+def submit(
+    body_html: str,
+    *,
+    bucket_name: str | None = None,
+    s3_filepath: str | None = None,
+    javascript: bool = False,
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+) -> RenderJob:
+    """Starts rendering a pdf from html using the splat lambda function, returning once lambda has queued it.
+
+    Takes the arguments of pdf_from_html. The job's urls expire after an hour, so a job lambda hasn't started by
+    then can't deliver its pdf or its status, and never finishes.
+    """
+    bucket_name = bucket_name or config.default_bucket_name
+    if not bucket_name:
+        raise SplatPDFGenerationFailure("Invalid configuration: no bucket name provided")
+
+    job_id = str(uuid4())
+    destination_path = s3_filepath or f"tmp/{job_id}.pdf"
+    s3_client = utils.get_s3_client()
+    presigned_url = utils.presign_destination(
+        s3_client, bucket_name, destination_path, fields, conditions, JOB_URL_EXPIRY
+    )
+    html_key, document_url = utils.upload_html(s3_client, bucket_name, body_html, JOB_URL_EXPIRY)
+    job = RenderJob(
+        id=job_id,
+        bucket_name=bucket_name,
+        key=destination_path,
+        html_key=html_key,
+        is_streaming=not s3_filepath,
+        status_prefix=_process_status_prefix(),
+    )
+    status_fields = {"Content-Type": "application/json"}
+    if config.default_tagging:
+        status_fields["tagging"] = _tagging_xml(config.default_tagging)
+    status_url = s3_client.generate_presigned_post(
+        bucket_name,
+        job.status_key,
+        ExpiresIn=JOB_URL_EXPIRY,
+        Fields=status_fields,
+        Conditions=[["eq", f"${name}", value] for name, value in status_fields.items()],
+    )
+
+    try:
+        utils.invoke_event(
+            utils.get_lambda_client(read_timeout=60),
+            {
+                "document_url": document_url,
+                "presigned_url": presigned_url,
+                "status_url": status_url,
+                "javascript": javascript,
+            },
+        )
+    except Exception:
+        deleter(bucket_name, html_key)
+        raise
+    return job
+
+
+_status_prefix: tuple[int, str] | None = None
+
+
+def _process_status_prefix() -> str:
+    """Returns the prefix of the status objects of jobs this process submits, under JOB_STATUS_PREFIX"""
+    global _status_prefix
+    # Checked against the pid so that a forked process doesn't share its parent's
+    if _status_prefix is None or _status_prefix[0] != os.getpid():
+        _status_prefix = (os.getpid(), f"{JOB_STATUS_PREFIX}{uuid4()}/")
+    return _status_prefix[1]
+
+
+def _tagging_xml(tagging: str) -> str:
+    """Returns tagging in the query string form put_object takes, e.g. ExpireAfter=1w, as the xml a presigned post
+    takes"""
+    tags = "".join(
+        f"<Tag><Key>{escape(key)}</Key><Value>{escape(value)}</Value></Tag>"
+        for key, value in parse_qsl(tagging, keep_blank_values=True)
+    )
+    return f"<Tagging><TagSet>{tags}</TagSet></Tagging>"
+
+
+def wait(
+    jobs: Iterable[RenderJob], timeout: float | None = None, return_when: str = ALL_COMPLETED
+) -> tuple[set[RenderJob], set[RenderJob]]:
+    """Waits for jobs like concurrent.futures.wait, returning the sets of done and not done jobs.
+
+    Polls by listing each bucket's job statuses, backing off from POLL_INTERVAL to MAX_POLL_INTERVAL seconds.
+
+    :param return_when: FIRST_COMPLETED or ALL_COMPLETED
+    """
+    pending = set(jobs)
+    done = {job for job in pending if job._done}
+    pending -= done
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = POLL_INTERVAL
+    while pending and not (done and return_when == FIRST_COMPLETED):
+        for job in _finished(pending):
+            job._done = True
+            done.add(job)
+            pending.discard(job)
+        if not pending or (done and return_when == FIRST_COMPLETED):
+            break
+        delay = interval if deadline is None else min(interval, deadline - time.monotonic())
+        if delay <= 0:
+            break
+        time.sleep(delay)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    return done, pending
+
+
+def _finished(jobs: set[RenderJob]) -> list[RenderJob]:
+    """Returns the jobs that have a status object"""
+    if len(jobs) == 1:
+        return [job for job in jobs if job.done()]
+
+    finished = []
+    s3_client = utils.get_s3_client()
+    for bucket_name, status_prefix in {(job.bucket_name, job.status_prefix) for job in jobs}:
+        status_keys: set[str] = set()
+        for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket_name, Prefix=status_prefix):
+            status_keys.update(obj["Key"] for obj in page.get("Contents", []))
+        finished.extend(
+            job
+            for job in jobs
+            if job.bucket_name == bucket_name and job.status_prefix == status_prefix and job.status_key in status_keys
+        )
+    return finished
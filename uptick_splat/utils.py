@@ -1,13 +1,34 @@
 import base64
+import gzip
+import itertools
 import json
+import os
 import re
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator, Mapping
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from json import JSONDecodeError
-from typing import cast
+from typing import Any, BinaryIO, NoReturn, cast
 from uuid import uuid4
 
-from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 
-from .config import config
+from .assets import share_assets
+from .config import clients, config
+from .deleter import deleter
+from .logging import metrics
+
+# The options of a document passed to pdf_from_html_many
+PDF_OPTIONS = {"body_html", "bucket_name", "s3_filepath", "javascript", "fields", "conditions"}
+# Lambda's limit on the payload of a synchronous invocation
+INVOKE_PAYLOAD_MAX_BYTES = 6 * 1024 * 1024
+# Part of the error splat returns for a pdf too large to return inline when it has no spill bucket
+PDF_TOO_LARGE_ERROR = "too large to stream back from lambda"
+# Pdfs are downloaded in parts of this size, this many at once
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DOWNLOAD_MAX_CONCURRENCY = 10
 
 
 class SplatPDFGenerationFailure(Exception):
@@ -18,83 +39,97 @@ def strip_dangerous_s3_chars(filename: str) -> str:
     return re.sub(r"[^0-9a-zA-Z_\.\-\s]", "", filename)
 
 
-def pdf_from_html(
-    body_html: str,
-    *,
-    bucket_name: str | None = None,
-    s3_filepath: str | None = None,
-    javascript: bool = False,
-    fields: dict | None = None,
-    conditions: list[list] | None = None,
-) -> bytes | None:
-    """Generates a pdf from html using the splat lambda function.
+def parse_server_timing(header: str) -> dict[str, float]:
+    """Parses a `Server-Timing` header into milliseconds per stage, e.g. `{"render": 812.4, "delivery": 40.1}`"""
+    timings = {}
+    for metric in header.split(","):
+        name, *params = (part.strip() for part in metric.split(";"))
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur" and name:
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
 
-    :param body_html: the html to convert to pdf
-    :param bucket_name: the bucket to upload the html to. defaults to config.default_bucket_name
-    :param s3_filepath: the path to upload the pdf to. defaults to a random path in the bucket
-    :param fields: additional fields to add to the presigned url
-    :param conditions: additional conditions to add to the presigned url
+
+def log_timings(splat_response: dict, invoke_seconds: float) -> dict[str, float]:
+    """Logs the per stage timings splat reported alongside the round trip time of the invocation.
+
+    The round trip less splat's total is the time spent outside of splat, e.g. lambda cold starts and transfer.
     """
-    bucket_name = bucket_name or config.default_bucket_name
-    if not bucket_name:
-        raise SplatPDFGenerationFailure("Invalid configuration: no bucket name provided")
+    headers = splat_response.get("headers") or {}
+    timings = parse_server_timing(headers.get("Server-Timing", ""))
+    timings["invoke"] = invoke_seconds * 1000
+    metrics.info(
+        "splat|timings|" + ",".join(f"{name}={duration:.1f}ms" for name, duration in timings.items()),
+        extra={"splat_timings": timings, "splat_cache": headers.get("X-Splat-Cache")},
+    )
+    return timings
 
-    is_streaming = not bool(s3_filepath)
 
-    session = config.get_session_fn()
-    lambda_client = session.client(
-        "lambda",
-        region_name=config.function_region,
-        config=Config(read_timeout=60 * 15, retries={"max_attempts": 0}),
+def get_lambda_client(read_timeout: float = 60 * 15) -> Any:
+    return clients.get(
+        "lambda", region_name=config.function_region, read_timeout=read_timeout, retries={"max_attempts": 0}
     )
-    s3_client = session.client("s3")
 
-    destination_path = s3_filepath or f"tmp/{uuid4()}.pdf"
-    fields = fields or {}
-    conditions = conditions or []
-
-    presigned_url = s3_client.generate_presigned_post(
-        bucket_name,
-        destination_path,
-        ExpiresIn=5 * 60,  # seconds
-        Fields={
-            "Content-Type": "application/pdf",
-            **fields,
-        },
-        Conditions=[["starts-with", "$Content-Type", "application/pdf"], *conditions],
+
+def get_s3_client() -> Any:
+    return clients.get("s3")
+
+
+def presign_destination(
+    s3_client: Any,
+    bucket_name: str,
+    destination_path: str,
+    fields: dict | None,
+    conditions: list[list] | None,
+    expires_in: int = 5 * 60,  # seconds
+) -> dict:
+    """Returns a presigned post splat can upload the pdf to"""
+    return cast(
+        dict,
+        s3_client.generate_presigned_post(
+            bucket_name,
+            destination_path,
+            ExpiresIn=expires_in,
+            Fields={
+                "Content-Type": "application/pdf",
+                **(fields or {}),
+            },
+            Conditions=[["starts-with", "$Content-Type", "application/pdf"], *(conditions or [])],
+        ),
     )
 
-    # Upload body HTML to s3 and get a link to hand to splat
-    tmp_html_key = config.get_tmp_html_key_fn()
 
+def upload_html(s3_client: Any, bucket_name: str, body_html: str, expires_in: int = 1800) -> tuple[str, str]:
+    """Uploads body html to s3, returning its key and a presigned link to hand to splat"""
+    if config.share_assets:
+        body_html = share_assets(s3_client, bucket_name, body_html, expires_in)
+    tmp_html_key = config.get_tmp_html_key_fn()
     s3_client.put_object(
         Body=body_html,
         Bucket=bucket_name,
         Key=tmp_html_key,
         Tagging=config.default_tagging,
     )
-
     document_url = s3_client.generate_presigned_url(
         "get_object",
         Params={"Bucket": bucket_name, "Key": tmp_html_key},
-        ExpiresIn=1800,
+        ExpiresIn=expires_in,
     )
+    return tmp_html_key, document_url
 
-    splat_body = json.dumps(
-        {
-            "document_url": document_url,
-            "presigned_url": presigned_url,
-            "javascript": javascript,
-        }
-    )
 
+def invoke(lambda_client: Any, splat_body: dict) -> dict:
+    """Invokes splat and returns its parsed response, whatever its status code"""
+    invoked_at = time.monotonic()
     response = lambda_client.invoke(
         FunctionName=config.function_name,
-        Payload=json.dumps({"body": splat_body}),
+        Payload=json.dumps({"body": json.dumps(splat_body)}),
     )
-
-    # Remove the temporary html file from s3
-    config.delete_key_fn(bucket_name, tmp_html_key)
+    invoke_seconds = time.monotonic() - invoked_at
 
     # Check response of the invocation. Note that a successful invocation doesn't mean the PDF was generated.
     if response.get("StatusCode") != 200:
@@ -109,80 +144,383 @@ def pdf_from_html(
         raise SplatPDFGenerationFailure("Invalid lambda response format") from exc
     except JSONDecodeError as exc:
         raise SplatPDFGenerationFailure("Error decoding splat response body as json") from exc
+    log_timings(splat_response, invoke_seconds)
+    return cast(dict, splat_response)
 
-    # ==== Success ====
-    if splat_response.get("statusCode") == 201:
-        # If no s3 path, read the pdf from the temp location we had splat save it to, delete it, and return the pdf file as bytes.
-        if is_streaming:
-            obj = s3_client.get_object(Bucket=bucket_name, Key=destination_path)
-            pdf_bytes = obj["Body"].read()
-            try:
-                config.delete_key_fn(bucket_name, destination_path)
-            except Exception:  # noqa
-                pass
-            return cast(bytes, pdf_bytes)
-        return None
 
-    # ==== Failure ====
+def invoke_event(lambda_client: Any, splat_body: dict) -> None:
+    """Queues an asynchronous invocation of splat, which returns once lambda has accepted it rather than rendered it"""
+    response = lambda_client.invoke(
+        FunctionName=config.function_name,
+        InvocationType="Event",
+        Payload=json.dumps({"body": json.dumps(splat_body)}),
+    )
+    if response.get("StatusCode") != 202:
+        raise SplatPDFGenerationFailure(f"Invalid response while invoking splat lambda - {response.get('StatusCode')}")
+
+
+def download(s3_client: Any, bucket_name: str, key: str) -> bytes:
+    """Reads a pdf splat saved to s3, then deletes it in the background"""
+    obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+    pdf_bytes = obj["Body"].read()
+    deleter(bucket_name, key)
+    return cast(bytes, pdf_bytes)
+
+
+def download_to_file(
+    s3_client: Any,
+    bucket_name: str,
+    key: str,
+    destination: str | os.PathLike | BinaryIO,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    max_concurrency: int = DOWNLOAD_MAX_CONCURRENCY,
+) -> None:
+    """Writes a pdf splat saved to s3 to a file path or file object, in parts fetched in parallel"""
+    transfer_config = TransferConfig(
+        multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=max_concurrency
+    )
+    if isinstance(destination, str | os.PathLike):
+        s3_client.download_file(bucket_name, key, os.fspath(destination), Config=transfer_config)
+    else:
+        s3_client.download_fileobj(bucket_name, key, destination, Config=transfer_config)
+
+
+def iter_parts(
+    s3_client: Any,
+    bucket_name: str,
+    key: str,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    max_concurrency: int = DOWNLOAD_MAX_CONCURRENCY,
+) -> Iterator[bytes]:
+    """Yields a pdf splat saved to s3 in order, part_size bytes at a time, fetching up to max_concurrency parts ahead"""
+
+    def get_part(start: int) -> dict:
+        return cast(
+            dict, s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{start + part_size - 1}")
+        )
+
+    def read_part(start: int) -> bytes:
+        return cast(bytes, get_part(start)["Body"].read())
+
+    # The first part says how large the pdf is, e.g. "bytes 0-8388607/314572800"
+    first = get_part(0)
+    size = int(first["ContentRange"].rpartition("/")[2])
+    yield first["Body"].read()
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="splat-download")
+    try:
+        parts: deque[Future] = deque()
+        for start in range(part_size, size, part_size):
+            parts.append(executor.submit(read_part, start))
+            if len(parts) >= max_concurrency:
+                yield parts.popleft().result()
+        while parts:
+            yield parts.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def spilled_location(splat_response: dict) -> tuple[str, str]:
+    """Returns the bucket and key of a pdf that splat uploaded to its spill bucket because it was too large to return"""
+    try:
+        spilled = json.loads(splat_response["body"])
+        return spilled["bucket"], spilled["key"]
+    except (KeyError, TypeError, JSONDecodeError) as exc:
+        raise SplatPDFGenerationFailure("Invalid spilled pdf response from splat") from exc
+
+
+def raise_for_error(splat_response: dict) -> NoReturn:
     # Lambda timeout et al.
-    elif error_message := splat_response.get("errorMessage"):
+    if error_message := splat_response.get("errorMessage"):
         raise SplatPDFGenerationFailure(f"Error returned from lambda invocation: {error_message}")
     # All other errors
-    else:
-        # Try to extract an error message from splat response
-        try:
-            splat_error = json.loads(splat_response["body"])["errors"][0]
-        except (KeyError, JSONDecodeError):
-            splat_error = splat_response
-        raise SplatPDFGenerationFailure(f"Error returned from splat: {splat_error}")
+    # Try to extract an error message from splat response
+    try:
+        splat_error = json.loads(splat_response["body"])["errors"][0]
+    except (KeyError, JSONDecodeError):
+        splat_error = splat_response
+    raise SplatPDFGenerationFailure(f"Error returned from splat: {splat_error}")
 
 
-def pdf_from_html_without_s3(
+def pdf_from_html(
     body_html: str,
+    *,
+    bucket_name: str | None = None,
+    s3_filepath: str | None = None,
     javascript: bool = False,
-) -> bytes:
-    """Generates a pdf from html without using s3. This is useful for small pdfs and html documents.
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+) -> bytes | None:
+    """Generates a pdf from html using the splat lambda function.
 
-    The maximum size of the html document is 6MB. The maximum size of the pdf is 6MB.
+    :param body_html: the html to convert to pdf
+    :param bucket_name: the bucket to upload the html to. defaults to config.default_bucket_name
+    :param s3_filepath: the path to upload the pdf to. defaults to a random path in the bucket
+    :param fields: additional fields to add to the presigned url
+    :param conditions: additional conditions to add to the presigned url
     """
-    session = config.get_session_fn()
-    lambda_client = session.client(
-        "lambda",
-        region_name=config.function_region,
-        config=Config(read_timeout=60 * 15, retries={"max_attempts": 0}),
-    )
+    bucket_name = bucket_name or config.default_bucket_name
+    destination_path = s3_filepath or f"tmp/{uuid4()}.pdf"
+    s3_client = render_to_s3(body_html, bucket_name, destination_path, javascript, fields, conditions)
 
-    splat_body = json.dumps({"document_content": body_html, "javascript": javascript})
+    # If no s3 path, read the pdf from the temp location we had splat save it to, delete it, and return the pdf file as bytes.
+    if not s3_filepath:
+        return download(s3_client, bucket_name, destination_path)
+    return None
 
-    response = lambda_client.invoke(
-        FunctionName=config.function_name,
-        Payload=json.dumps({"body": splat_body}),
-    )
 
-    # Check response of the invocation. Note that a successful invocation doesn't mean the PDF was generated.
-    if response.get("StatusCode") != 200:
-        raise SplatPDFGenerationFailure(
-            "Invalid response while invoking splat lambda -" f" {response.get('StatusCode')}"
+def render_to_s3(
+    body_html: str,
+    bucket_name: str,
+    destination_path: str,
+    javascript: bool,
+    fields: dict | None,
+    conditions: list[list] | None,
+) -> Any:
+    """Has splat render body_html to destination_path in the bucket, and returns the s3 client to fetch it with"""
+    if not bucket_name:
+        raise SplatPDFGenerationFailure("Invalid configuration: no bucket name provided")
+
+    s3_client = get_s3_client()
+    presigned_url = presign_destination(s3_client, bucket_name, destination_path, fields, conditions)
+    tmp_html_key, document_url = upload_html(s3_client, bucket_name, body_html)
+    try:
+        splat_response = invoke(
+            get_lambda_client(),
+            {"document_url": document_url, "presigned_url": presigned_url, "javascript": javascript},
         )
+    finally:
+        # Remove the temporary html file from s3
+        deleter(bucket_name, tmp_html_key)
 
-    # Parse lambda response
+    # ==== Success ====
+    if splat_response.get("statusCode") == 201:
+        return s3_client
+    # ==== Failure ====
+    raise_for_error(splat_response)
+
+
+def pdf_from_html_to_file(
+    body_html: str,
+    destination: str | os.PathLike | BinaryIO,
+    *,
+    bucket_name: str | None = None,
+    javascript: bool = False,
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    max_concurrency: int = DOWNLOAD_MAX_CONCURRENCY,
+) -> None:
+    """Generates a pdf from html using the splat lambda function, writing it to a file path or file object rather than
+    holding it in memory. Pdfs larger than part_size are downloaded in parts, up to max_concurrency at once.
+
+    See pdf_from_html for the other arguments.
+    """
+    bucket_name = bucket_name or config.default_bucket_name
+    key = f"tmp/{uuid4()}.pdf"
+    s3_client = render_to_s3(body_html, bucket_name, key, javascript, fields, conditions)
     try:
-        splat_response = json.loads(response["Payload"].read().decode("utf-8"))
-    except (KeyError, AttributeError) as exc:
-        raise SplatPDFGenerationFailure("Invalid lambda response format") from exc
+        download_to_file(s3_client, bucket_name, key, destination, part_size, max_concurrency)
+    finally:
+        deleter(bucket_name, key)
+
+
+def pdf_from_html_chunks(
+    body_html: str,
+    *,
+    bucket_name: str | None = None,
+    javascript: bool = False,
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    max_concurrency: int = DOWNLOAD_MAX_CONCURRENCY,
+) -> Iterator[bytes]:
+    """Generates a pdf from html using the splat lambda function, yielding it part_size bytes at a time, e.g. to
+    stream it to a response. Parts are fetched up to max_concurrency ahead of the one being yielded.
+
+    Rendering starts on the first iteration, so that's where errors are raised. See pdf_from_html for the other
+    arguments.
+    """
+    bucket_name = bucket_name or config.default_bucket_name
+    key = f"tmp/{uuid4()}.pdf"
+    s3_client = render_to_s3(body_html, bucket_name, key, javascript, fields, conditions)
+    try:
+        yield from iter_parts(s3_client, bucket_name, key, part_size, max_concurrency)
+    finally:
+        deleter(bucket_name, key)
+
+
+@dataclass
+class PdfResult:
+    """The outcome of one document rendered by pdf_from_html_many"""
+
+    index: int  # of the document in the iterable passed to pdf_from_html_many
+    pdf: bytes | None = None  # None when it failed, or was saved to its s3_filepath
+    error: Exception | None = None
+
+
+def pdf_from_html_many(
+    documents: Iterable[str | Mapping[str, Any]],
+    *,
+    bucket_name: str | None = None,
+    javascript: bool = False,
+    max_concurrency: int = 8,
+) -> Iterator[PdfResult]:
+    """Generates pdfs from many html documents using the splat lambda function, yielding each as it completes.
+
+    Documents are read from the iterable as renders complete, so it can be a generator. A document that fails to
+    render yields a result with its error rather than stopping the others.
+
+    :param documents: the html of each document, or the keyword arguments of pdf_from_html for it, e.g.
+        `{"body_html": "<h1>test</h1>", "s3_filepath": "invoices/1.pdf"}`
+    :param bucket_name: the default bucket to upload the html to. defaults to config.default_bucket_name
+    :param javascript: the default for documents that don't set it
+    :param max_concurrency: the number of documents rendered at once
+    """
+
+    def render(document: str | Mapping[str, Any]) -> bytes | None:
+        options = {"body_html": document} if isinstance(document, str) else dict(document)
+        if unknown := options.keys() - PDF_OPTIONS:
+            raise SplatPDFGenerationFailure(f"Invalid document options: {', '.join(sorted(unknown))}")
+        return pdf_from_html(
+            options["body_html"],
+            bucket_name=options.get("bucket_name", bucket_name),
+            s3_filepath=options.get("s3_filepath"),
+            javascript=options.get("javascript", javascript),
+            fields=options.get("fields"),
+            conditions=options.get("conditions"),
+        )
 
+    pending: dict[Future, int] = {}
+    remaining = enumerate(documents)
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="splat")
+    try:
+        for index, document in itertools.islice(remaining, max_concurrency):
+            pending[executor.submit(render, document)] = index
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                if (error := future.exception()) is not None:
+                    yield PdfResult(index=index, error=error)
+                else:
+                    yield PdfResult(index=index, pdf=future.result())
+                # Keep max_concurrency renders in flight
+                for next_index, document in itertools.islice(remaining, 1):
+                    pending[executor.submit(render, document)] = next_index
+    finally:
+        # Waits for renders in flight when the caller stops early, so their temporary files are cleaned up
+        executor.shutdown(cancel_futures=True)
+
+
+def document_content_body(body_html: str, javascript: bool, compress: bool) -> dict:
+    """Returns the splat body sending body_html inline, gzipped when compress is set and that makes it smaller"""
+    splat_body = {"document_content": body_html, "javascript": javascript}
+    if compress:
+        compressed = {
+            "document_content": base64.b64encode(gzip.compress(body_html.encode("utf-8"))).decode("ascii"),
+            "document_content_encoding": "gzip+base64",
+            "javascript": javascript,
+        }
+        if payload_size(compressed) < payload_size(splat_body):
+            return compressed
+    return splat_body
+
+
+def payload_size(splat_body: dict) -> int:
+    """Returns the size of the lambda invocation payload for splat_body"""
+    return len(json.dumps({"body": json.dumps(splat_body)}).encode("utf-8"))
+
+
+def pdf_from_html_without_s3(
+    body_html: str,
+    javascript: bool = False,
+    compress: bool = False,
+) -> bytes:
+    """Generates a pdf from html without using s3. This is useful for small pdfs and html documents.
+
+    The maximum size of the html document is 6MB, or 6MB once gzipped and base64 encoded with compress. PDFs too
+    large to return from lambda (over ~4MB) are fetched from splat's spill bucket when it has one (see
+    SPLAT_SPILL_BUCKET), which requires permission to read and delete them.
+    """
+    return _pdf_from_splat_body(document_content_body(body_html, javascript, compress))
+
+
+def _pdf_from_splat_body(splat_body: dict) -> bytes:
+    return _pdf_from_splat_response(invoke(get_lambda_client(), splat_body))
+
+
+def _pdf_from_splat_response(splat_response: dict) -> bytes:
     # ==== Success ====
     if splat_response.get("statusCode") == 200:
         return base64.b64decode(splat_response.get("body"))
+    # Too large to return, splat uploaded it to its spill bucket instead
+    elif splat_response.get("statusCode") == 303:
+        return download(get_s3_client(), *spilled_location(splat_response))
     # ==== Failure ====
-    # Lambda timeout et al.
-    elif error_message := splat_response.get("errorMessage"):
-        raise SplatPDFGenerationFailure(f"Error returned from lambda invocation: {error_message}")
-    # All other errors
-    else:
-        # Try to extract an error message from splat response
-        try:
-            splat_error = json.loads(splat_response["body"])["errors"][0]
-        except (KeyError, JSONDecodeError):
-            splat_error = splat_response
-        raise SplatPDFGenerationFailure(f"Error returned from splat: {splat_error}")
+    raise_for_error(splat_response)
+
+
+def pdf_too_large(splat_response: dict) -> bool:
+    """Whether splat failed because the pdf was too large to return inline"""
+    return splat_response.get("statusCode") == 500 and PDF_TOO_LARGE_ERROR in str(splat_response.get("body"))
+
+
+def inline_splat_body(
+    body_html: str,
+    bucket_name: str | None,
+    s3_filepath: str | None,
+    javascript: bool,
+    fields: dict | None,
+    conditions: list[list] | None,
+    compress: bool,
+) -> dict | None:
+    """Returns the splat body sending body_html inline, and saving the pdf to s3_filepath when it's set, or None when
+    that doesn't fit in an invocation"""
+    splat_body = document_content_body(body_html, javascript, compress)
+    if payload_size(splat_body) > INVOKE_PAYLOAD_MAX_BYTES:
+        return None
+    if s3_filepath:
+        if not bucket_name:
+            raise SplatPDFGenerationFailure("Invalid configuration: no bucket name provided")
+        # Presigning is local, so this costs nothing when the body turns out not to fit
+        splat_body["presigned_url"] = presign_destination(get_s3_client(), bucket_name, s3_filepath, fields, conditions)
+        if payload_size(splat_body) > INVOKE_PAYLOAD_MAX_BYTES:
+            return None
+    return splat_body
+
+
+def pdf_with_splat(
+    body_html: str,
+    *,
+    bucket_name: str | None = None,
+    s3_filepath: str | None = None,
+    javascript: bool = False,
+    fields: dict | None = None,
+    conditions: list[list] | None = None,
+    compress: bool = True,
+) -> bytes | None:
+    """Generates a pdf from html, sending the html inline when it fits in the invocation and via s3 when it doesn't.
+
+    Inline skips uploading the html to s3 and deleting it afterwards. The pdf is saved to s3 when s3_filepath is set,
+    however the html is sent. Takes the arguments of pdf_from_html, plus compress, which gzips the html when that makes
+    it smaller, so far larger documents fit inline. A pdf too large to return inline (over ~4MB) when splat has no
+    spill bucket is rendered again via s3, if there's a bucket to use.
+    """
+    bucket_name = bucket_name or config.default_bucket_name
+    splat_body = inline_splat_body(body_html, bucket_name, s3_filepath, javascript, fields, conditions, compress)
+    if splat_body is not None:
+        splat_response = invoke(get_lambda_client(), splat_body)
+        # ==== Saved to s3_filepath ====
+        if s3_filepath and splat_response.get("statusCode") == 201:
+            return None
+        if not (pdf_too_large(splat_response) and bucket_name):
+            return _pdf_from_splat_response(splat_response)
+    return pdf_from_html(
+        body_html,
+        bucket_name=bucket_name,
+        s3_filepath=s3_filepath,
+        javascript=javascript,
+        fields=fields,
+        conditions=conditions,
+    )